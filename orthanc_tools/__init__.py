@@ -7,11 +7,13 @@ from .pacs_migrator import PacsMigrator
 from .orthanc_comparator import OrthancComparator
 from .orthanc_cleaner import OrthancCleaner
 from .orthanc_replicator import OrthancReplicator
+from .replicator_transports import ReplicatorTransport, ReplicatorMessage, RabbitMqTransport, SqliteTransport
 from .ids_migrator import IdsMigrator
 from .orthanc_downloader import *
 from .orthanc_warmer import OrthancWarmer
 from .label_modifier import LabelModifier
-from .orthanc_syncher import OrthancSyncher
+from .orthanc_syncher import OrthancSyncher, SyncherTransferMode
+from .orthanc_multi_syncher import OrthancMultiSyncher
 from .orthanc_files_checker import OrthancFilesChecker
 
 from .hl7Lib import *
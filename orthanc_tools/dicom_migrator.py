@@ -10,19 +10,36 @@ import multiprocessing
 import random
 import pydicom
 import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 from orthanc_api_client import helpers
 from .helpers.scheduler import Scheduler
+from .helpers.timer import Timer
+from .helpers.adaptive_concurrency_limiter import AdaptiveConcurrencyLimiter
+from .helpers.migration_journal import MigrationJournal, MigrationStatus
+from .helpers.watermark_flow_controller import WatermarkFlowController
 
 from orthanc_api_client import OrthancApiClient
 logger = logging.getLogger(__name__)
 
 
 class Message:
-    def __init__(self, dicom_id: str = None, orthanc_id: str = None, should_stop: bool = False, info: str = None):
+    def __init__(self, dicom_id: str = None, orthanc_id: str = None, should_stop: bool = False, info: str = None,
+                 series_dicom_id: str = None, instances_count: int = None):
         self.dicom_id = dicom_id
         self.orthanc_id = orthanc_id
         self.should_stop = should_stop
         self.info = info
+        self.series_dicom_id = series_dicom_id      # only for the series of an expanded study (dicom_id is the StudyInstanceUID)
+        self.instances_count = instances_count      # the number of instances of the study in the source (if known)
+
+
+@dataclass
+class ExpandedStudy:
+    remaining_series_count: int
+    failed_series_ids: List[str] = field(default_factory=list)
+    size: Optional[int] = None
+    timer: Timer = field(default_factory=Timer)
 
 
 class DicomMigrator:
@@ -72,12 +89,25 @@ class DicomMigrator:
                  use_get_not_move: bool = False,
                  max_retries: int = 5,
                  constant_retry_delays: bool = False,
-                 error_log_path: str = None             # path to a file that will contain a CSV with the failed studies
+                 error_log_path: str = None,            # path to a file that will contain a CSV with the failed studies
+                 adaptive_concurrency: bool = False,    # adapt the number of concurrent C-MOVE/C-GET (up to worker_threads_count) to the throughput and failures of the source
+                 journal_path: str = None,              # path to a SQLite file recording the outcome of each study (to resume an interrupted migration)
+                 retry_failed_only: bool = False,       # only retry the studies that have failed according to the journal
+                 skip_existing_studies: bool = False,   # check by batches which studies are already complete at the destination and skip them
+                 destination_query_modality: str = None,  # alias of the destination modality (in this Orthanc config) to query when skip_existing_studies is enabled and the destination is a destination_aet
+                 existing_studies_batch_size: int = 100,  # the number of StudyInstanceUIDs checked in a single query
+                 series_expansion_threshold: int = None  # the studies with more instances are transferred series by series by all the workers
                  ):
 
         if (destination_aet is not None and destination_modality is not None):
             raise ValueError("You cannot define destinationAet and destinationModality together")
 
+        if retry_failed_only and journal_path is None:
+            raise ValueError("You cannot retry the failed studies without a journal")
+
+        if skip_existing_studies and source_modality is None:
+            raise ValueError("The existing studies can only be skipped when migrating from a source modality")
+
         self._api_client = api_client
         self._source_modality = source_modality
         self._max_cfind_study_count = max_cfind_study_count
@@ -94,7 +124,10 @@ class DicomMigrator:
 
         self._worker_threads_count = worker_threads_count
         self._worker_threads = []
-        self._messages = queue.Queue(maxsize=2*worker_threads_count)  # this is thread safe https://docs.python.org/3.5/library/queue.html#module-queue
+        self._messages = queue.Queue()  # this is thread safe https://docs.python.org/3.5/library/queue.html#module-queue
+        self._pushed_messages_slots = threading.Semaphore(2*worker_threads_count)  # limits the number of pushed messages waiting in the queue (the series of the expanded studies are not limited)
+        self._expanded_studies = {}
+        self._expanded_studies_lock = threading.Lock()
         self._is_running = False
 
         self._dicom_tags_to_query = {  # this might be extended once we implement filters
@@ -103,10 +136,38 @@ class DicomMigrator:
             'StudyInstanceUID': ''
         }
 
-        if not self._destination_modality and not self._destination_aet:
+        self._destination_is_this_orthanc = not self._destination_modality and not self._destination_aet
+        if self._destination_is_this_orthanc:
             # destination is orthanc -> set orthanc AET
             self._destination_aet = self._api_client.get_json('system')["DicomAet"]
 
+        self._concurrency_limiter = None
+        if adaptive_concurrency:
+            self._concurrency_limiter = AdaptiveConcurrencyLimiter(
+                name=source_modality or "source",
+                max_concurrency=worker_threads_count,
+                unit="MB" if self._destination_is_this_orthanc else "studies"
+            )
+
+        self._skip_existing_studies = skip_existing_studies
+        self._destination_query_modality = destination_query_modality
+        self._existing_studies_batch_size = existing_studies_batch_size
+        if skip_existing_studies:
+            if not self._destination_is_this_orthanc and destination_query_modality is None:
+                raise ValueError("You must define the destination_query_modality to skip the existing studies")
+            self._dicom_tags_to_query['NumberOfStudyRelatedInstances'] = ''
+
+        self._flow_controller: Optional[WatermarkFlowController] = None  # might be defined by the derived classes to pause the transfers
+
+        self._series_expansion_threshold = series_expansion_threshold
+        if series_expansion_threshold is not None:
+            self._dicom_tags_to_query['NumberOfStudyRelatedInstances'] = ''
+
+        self._journal = None
+        if journal_path is not None:
+            self._journal = MigrationJournal(path=journal_path)
+        self._retry_failed_only = retry_failed_only
+
     @property
     def source_is_orthanc(self):
         return self._source_modality is None
@@ -120,12 +181,15 @@ class DicomMigrator:
 
         while True:
             message = self._messages.get()  # block until a message is available
+            if not message.should_stop and message.series_dicom_id is None:
+                self._pushed_messages_slots.release()
 
             if message.should_stop:  # sent by stop() to stop all worker threads
                 self._messages.task_done()
                 break
 
             if self.source_is_orthanc:
+                timer = Timer()
                 try:
                     logger.info(f"C-Store study {message.orthanc_id} from orthanc to destination modality {self._destination_modality}")
                     # move the study from orthanc to the target modality
@@ -138,8 +202,13 @@ class DicomMigrator:
                         self._api_client.studies.delete(
                             orthanc_id=message.orthanc_id
                         )
+
+                    if self._journal:
+                        self._journal.set_done(message.orthanc_id, duration=timer.get_elapsed_seconds())
                 except Exception as ex:
                     logger.error(f"Error while transferring {message.orthanc_id} {str(ex)}")
+                    if self._journal:
+                        self._journal.set_failed(message.orthanc_id, duration=timer.get_elapsed_seconds())
                     if self._exit_on_error:
                         logger.info("exiting due to an error...")
                         self.stop_threads()
@@ -147,69 +216,285 @@ class DicomMigrator:
 
 
             elif self._source_modality and self._destination_aet:
-                retry_count = 0
-                if self._constant_retry_delays:
-                    retry_delays = [60]
+                if message.series_dicom_id is None and self._should_expand_study(message):
+                    self._expand_study(message)
                 else:
-                    retry_delays = [5, 20, 60, 120, 300, 600, 900, 1200, 1500, 1800, 3600]
+                    self._transfer_from_source(message)
 
-                while retry_count < self._max_retries:
-                    if retry_count >= 1:
-                        delay = retry_delays[min(retry_count, len(retry_delays)) - 1]
-                        logger.info(f"waiting {delay} seconds before retrying C-Move for study {message.dicom_id}")
-                        time.sleep(delay)
+            else:
+                raise NotImplementedError("configuration not handled")
+
+            self._messages.task_done()  # tell the queue the item has been processed
+
+        logger.debug(f"Processing thread {worker_thread_id} stopped")
 
+    def _transfer_from_source(self, message: Message):
+        # transfers a study (or a series of an expanded study) from the source modality, with retries
+        resource_summary = f"study {message.dicom_id}" if message.series_dicom_id is None else f"series {message.series_dicom_id} (study {message.dicom_id})"
+
+        retry_count = 0
+        if self._constant_retry_delays:
+            retry_delays = [60]
+        else:
+            retry_delays = [5, 20, 60, 120, 300, 600, 900, 1200, 1500, 1800, 3600]
+
+        transfer_timer = Timer()
+        duration = None     # the duration of the successful attempt (None if all attempts have failed)
+        while retry_count < self._max_retries:
+            if retry_count >= 1:
+                delay = retry_delays[min(retry_count, len(retry_delays)) - 1]
+                logger.info(f"waiting {delay} seconds before retrying C-Move for {resource_summary}")
+                time.sleep(delay)
+
+            if self._flow_controller:
+                self._flow_controller.acquire()  # block until the destination can handle one more transfer
+            if self._concurrency_limiter:
+                self._concurrency_limiter.acquire()  # block until the source can handle one more transfer
+
+            try:
+                timer = Timer()
+                # not possible to use the `retrive_study` method because the destination could be something else than Orthanc
+                if self._use_get_not_move:
+                    logger.info(
+                        f"C-Get {resource_summary} from source {self._source_modality} to Orthanc ({self._destination_aet})")
+                    # get the study from source to Orthanc
+                    if message.series_dicom_id is None:
+                        self._api_client.modalities.get_study(
+                            from_modality=self._source_modality,
+                            dicom_id=message.dicom_id
+                        )
+                    else:
+                        self._api_client.modalities.get_series(
+                            from_modality=self._source_modality,
+                            dicom_id=message.series_dicom_id,
+                            study_dicom_id=message.dicom_id
+                        )
+                else:
+                    logger.info(f"C-Move {resource_summary} from source {self._source_modality} to destination AET {self._destination_aet}")
+                    # move the study from source to target modality
+                    if message.series_dicom_id is None:
+                        self._api_client.modalities.move_study(
+                            from_modality=self._source_modality,
+                            dicom_id=message.dicom_id,
+                            to_modality_aet=self._destination_aet
+                        )
+                    else:
+                        self._api_client.modalities.move_series(
+                            from_modality=self._source_modality,
+                            dicom_id=message.series_dicom_id,
+                            study_dicom_id=message.dicom_id,
+                            to_modality_aet=self._destination_aet
+                        )
+
+                duration = timer.get_elapsed_seconds()
+                break
+            except Exception as ex:
+                if self._concurrency_limiter:
+                    self._concurrency_limiter.record_failure()
+
+                retry_count += 1
+                if retry_count == self._max_retries:
+                    logger.error(f"Error (retried {retry_count} times) while transferring {resource_summary} {str(ex)}")
+                    if self._exit_on_error:
+                        logger.info("exiting due to an error...")
+                        self.stop_threads()
+                        sys.exit(1)
+                else:
+                    logger.warning(f"Error while transferring, retrying... {resource_summary} {str(ex)}")
+            finally:
+                if self._concurrency_limiter:
+                    self._concurrency_limiter.release()
+                if self._flow_controller:
+                    self._flow_controller.release()
+
+        # the bookkeeping happens once the transfer is over: its failures must not trigger a new transfer
+        try:
+            if duration is not None:
+                size = None
+                if self._concurrency_limiter or self._journal:
                     try:
-                        # not possible to use the `retrive_study` method because the destination could be something else than Orthanc
-                        if self._use_get_not_move:
-                            logger.info(
-                                f"C-Get study {message.dicom_id} from source {self._source_modality} to Orthanc ({self._destination_aet})")
-                            # get the study from source to Orthanc
-                            self._api_client.modalities.get_study(
-                                from_modality=self._source_modality,
-                                dicom_id=message.dicom_id
-                            )
-                            break
-                        else:
-                            logger.info(f"C-Move study {message.dicom_id} from source {self._source_modality} to destination AET {self._destination_aet}")
-                            # move the study from source to target modality
-                            self._api_client.modalities.move_study(
-                                from_modality=self._source_modality,
-                                dicom_id=message.dicom_id,
-                                to_modality_aet=self._destination_aet
-                            )
-                            break
+                        size = self._get_disk_size(message)
                     except Exception as ex:
-                        retry_count += 1
-                        if retry_count == self._max_retries:
-                            logger.error(f"Error (retried {retry_count} times) while transferring {message.dicom_id} {str(ex)}")
-                            if self._exit_on_error:
-                                logger.info("exiting due to an error...")
-                                self.stop_threads()
-                                sys.exit(1)
-                            elif self._error_log_path and message.info:
-                                with self._error_log_lock:
-                                    with open(self._error_log_path, "at") as f:
-                                        f.write(message.info + "\n")
-                            break
-                        else:
-                            logger.warning(f"Error while transferring, retrying... {message.dicom_id} {str(ex)}")
+                        logger.warning(f"Could not get the size of {resource_summary} {str(ex)}")
 
+                if self._concurrency_limiter:
+                    self._concurrency_limiter.record_success(size=size / (1024 * 1024) if size is not None else 1, duration=duration)
+                self._on_transfer_completed(message, success=True, size=size, duration=duration)
             else:
-                raise NotImplementedError("configuration not handled")
+                self._on_transfer_completed(message, success=False, size=None, duration=transfer_timer.get_elapsed_seconds())
+        except Exception as ex:
+            logger.exception(f"Error while recording the transfer of {resource_summary} {str(ex)}")
+
+    def _on_transfer_completed(self, message: Message, success: bool, size: Optional[int], duration: float):
+        if message.series_dicom_id is not None:
+            # the study is complete once all its series have been transferred
+            with self._expanded_studies_lock:
+                expanded_study = self._expanded_studies[message.dicom_id]
+                expanded_study.remaining_series_count -= 1
+                if success:
+                    expanded_study.size = (expanded_study.size or 0) + size if size is not None else expanded_study.size
+                else:
+                    expanded_study.failed_series_ids.append(message.series_dicom_id)
 
-            self._messages.task_done()  # tell the queue the item has been processed
+                if expanded_study.remaining_series_count > 0:
+                    return
+                del self._expanded_studies[message.dicom_id]
 
-        logger.debug(f"Processing thread {worker_thread_id} stopped")
+            if len(expanded_study.failed_series_ids) > 0:
+                logger.error(f"Study {message.dicom_id}: {len(expanded_study.failed_series_ids)} series could not be transferred: {', '.join(expanded_study.failed_series_ids)}")
+            else:
+                logger.info(f"Study {message.dicom_id}: all series transferred")
+
+            message = Message(dicom_id=message.dicom_id, info=message.info)
+            success = len(expanded_study.failed_series_ids) == 0
+            size = expanded_study.size
+            duration = expanded_study.timer.get_elapsed_seconds()
+
+        if success:
+            if self._journal:
+                self._journal.set_done(message.dicom_id, size=size, duration=duration)
+        else:
+            if self._journal:
+                self._journal.set_failed(message.dicom_id, duration=duration)
+            if self._error_log_path and message.info:
+                with self._error_log_lock:
+                    with open(self._error_log_path, "at") as f:
+                        f.write(message.info + "\n")
+
+    def _should_expand_study(self, message: Message) -> bool:
+        if self._series_expansion_threshold is None:
+            return False
+
+        instances_count = message.instances_count
+        if instances_count is None:
+            try:
+                instances_count = self.get_studies_instances_counts(dicom_ids=[message.dicom_id], modality=self._source_modality).get(message.dicom_id)
+            except Exception as ex:
+                logger.warning(f"Could not get the instances count of study {message.dicom_id} {str(ex)}")
+
+        return instances_count is not None and instances_count > self._series_expansion_threshold
+
+    def _expand_study(self, message: Message):
+        # the series of a large study are transferred by all the workers (and retried individually)
+        try:
+            remote_series = self._api_client.modalities.query_series(
+                from_modality=self._source_modality,
+                query={
+                    'StudyInstanceUID': message.dicom_id,
+                    'SeriesInstanceUID': ''
+                })
+        except Exception as ex:
+            logger.warning(f"Could not list the series of study {message.dicom_id}, transferring the whole study {str(ex)}")
+            remote_series = []
+
+        if len(remote_series) == 0:
+            self._transfer_from_source(message)
+            return
+
+        logger.info(f"Study {message.dicom_id}: transferring {len(remote_series)} series concurrently")
+        with self._expanded_studies_lock:
+            self._expanded_studies[message.dicom_id] = ExpandedStudy(remaining_series_count=len(remote_series))
+
+        for series in remote_series:
+            self._messages.put(Message(dicom_id=message.dicom_id, series_dicom_id=series.dicom_id, info=message.info))
+
+    def _get_disk_size(self, message: Message) -> Optional[int]:
+        # in bytes, only known if the study/series has been transferred to this Orthanc
+        if not self._destination_is_this_orthanc:
+            return None
+
+        if message.series_dicom_id is None:
+            orthanc_id = self._api_client.studies.lookup(message.dicom_id)
+            resources = self._api_client.studies
+        else:
+            orthanc_id = self._api_client.series.lookup(message.series_dicom_id)
+            resources = self._api_client.series
+
+        if orthanc_id is None:
+            return 0
+        return resources.get_json_statistics(orthanc_id)['DiskSize']
+
+    def get_studies_instances_counts(self, dicom_ids: List[str], modality: Optional[str] = None) -> Dict[str, Optional[int]]:
+        # a single query for all the studies (DICOM list matching) in this Orthanc (if modality is None) or in a modality
+        # (the instances count is None if the modality does not provide it)
+        if modality is None:
+            json_studies = self._api_client.post(
+                endpoint="tools/find",
+                json={
+                    "Level": "Study",
+                    "Query": {"StudyInstanceUID": "\\".join(dicom_ids)},
+                    "Expand": True,
+                    "RequestedTags": ["NumberOfStudyRelatedInstances"]
+                }).json()
+            return {s["MainDicomTags"]["StudyInstanceUID"]: int(s.get("RequestedTags", {}).get("NumberOfStudyRelatedInstances", 0)) for s in json_studies}
+
+        remote_studies = self._api_client.modalities.query_studies(
+            from_modality=modality,
+            query={
+                'StudyInstanceUID': "\\".join(dicom_ids),
+                'NumberOfStudyRelatedInstances': ''
+            })
+        return {s.dicom_id: int(s.tags.get('NumberOfStudyRelatedInstances')) if s.tags.get('NumberOfStudyRelatedInstances') else None for s in remote_studies}
+
+    def get_existing_studies(self, source_instances_counts: Dict[str, Optional[int]]) -> List[str]:
+        # returns the studies that already exist at the destination with the same instances count as in the source.
+        # The unknown (None) source instances counts are first queried in the source (a single query per batch) and
+        # completed in source_instances_counts.  A study whose source instances count is still unknown is never
+        # skipped since it might only be partially migrated.
+        existing_studies = []
+        dicom_ids = list(source_instances_counts.keys())
+
+        for i in range(0, len(dicom_ids), self._existing_studies_batch_size):
+            batch = dicom_ids[i:i + self._existing_studies_batch_size]
+
+            unknown_counts_ids = [dicom_id for dicom_id in batch if source_instances_counts[dicom_id] is None]
+            if len(unknown_counts_ids) > 0:
+                queried_counts = self.get_studies_instances_counts(dicom_ids=unknown_counts_ids, modality=self._source_modality)
+                for dicom_id in unknown_counts_ids:
+                    source_instances_counts[dicom_id] = queried_counts.get(dicom_id)
+
+            destination_instances_counts = self.get_studies_instances_counts(
+                dicom_ids=batch,
+                modality=None if self._destination_is_this_orthanc else self._destination_query_modality)
+
+            for dicom_id in batch:
+                if source_instances_counts[dicom_id] is not None and source_instances_counts[dicom_id] == destination_instances_counts.get(dicom_id):
+                    existing_studies.append(dicom_id)
+
+        return existing_studies
+
+    def push_message(self, message: Message, journal_range_key: str = None):
+        if self._journal:
+            study_id = message.orthanc_id if self.source_is_orthanc else message.dicom_id
+            if self._journal.is_done(study_id):
+                logger.info(f"Skipping study {study_id}, already migrated")
+                return
+            self._journal.set_pending(study_id, info=message.info, range_key=journal_range_key)
 
-    def push_message(self, message: Message):
         if self._scheduler:
             self._scheduler.wait_right_time_to_run()
 
+        self._pushed_messages_slots.acquire()
         self._messages.put(message)
 
+    def push_journal_entries(self, status: MigrationStatus, journal_range_key: str = None) -> List[str]:
+        # push the studies from the journal (without querying the source), returns the ids of the studies pushed
+        entries = self._journal.get_entries(status, range_key=journal_range_key)
+        logger.info(f"Pushing {len(entries)} {status} studies from the journal")
+
+        for entry in entries:
+            if self.source_is_orthanc:
+                self.push_message(Message(orthanc_id=entry.study_id, info=entry.info), journal_range_key=entry.range_key)
+            else:
+                self.push_message(Message(dicom_id=entry.study_id, info=entry.info), journal_range_key=entry.range_key)
+
+        return [entry.study_id for entry in entries]
+
     def stop_threads(self):
         logger.info("Waiting for worker threads to complete")
+        if threading.current_thread() not in self._worker_threads:
+            self._messages.join()  # the series of the expanded studies are pushed by the worker threads themselves
+
         # post one 'empty' exit message per thread to unlock the threads from waiting on the process queue
         for i in range(0, self._worker_threads_count):
             self._messages.put(Message(should_stop=True))
@@ -217,6 +502,13 @@ class DicomMigrator:
         for worker_thread in self._worker_threads:
             worker_thread.join()
 
+        if self._flow_controller:
+            self._flow_controller.stop()
+
+        if self._journal:
+            self._journal.commit()
+            logger.info(f"Journal: {self._journal.get_count(MigrationStatus.DONE)} studies done, {self._journal.get_count(MigrationStatus.FAILED)} failed, {self._journal.get_count(MigrationStatus.PENDING)} pending")
+
         self._is_running = False
         self._worker_threads = []
 
@@ -246,6 +538,9 @@ class DicomMigrator:
                 args=(i,)
             ))
 
+        if self._flow_controller:
+            self._flow_controller.start()
+
         # start threads
         self._is_running = True
         for worker_thread in self._worker_threads:
@@ -1,2 +1,10 @@
 from .scheduler import Scheduler
 from .old_files_deleter import OldFilesDeleter
+from .circuit_breaker import CircuitBreaker, CircuitBreakerState
+from .bulk_deleter import BulkDeleter
+from .orthanc_snapshot import OrthancSnapshot, StudySummary, find_studies_summaries, get_study_summary, get_study_content
+from .study_date_range_splitter import StudyDateRangeSplitter, StudyDateRange
+from .modality_query_cache import ModalityQueryCache, CachedQueryResult
+from .adaptive_concurrency_limiter import AdaptiveConcurrencyLimiter
+from .migration_journal import MigrationJournal, MigrationJournalEntry, MigrationStatus
+from .watermark_flow_controller import WatermarkFlowController
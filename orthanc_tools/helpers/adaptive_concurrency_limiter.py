@@ -0,0 +1,118 @@
+import threading
+import time
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent transfers to a remote modality and adapts this limit to what the modality
+    can handle (AIMD: additive increase, multiplicative decrease).
+
+    The limit is re-evaluated each time 2 x `concurrency` transfers have completed:
+    - if one of the transfers has failed or if the transfers are much slower (per MB) than usual
+      (> `latency_spike_factor` x the average), the limit is multiplied by `decrease_factor`,
+    - otherwise, if the global throughput has improved since the previous evaluation, the limit is increased by 1.
+
+    example:
+        limiter = AdaptiveConcurrencyLimiter(name="pacs", max_concurrency=8)
+        limiter.acquire()   # blocks until a slot is available
+        try:
+            timer = Timer()
+            transfer()
+            limiter.record_success(size=study_size_in_mb, duration=timer.get_elapsed_seconds())
+        except Exception:
+            limiter.record_failure()
+        finally:
+            limiter.release()
+    """
+
+    def __init__(self, name: str, max_concurrency: int, min_concurrency: int = 1, initial_concurrency: Optional[int] = None,
+                 decrease_factor: float = 0.5, latency_spike_factor: float = 3.0, unit: str = "MB"):
+        """
+        :param name: the name of the remote modality (for logging)
+        :param max_concurrency: the maximum number of concurrent transfers
+        :param min_concurrency: the minimum number of concurrent transfers
+        :param initial_concurrency: the number of concurrent transfers to start with (default: min_concurrency)
+        :param decrease_factor: the factor applied to the concurrency in case of failures or latency spikes
+        :param latency_spike_factor: a transfer slower than this factor x the average duration per unit is a latency spike
+        :param unit: the unit of the transfers size (for logging)
+        """
+        self._name = name
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._decrease_factor = decrease_factor
+        self._latency_spike_factor = latency_spike_factor
+        self._unit = unit
+
+        self._condition = threading.Condition()
+        self._concurrency = initial_concurrency or min_concurrency
+        self._in_flight_count = 0
+
+        self._window_start = time.monotonic()
+        self._window_size = 0.0
+        self._window_durations_per_unit = []
+        self._window_failures_count = 0
+        self._previous_throughput = None
+        self.average_duration_per_unit = None   # exponential moving average of the duration (in seconds) per unit
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight_count >= self._concurrency:
+                self._condition.wait()
+            self._in_flight_count += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight_count -= 1
+            self._condition.notify_all()
+
+    def record_success(self, size: float, duration: float):
+        with self._condition:
+            self._window_size += size
+            if size > 0:
+                self._window_durations_per_unit.append(duration / size)
+            self._evaluate_if_needed()
+
+    def record_failure(self):
+        with self._condition:
+            self._window_failures_count += 1
+            self._evaluate_if_needed()
+
+    def _evaluate_if_needed(self):
+        samples_count = len(self._window_durations_per_unit) + self._window_failures_count
+        if samples_count < 2 * self._concurrency:
+            return
+
+        throughput = self._window_size / max(time.monotonic() - self._window_start, 1e-6)
+
+        is_latency_spike = False
+        if len(self._window_durations_per_unit) > 0:
+            duration_per_unit = sum(self._window_durations_per_unit) / len(self._window_durations_per_unit)
+            if self.average_duration_per_unit is None:
+                self.average_duration_per_unit = duration_per_unit
+            else:
+                is_latency_spike = duration_per_unit > self._latency_spike_factor * self.average_duration_per_unit
+                self.average_duration_per_unit = 0.8 * self.average_duration_per_unit + 0.2 * duration_per_unit
+
+        previous_concurrency = self._concurrency
+        if self._window_failures_count > 0 or is_latency_spike:
+            self._concurrency = max(self._min_concurrency, int(self._concurrency * self._decrease_factor))
+        elif self._previous_throughput is None or throughput > self._previous_throughput:
+            self._concurrency = min(self._max_concurrency, self._concurrency + 1)
+
+        logger.info(f"{self._name}: concurrency {previous_concurrency} -> {self._concurrency} (throughput: {throughput:.2f} {self._unit}/s, "
+                    f"failures: {self._window_failures_count}/{samples_count}{', latency spike' if is_latency_spike else ''})")
+
+        self._previous_throughput = throughput
+        self._window_start = time.monotonic()
+        self._window_size = 0.0
+        self._window_durations_per_unit = []
+        self._window_failures_count = 0
+        self._condition.notify_all()
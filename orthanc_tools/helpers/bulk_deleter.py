@@ -0,0 +1,131 @@
+import threading
+import time
+import logging
+from typing import List, Set
+
+logger = logging.getLogger(__name__)
+
+
+class BulkDeleter:
+    """
+    Buffers the instances to delete and deletes them in batches through Orthanc's /tools/bulk-delete route.
+    The batches are issued from a dedicated thread with a pause between two batches such that the deletions
+    do not compete too much with the ingestion on the Orthanc DB.
+
+    The instances remain 'pending' until they have actually been deleted.  Use is_pending() to avoid handling
+    them again in the meantime.
+
+    example:
+        with BulkDeleter(api_client=orthanc) as deleter:
+            deleter.add(instances_ids)
+    """
+
+    def __init__(self, api_client, batch_size: int = 500, flush_interval: float = 5.0, pause_between_batches: float = 0.5):
+        """
+        :param api_client: the Orthanc to delete from
+        :param batch_size: the maximum number of instances deleted in a single bulk-delete
+        :param flush_interval: the maximum delay (in seconds) before an incomplete batch is deleted
+        :param pause_between_batches: the delay (in seconds) between two consecutive batches
+        """
+        self._api_client = api_client
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pause_between_batches = pause_between_batches
+
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._to_delete = []        # instances ids waiting for a batch, in order of arrival
+        self._pending = set()       # instances ids that have not been deleted yet (buffered + being deleted)
+        self._is_running = False
+        self._thread = None
+
+    def add(self, instances_ids: List[str]):
+        with self._lock:
+            for instance_id in instances_ids:
+                if instance_id not in self._pending:
+                    self._pending.add(instance_id)
+                    self._to_delete.append(instance_id)
+
+            if len(self._to_delete) >= self._batch_size:
+                self._wake_up.set()
+
+    def is_pending(self, instance_id: str) -> bool:
+        with self._lock:
+            return instance_id in self._pending
+
+    def get_pending_ids(self) -> Set[str]:
+        with self._lock:
+            return set(self._pending)
+
+    def _get_buffered_count(self) -> int:
+        with self._lock:
+            return len(self._to_delete)
+
+    def delete_next_batch(self) -> int:
+        # returns the number of instances deleted
+        with self._lock:
+            batch = self._to_delete[:self._batch_size]
+            self._to_delete = self._to_delete[self._batch_size:]
+
+        if len(batch) == 0:
+            return 0
+
+        try:
+            self._api_client.post(
+                endpoint="tools/bulk-delete",
+                json={
+                    "Resources": batch
+                })
+        except Exception as ex:
+            logger.error(f"Error while deleting {len(batch)} instances, will retry: {str(ex)}")
+            with self._lock:
+                self._to_delete = batch + self._to_delete
+            return 0
+
+        with self._lock:
+            self._pending.difference_update(batch)
+
+        logger.debug(f"Deleted {len(batch)} instances")
+        return len(batch)
+
+    def flush(self):
+        # deletes all the buffered instances right now
+        while self._get_buffered_count() > 0:
+            if self.delete_next_batch() == 0:
+                break
+
+    def execute(self):
+        while self._is_running:
+            self._wake_up.wait(timeout=self._flush_interval)
+            self._wake_up.clear()
+
+            while self._is_running and self.delete_next_batch() > 0:
+                if self._get_buffered_count() < self._batch_size:
+                    break  # wait for the batch to fill up or for the flush_interval to expire
+                time.sleep(self._pause_between_batches)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._is_running = True
+        self._thread = threading.Thread(
+            target=self.execute,
+            name='BulkDeleter Thread',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._is_running = False
+        self._wake_up.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        # do not leave anything behind
+        self.flush()
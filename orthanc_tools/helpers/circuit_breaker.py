@@ -0,0 +1,112 @@
+import threading
+import time
+import logging
+from strenum import StrEnum
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreakerState(StrEnum):
+    CLOSED = 'closed'           # the destination is healthy, traffic is sent to it
+    OPEN = 'open'               # the destination is down, it shall not be contacted until a probe succeeds
+    HALF_OPEN = 'half-open'     # a probe has succeeded, the next call will tell if the destination is really back
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of a remote destination to avoid waiting for a full connection/association timeout
+    each time we try to send data to a destination that is down.
+
+    - the breaker trips OPEN after `failure_threshold` consecutive failures.  A call that is slower than
+      `max_latency` counts as a failure too.
+    - while the breaker is OPEN, the destination shall not be contacted.  Instead, it shall be probed with a
+      cheap request (i.e. a DICOM echo) every `probe_interval` seconds (see should_probe() and record_probe()).
+    - once a probe has succeeded, the breaker is HALF_OPEN: a single trial call is admitted (is_available() returns
+      True only once), it will close the breaker (if it succeeds) or open it again (if it fails).
+
+    example:
+        breaker = CircuitBreaker(name="pacs")
+        if breaker.is_available():
+            timer = Timer()
+            try:
+                send()
+                breaker.record_success(latency=timer.get_elapsed_seconds())
+            except Exception:
+                breaker.record_failure()
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 2, max_latency: Optional[float] = None, probe_interval: float = 10):
+        """
+        :param name: the name of the destination (for logging)
+        :param failure_threshold: the number of consecutive failures after which the breaker opens
+        :param max_latency: the duration (in seconds) above which a successful call is considered as a failure
+        :param probe_interval: the delay (in seconds) between two probes while the breaker is open
+        """
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._max_latency = max_latency
+        self._probe_interval = probe_interval
+
+        self._lock = threading.Lock()
+        self._state = CircuitBreakerState.CLOSED
+        self._consecutive_failures = 0
+        self._last_probe_time = None
+        self._trial_in_flight = False   # True while the trial call of the HALF_OPEN state is running
+        self.average_latency = None     # exponential moving average of the successful calls latency (in seconds)
+
+    @property
+    def state(self) -> CircuitBreakerState:
+        return self._state
+
+    def is_available(self) -> bool:
+        # when HALF_OPEN, only the first caller is admitted (until its call is recorded)
+        with self._lock:
+            if self._state == CircuitBreakerState.OPEN:
+                return False
+            if self._state == CircuitBreakerState.HALF_OPEN:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self, latency: Optional[float] = None):
+        with self._lock:
+            if latency is not None:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                else:
+                    self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+
+            is_slow = latency is not None and self._max_latency is not None and latency > self._max_latency
+            if not is_slow:
+                if self._state != CircuitBreakerState.CLOSED:
+                    logger.info(f"{self._name}: circuit breaker closed, the destination is available again")
+                self._state = CircuitBreakerState.CLOSED
+                self._consecutive_failures = 0
+                self._trial_in_flight = False
+
+        if is_slow:
+            logger.warning(f"{self._name}: slow call ({latency:.1f}s > {self._max_latency:.1f}s)")
+            self.record_failure()
+
+    def record_failure(self):
+        with self._lock:
+            self._trial_in_flight = False
+            self._consecutive_failures += 1
+            if self._state == CircuitBreakerState.HALF_OPEN or (self._state == CircuitBreakerState.CLOSED and self._consecutive_failures >= self._failure_threshold):
+                logger.warning(f"{self._name}: circuit breaker opened after {self._consecutive_failures} failure(s)")
+                self._state = CircuitBreakerState.OPEN
+                self._last_probe_time = time.monotonic()
+
+    def should_probe(self) -> bool:
+        with self._lock:
+            return self._state == CircuitBreakerState.OPEN and time.monotonic() - self._last_probe_time >= self._probe_interval
+
+    def record_probe(self, success: bool):
+        with self._lock:
+            self._last_probe_time = time.monotonic()
+            if success and self._state == CircuitBreakerState.OPEN:
+                logger.info(f"{self._name}: probe succeeded, circuit breaker half-opened")
+                self._state = CircuitBreakerState.HALF_OPEN
+                self._trial_in_flight = False
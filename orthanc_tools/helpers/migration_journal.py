@@ -0,0 +1,129 @@
+import datetime
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from strenum import StrEnum
+from typing import List, Optional
+
+
+class MigrationStatus(StrEnum):
+    PENDING = 'pending'         # the study has been found but its transfer has not completed yet
+    DONE = 'done'
+    FAILED = 'failed'           # the transfer has failed (after all retries)
+
+
+@dataclass
+class MigrationJournalEntry:
+    study_id: str
+    status: MigrationStatus
+    info: Optional[str] = None          # the info of the message (see DicomMigrator Message)
+    range_key: Optional[str] = None     # the migrated range the study has been found in (if any)
+    size: Optional[int] = None          # in bytes (only known if the destination is the migrator Orthanc)
+    duration: Optional[float] = None    # in seconds
+
+
+class MigrationJournal:
+    """
+    Stores the outcome of the transfer of each study of a migration such that an interrupted migration can
+    resume without transferring the completed studies again.
+
+    The journal also stores, for each migrated range, the last date whose studies have all been recorded such
+    that the resumed migration does not need to query these dates again.
+
+    The entries are stored in a SQLite database and the writes are committed by batches of `commit_interval`
+    (and when calling commit()).  In case of a crash, the uncommitted studies are simply transferred again.
+    """
+
+    def __init__(self, path: str, commit_interval: int = 100):
+        """
+        :param path: the path of the SQLite database file
+        :param commit_interval: the number of writes after which they are committed
+        """
+        self._commit_interval = commit_interval
+        self._uncommitted_count = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS studies (study_id TEXT PRIMARY KEY, status TEXT NOT NULL, info TEXT, range_key TEXT, size INTEGER, duration REAL, updated_at REAL NOT NULL) WITHOUT ROWID")
+            self._db.execute("CREATE INDEX IF NOT EXISTS studies_status ON studies (status)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ranges (range_key TEXT PRIMARY KEY, recorded_until TEXT NOT NULL) WITHOUT ROWID")
+            self._db.commit()
+
+    def get(self, study_id: str) -> Optional[MigrationJournalEntry]:
+        with self._lock:
+            row = self._db.execute("SELECT status, info, range_key, size, duration FROM studies WHERE study_id = ?", (study_id,)).fetchone()
+
+        if row is None:
+            return None
+        return MigrationJournalEntry(study_id=study_id, status=MigrationStatus(row[0]), info=row[1], range_key=row[2], size=row[3], duration=row[4])
+
+    def is_done(self, study_id: str) -> bool:
+        entry = self.get(study_id)
+        return entry is not None and entry.status == MigrationStatus.DONE
+
+    def set_pending(self, study_id: str, info: Optional[str] = None, range_key: Optional[str] = None):
+        # a study that is already done stays done
+        with self._lock:
+            self._db.execute("INSERT INTO studies (study_id, status, info, range_key, updated_at) VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT(study_id) DO UPDATE SET status = excluded.status, info = COALESCE(excluded.info, info), "
+                             "range_key = COALESCE(excluded.range_key, range_key), updated_at = excluded.updated_at "
+                             "WHERE status != ?",
+                             (study_id, MigrationStatus.PENDING, info, range_key, time.time(), MigrationStatus.DONE))
+            self._on_write()
+
+    def set_done(self, study_id: str, size: Optional[int] = None, duration: Optional[float] = None):
+        self._set_outcome(study_id, MigrationStatus.DONE, size, duration)
+
+    def set_failed(self, study_id: str, duration: Optional[float] = None):
+        self._set_outcome(study_id, MigrationStatus.FAILED, None, duration)
+
+    def _set_outcome(self, study_id: str, status: MigrationStatus, size: Optional[int], duration: Optional[float]):
+        with self._lock:
+            self._db.execute("INSERT INTO studies (study_id, status, size, duration, updated_at) VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT(study_id) DO UPDATE SET status = excluded.status, size = excluded.size, duration = excluded.duration, updated_at = excluded.updated_at",
+                             (study_id, status, size, duration, time.time()))
+            self._on_write()
+
+    def get_entries(self, status: MigrationStatus, range_key: Optional[str] = None) -> List[MigrationJournalEntry]:
+        # all the entries with this status, or only those found in the range_key range
+        with self._lock:
+            if range_key is None:
+                rows = self._db.execute("SELECT study_id, info, range_key, size, duration FROM studies WHERE status = ? ORDER BY study_id", (status,)).fetchall()
+            else:
+                rows = self._db.execute("SELECT study_id, info, range_key, size, duration FROM studies WHERE status = ? AND range_key = ? ORDER BY study_id", (status, range_key)).fetchall()
+        return [MigrationJournalEntry(study_id=r[0], status=status, info=r[1], range_key=r[2], size=r[3], duration=r[4]) for r in rows]
+
+    def get_count(self, status: MigrationStatus) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM studies WHERE status = ?", (status,)).fetchone()[0]
+
+    def get_recorded_until(self, range_key: str) -> Optional[datetime.date]:
+        with self._lock:
+            row = self._db.execute("SELECT recorded_until FROM ranges WHERE range_key = ?", (range_key,)).fetchone()
+        return datetime.date.fromisoformat(row[0]) if row is not None else None
+
+    def set_recorded_until(self, range_key: str, date: datetime.date):
+        # the studies up to this date have all been recorded (as pending at least)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO ranges (range_key, recorded_until) VALUES (?, ?)", (range_key, date.isoformat()))
+            self._db.commit()   # committed together with the pending studies of the date range
+            self._uncommitted_count = 0
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._uncommitted_count = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def _on_write(self):
+        self._uncommitted_count += 1
+        if self._uncommitted_count >= self._commit_interval:
+            self._db.commit()
+            self._uncommitted_count = 0
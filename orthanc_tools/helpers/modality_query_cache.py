@@ -0,0 +1,89 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+@dataclass
+class CachedQueryResult:
+    dicom_id: str
+    tags: Dict[str, str]
+
+
+class ModalityQueryCache:
+    """
+    Caches the results of the C-FIND queries to a remote modality in a SQLite database such that the queries
+    about old dates are not repeated at each execution.
+
+    An entry is valid:
+    - for a time-to-live that grows with the age of the study date: `ttl_ratio` * age (e.g, with a ratio of 0.1,
+      the results of a 30 days old date are kept for 3 days) up to `max_ttl_in_days`,
+    - and as long as the local content it has been compared to has not changed (e.g. if a study has been added
+      locally for this date, the modality is queried again).
+    """
+
+    def __init__(self, path: str, ttl_ratio: float = 0.1, max_ttl_in_days: float = 90):
+        """
+        :param path: the path of the SQLite database file
+        :param ttl_ratio: the time-to-live of an entry relative to the age of its study date
+        :param max_ttl_in_days: the maximum time-to-live of an entry
+        """
+        self._ttl_ratio = ttl_ratio
+        self._max_ttl_in_days = max_ttl_in_days
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS queries (query_key TEXT PRIMARY KEY, results TEXT NOT NULL, local_fingerprint TEXT NOT NULL, queried_at REAL NOT NULL) WITHOUT ROWID")
+            self._db.commit()
+
+    @staticmethod
+    def _get_local_fingerprint(local_ids: Iterable[str]) -> str:
+        return hashlib.blake2b("\n".join(sorted(local_ids)).encode("utf8"), digest_size=16).hexdigest()
+
+    def get_ttl(self, study_date: datetime.date) -> float:
+        # in seconds
+        age_in_days = max((datetime.date.today() - study_date).days, 0)
+        return min(age_in_days * self._ttl_ratio, self._max_ttl_in_days) * 24 * 3600
+
+    def get(self, query_key: str, study_date: datetime.date, local_ids: Iterable[str]) -> Optional[List[CachedQueryResult]]:
+        with self._lock:
+            row = self._db.execute("SELECT results, local_fingerprint, queried_at FROM queries WHERE query_key = ?", (query_key,)).fetchone()
+
+        if row is None:
+            return None
+
+        results, local_fingerprint, queried_at = row
+        if time.time() - queried_at > self.get_ttl(study_date) or local_fingerprint != self._get_local_fingerprint(local_ids):
+            return None
+
+        return [CachedQueryResult(dicom_id=r["dicom_id"], tags=r["tags"]) for r in json.loads(results)]
+
+    def set(self, query_key: str, local_ids: Iterable[str], results: List, tags_names: Iterable[str]):
+        # only the tags in tags_names are stored
+        serialized_results = json.dumps([{"dicom_id": r.dicom_id, "tags": {t: r.tags.get(t) for t in tags_names}} for r in results])
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO queries (query_key, results, local_fingerprint, queried_at) VALUES (?, ?, ?, ?)",
+                             (query_key, serialized_results, self._get_local_fingerprint(local_ids), time.time()))
+            self._db.commit()
+
+    def remove(self, query_key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM queries WHERE query_key = ?", (query_key,))
+            self._db.commit()
+
+    def query(self, query_key: str, study_date: datetime.date, local_ids: Iterable[str], query: Dict[str, str],
+              query_function: Callable[[Dict[str, str]], List]) -> List:
+        # returns the cached results if they are still valid, otherwise, performs the query and caches its results
+        local_ids = list(local_ids)
+        results = self.get(query_key, study_date, local_ids)
+        if results is None:
+            results = query_function(query)
+            self.set(query_key, local_ids, results, query.keys())
+        return results
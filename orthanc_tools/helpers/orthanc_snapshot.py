@@ -0,0 +1,135 @@
+import datetime
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from orthanc_api_client import OrthancApiClient, ResourceNotFound
+from orthanc_api_client.helpers import from_orthanc_datetime
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StudySummary:
+    orthanc_id: str
+    last_update: datetime.datetime
+    series_count: int
+    instances_count: int
+
+
+def _get_study_summary(json_study) -> StudySummary:
+    requested_tags = json_study.get("RequestedTags", {})
+    return StudySummary(
+        orthanc_id=json_study["ID"],
+        last_update=from_orthanc_datetime(json_study.get("LastUpdate")),
+        series_count=int(requested_tags.get("NumberOfStudyRelatedSeries", len(json_study.get("Series", [])))),
+        instances_count=int(requested_tags.get("NumberOfStudyRelatedInstances", 0))
+    )
+
+
+def find_studies_summaries(api_client: OrthancApiClient, limit: int, since: int) -> List[StudySummary]:
+    """
+    Lists a page of studies with their series/instances counts in a single call to /tools/find.
+    The studies are ordered by LastUpdate (most recent first).
+    """
+    json_studies = api_client.post(
+        endpoint="tools/find",
+        json={
+            "Level": "Study",
+            "Query": {},
+            "Expand": True,
+            "RequestedTags": ["NumberOfStudyRelatedSeries", "NumberOfStudyRelatedInstances"],
+            "Limit": limit,
+            "Since": since,
+            "OrderBy": [
+                {
+                    "Type": "Metadata",
+                    "Key": "LastUpdate",
+                    "Direction": "DESC"
+                }
+            ]
+        }).json()
+
+    return [_get_study_summary(s) for s in json_studies]
+
+
+def get_study_summary(api_client: OrthancApiClient, study_id: str) -> Optional[StudySummary]:
+    # returns None if the study does not exist
+    try:
+        json_study = api_client.get_json(f"studies/{study_id}", params={"requestedTags": "NumberOfStudyRelatedSeries;NumberOfStudyRelatedInstances"})
+    except ResourceNotFound:
+        return None
+    return _get_study_summary(json_study)
+
+
+def get_study_content(api_client: OrthancApiClient, study_id: str) -> Dict[str, Set[str]]:
+    """
+    Returns the instances ids of each series of a study (series_id -> instances_ids) in a single call.
+    """
+    try:
+        json_series = api_client.get_json(f"studies/{study_id}/series", params={"expand": ""})
+    except ResourceNotFound:
+        return {}
+    return {s["ID"]: set(s["Instances"]) for s in json_series}
+
+
+class OrthancSnapshot:
+    """
+    An in-memory snapshot of the studies of an Orthanc with their series/instances counts.
+    The content is listed by batches through /tools/find (most recently updated studies first) such that enumerating
+    a large Orthanc requires only a few requests (instead of one request per study).
+
+    The snapshot can be partial: load(last_update_limit) stops listing once it reaches studies that have not been
+    updated since last_update_limit.  The studies that have not been listed are then looked up one by one in get().
+    A snapshot can be shared between threads.
+
+    example:
+        snapshot = OrthancSnapshot(api_client=orthanc)
+        snapshot.load()
+        summary = snapshot.get(study_id)
+    """
+
+    def __init__(self, api_client: OrthancApiClient, batch_size: int = 1000):
+        self._api_client = api_client
+        self._batch_size = batch_size
+        self._lock = threading.RLock()
+        self._since = 0
+        self._listed_studies = []   # the studies that have been listed, most recently updated first
+        self.studies = {}           # study_id -> StudySummary (None if the study does not exist)
+        self.is_complete = False    # True once all studies have been listed
+
+    @property
+    def api_client(self) -> OrthancApiClient:
+        return self._api_client
+
+    def load(self, last_update_limit: datetime.datetime = None):
+        with self._lock:
+            while not self.is_complete:
+                summaries = find_studies_summaries(self._api_client, limit=self._batch_size, since=self._since)
+                self._since += len(summaries)
+                for s in summaries:
+                    self.studies[s.orthanc_id] = s
+                    self._listed_studies.append(s)
+
+                if len(summaries) < self._batch_size:
+                    self.is_complete = True
+                elif last_update_limit is not None and summaries[-1].last_update < last_update_limit:
+                    break
+
+            logger.info(f"Loaded a snapshot of {len(self._listed_studies)} studies" + ("" if self.is_complete else " (partial)"))
+
+    def get_studies_updated_since(self, last_update_limit: datetime.datetime) -> List[StudySummary]:
+        with self._lock:
+            return [s for s in self._listed_studies if s.last_update >= last_update_limit]
+
+    def get(self, study_id: str) -> Optional[StudySummary]:
+        with self._lock:
+            if study_id in self.studies or self.is_complete:
+                return self.studies.get(study_id)
+
+        # the study has not been listed: look for this study only
+        summary = get_study_summary(self._api_client, study_id)
+        with self._lock:
+            self.studies[study_id] = summary
+        return summary
@@ -0,0 +1,138 @@
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from orthanc_api_client import helpers
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StudyDateRange:
+    from_date: datetime.date
+    to_date: datetime.date
+    from_time: Optional[int] = None     # in seconds since midnight (only for the ranges within a single day)
+    to_time: Optional[int] = None
+    without_time: bool = False          # True for the studies of a single day that have no StudyTime
+    is_truncated: bool = False          # True if the results were still truncated and the range could not be split any further
+
+    def get_query(self) -> Dict[str, str]:
+        # the StudyDate/StudyTime tags to query (DICOM range matching)
+        first_date, last_date = sorted([self.from_date, self.to_date])
+        if first_date == last_date:
+            query = {'StudyDate': helpers.to_dicom_date(first_date)}
+        else:
+            query = {'StudyDate': f"{helpers.to_dicom_date(first_date)}-{helpers.to_dicom_date(last_date)}"}
+
+        if self.from_time is not None:
+            # the range ends at the last fraction of its last second such that the ranges are contiguous
+            query['StudyTime'] = f"{self._to_dicom_time(self.from_time)}-{self._to_dicom_time(self.to_time)}.999999"
+        elif self.without_time:
+            query['StudyTime'] = '""'   # DICOM empty value matching
+        return query
+
+    @staticmethod
+    def _to_dicom_time(seconds: int) -> str:
+        return f"{seconds // 3600:02d}{(seconds // 60) % 60:02d}{seconds % 60:02d}"
+
+    def __str__(self):
+        return "/".join(self.get_query().values())
+
+
+class StudyDateRangeSplitter:
+    """
+    Enumerates the studies of a date range with as few C-FIND as possible while never losing studies because
+    the source truncates its results to `max_results_count` studies.
+
+    The dates are queried by ranges of `initial_range_in_days`:
+    - a range whose results count reaches `max_results_count` is split in 2 and queried again,
+    - a single day that still reaches `max_results_count` is split by StudyTime ranges (down to a single second,
+      including its fractions).  Since the studies without a StudyTime do not match any StudyTime range, they are
+      queried once more through DICOM empty value matching (StudyTime = "") in a last range of the day,
+    - the next range is twice longer when the results are sparse (< 1/4 of the limit), and twice shorter when they
+      are dense (> 1/2 of the limit).
+
+    If `max_results_count` is unknown, a truncation can not be detected and the dates are queried one by one.
+    Note: a source that does not support empty value matching returns no studies for the last range of a dense day:
+    its studies without a StudyTime are then missed.
+
+    example:
+        splitter = StudyDateRangeSplitter(query_studies=lambda query: api_client.modalities.query_studies(from_modality='pacs', query=query),
+                                          max_results_count=1000)
+        for date_range, studies in splitter.iterate(from_date, to_date):
+            ...
+    """
+
+    def __init__(self,
+                 query_studies: Callable[[Dict[str, str]], List],   # performs the query with the StudyDate/StudyTime tags and returns the studies found
+                 max_results_count: int = None,                     # the known maximum amount of studies returned by a query
+                 initial_range_in_days: int = 30,
+                 max_range_in_days: int = 365):
+        self._query_studies = query_studies
+        self._max_results_count = max_results_count
+        self._initial_range_in_days = initial_range_in_days
+        self._max_range_in_days = max_range_in_days
+
+    def _is_truncated(self, results: List) -> bool:
+        return self._max_results_count is not None and len(results) >= self._max_results_count
+
+    def iterate(self, from_date: datetime.date, to_date: datetime.date) -> Iterator[Tuple[StudyDateRange, List]]:
+        # the dates are processed from from_date to to_date (possibly backward)
+        direction = 1 if from_date <= to_date else -1
+        range_in_days = self._initial_range_in_days if self._max_results_count is not None else 1
+
+        current_date = from_date
+        while (to_date - current_date).days * direction >= 0:
+            remaining_days = abs((to_date - current_date).days) + 1
+            range_in_days = min(range_in_days, remaining_days)
+            end_date = current_date + datetime.timedelta(days=(range_in_days - 1) * direction)
+
+            date_range = StudyDateRange(from_date=current_date, to_date=end_date)
+            results = self._query_studies(date_range.get_query())
+
+            if self._is_truncated(results):
+                if range_in_days > 1:
+                    logger.debug(f"Too many studies in {date_range}, splitting the range")
+                    range_in_days = range_in_days // 2
+                    continue
+
+                yield from self._iterate_time_ranges(current_date)
+            else:
+                yield date_range, results
+
+            current_date = end_date + datetime.timedelta(days=direction)
+
+            if self._max_results_count is not None:
+                if len(results) < self._max_results_count / 4:
+                    range_in_days = min(range_in_days * 2, self._max_range_in_days)
+                elif len(results) > self._max_results_count / 2:
+                    range_in_days = max(range_in_days // 2, 1)
+
+    def _iterate_time_ranges(self, date: datetime.date) -> Iterator[Tuple[StudyDateRange, List]]:
+        time_ranges = [(0, 24 * 3600 - 1)]
+
+        while len(time_ranges) > 0:
+            from_time, to_time = time_ranges.pop(0)
+            date_range = StudyDateRange(from_date=date, to_date=date, from_time=from_time, to_time=to_time)
+            results = self._query_studies(date_range.get_query())
+
+            if self._is_truncated(results):
+                if to_time > from_time:
+                    middle_time = (from_time + to_time) // 2
+                    time_ranges[0:0] = [(from_time, middle_time), (middle_time + 1, to_time)]
+                    continue
+
+                logger.error(f"Too many studies in a single request: {len(results)} in {date_range}, you'll probably miss some studies")
+                date_range.is_truncated = True
+
+            yield date_range, results
+
+        # the studies without StudyTime are not returned by the queries on StudyTime ranges
+        date_range = StudyDateRange(from_date=date, to_date=date, without_time=True)
+        results = self._query_studies(date_range.get_query())
+        if self._is_truncated(results):
+            logger.error(f"Too many studies in a single request: {len(results)} in {date_range}, you'll probably miss some studies")
+            date_range.is_truncated = True
+
+        yield date_range, results
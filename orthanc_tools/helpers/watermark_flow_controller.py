@@ -0,0 +1,109 @@
+import math
+import threading
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class WatermarkFlowController:
+    """
+    Limits the number of active workers according to the usage of a resource (i.e. the disk space used by an
+    intermediate Orthanc that is emptied by a forwarder).  The usage is sampled by a background thread every
+    `sampling_interval` seconds:
+    - below `low_watermark`, all the workers are active,
+    - above `high_watermark`, no worker is active,
+    - in between, the number of active workers decreases linearly such that the resource is kept busy without
+      being filled.
+
+    example:
+        controller = WatermarkFlowController(name="orthanc disk", get_usage=lambda: api_client.get_statistics().total_disk_size_mb,
+                                             low_watermark=8000, high_watermark=10000, max_active_count=4)
+        controller.start()
+        ...
+        controller.acquire()    # in each worker, blocks until the worker can be active
+        try:
+            transfer()
+        finally:
+            controller.release()
+        ...
+        controller.stop()
+    """
+
+    def __init__(self, name: str, get_usage: Callable[[], float], low_watermark: float, high_watermark: float,
+                 max_active_count: int, sampling_interval: float = 10):
+        """
+        :param name: the name of the resource (for logging)
+        :param get_usage: returns the current usage of the resource
+        :param low_watermark: the usage below which all the workers are active
+        :param high_watermark: the usage above which no worker is active
+        :param max_active_count: the number of workers
+        :param sampling_interval: the delay (in seconds) between two samples of the usage
+        """
+        if low_watermark >= high_watermark:
+            raise ValueError("The low watermark must be lower than the high watermark")
+
+        self._name = name
+        self._get_usage = get_usage
+        self._low_watermark = low_watermark
+        self._high_watermark = high_watermark
+        self._max_active_count = max_active_count
+        self._sampling_interval = sampling_interval
+
+        self._condition = threading.Condition()
+        self._active_count = max_active_count
+        self._in_flight_count = 0
+        self._is_stopping = threading.Event()
+        self._sampler_thread = None
+
+    @property
+    def active_count(self) -> int:
+        return self._active_count
+
+    def get_active_count(self, usage: float) -> int:
+        if usage <= self._low_watermark:
+            return self._max_active_count
+        if usage >= self._high_watermark:
+            return 0
+        return math.ceil(self._max_active_count * (self._high_watermark - usage) / (self._high_watermark - self._low_watermark))
+
+    def start(self):
+        self._is_stopping.clear()
+        self._sample()  # the first sample is taken before any worker becomes active
+        self._sampler_thread = threading.Thread(target=self._run_sampler, name=f"{self._name} sampler", daemon=True)
+        self._sampler_thread.start()
+
+    def stop(self):
+        self._is_stopping.set()
+        if self._sampler_thread is not None:
+            self._sampler_thread.join()
+            self._sampler_thread = None
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight_count >= self._active_count:
+                self._condition.wait()
+            self._in_flight_count += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight_count -= 1
+            self._condition.notify_all()
+
+    def _run_sampler(self):
+        while not self._is_stopping.wait(self._sampling_interval):
+            self._sample()
+
+    def _sample(self):
+        try:
+            usage = self._get_usage()
+        except Exception as ex:
+            logger.warning(f"{self._name}: could not sample the usage, keeping {self._active_count} active workers: {str(ex)}")
+            return
+
+        active_count = self.get_active_count(usage)
+        with self._condition:
+            if active_count != self._active_count:
+                logger.info(f"{self._name}: usage {usage:.0f} (watermarks: {self._low_watermark:.0f}-{self._high_watermark:.0f}), active workers {self._active_count} -> {active_count}")
+                self._active_count = active_count
+                self._condition.notify_all()
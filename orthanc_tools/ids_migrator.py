@@ -7,6 +7,7 @@ import datetime
 import multiprocessing
 from orthanc_api_client import helpers
 from .helpers.scheduler import Scheduler
+from .helpers.migration_journal import MigrationStatus
 from .dicom_migrator import DicomMigrator, Message
 import csv
 
@@ -16,6 +17,8 @@ logger = logging.getLogger(__name__)
 class IdsMigrator(DicomMigrator):
     """
     Uses the DicomMigrator to migrate a list of studies based on a csv file containing the UIDs.
+
+    With a `journal_path`, the studies that have already been migrated are skipped when the migration is restarted.
     """
 
     def __init__(self,
@@ -29,7 +32,12 @@ class IdsMigrator(DicomMigrator):
                  scheduler: Scheduler = None,
                  worker_threads_count: int = multiprocessing.cpu_count() - 1,  # by default, use all CPUs but one for compression
                  exit_on_error: bool = False,
-                 use_get_not_move: bool = False
+                 use_get_not_move: bool = False,
+                 journal_path: str = None,              # path to a SQLite file recording the outcome of each study (to resume an interrupted migration)
+                 retry_failed_only: bool = False,       # only retry the studies that have failed according to the journal
+                 skip_existing_studies: bool = False,   # check by batches which studies are already complete at the destination and skip them
+                 destination_query_modality: str = None,  # alias of the destination modality (in this Orthanc config) to query when skip_existing_studies is enabled and the destination is a destination_aet
+                 series_expansion_threshold: int = None  # the studies with more instances are transferred series by series by all the workers
                  ):
 
         super().__init__(
@@ -42,7 +50,12 @@ class IdsMigrator(DicomMigrator):
             scheduler=scheduler,
             worker_threads_count=worker_threads_count,
             exit_on_error=exit_on_error,
-            use_get_not_move=use_get_not_move
+            use_get_not_move=use_get_not_move,
+            journal_path=journal_path,
+            retry_failed_only=retry_failed_only,
+            skip_existing_studies=skip_existing_studies,
+            destination_query_modality=destination_query_modality,
+            series_expansion_threshold=series_expansion_threshold
         )
 
         self._ids_list_file_path = ids_list_file_path
@@ -50,6 +63,13 @@ class IdsMigrator(DicomMigrator):
     def execute(self):
         super().execute()
 
+        if self._retry_failed_only:
+            self.push_journal_entries(MigrationStatus.FAILED)
+            self.stop_threads()
+            logger.info("--------------------------------------------------------------------")
+            logger.info("Retry of the failed studies completed")
+            return
+
         logger.info("Path of the file containing the ids of the studies to migrate: " + str(self._ids_list_file_path))
 
         # The input could be a simple text file, each line being an id but also the output of another script with more
@@ -60,9 +80,27 @@ class IdsMigrator(DicomMigrator):
             for line in reader:
                 ids_list.append(line[0])
 
-        for id in ids_list:
-            logger.info(f"Processing id {id}")
-            self.push_message(Message(dicom_id=id))
+        for i in range(0, len(ids_list), self._existing_studies_batch_size):
+            batch = ids_list[i:i + self._existing_studies_batch_size]
+
+            existing_studies = set()
+            source_instances_counts = {id: None for id in batch}
+            if self._skip_existing_studies:
+                try:
+                    # the instances counts of the batch are queried in the source too (and completed in source_instances_counts)
+                    existing_studies = set(self.get_existing_studies(source_instances_counts))
+                    logger.info(f"Skipping {len(existing_studies)} studies already at the destination")
+                except Exception as ex:
+                    logger.warning(f"Could not check the studies already at the destination, transferring all studies of the batch: {str(ex)}")
+
+            for id in batch:
+                if id in existing_studies:
+                    if self._journal:
+                        self._journal.set_done(id)
+                    continue
+
+                logger.info(f"Processing id {id}")
+                self.push_message(Message(dicom_id=id, instances_count=source_instances_counts.get(id)))
 
         self.stop_threads()
 
@@ -95,6 +133,11 @@ if __name__ == '__main__':
     parser.add_argument('--worker_threads_count', type=int, default=1, help='Worker threads count')
     parser.add_argument('--exit_on_error', default=False, action='store_true', help='if True, the script will exit in case of error')
     parser.add_argument('--use_get_not_move', default=False, action='store_true', help='use a C-Get in place of C-Move (only if destination is Orthanc)')
+    parser.add_argument('--journal_path', type=str, default=None, help='SQLite file recording the outcome of each study (to resume an interrupted migration)')
+    parser.add_argument('--skip_existing_studies', default=False, action='store_true', help='Skip the studies that are already complete at the destination (checked by batches)')
+    parser.add_argument('--destination_query_modality', type=str, default=None, help='Alias of the destination modality to query to skip the existing studies (if the destination is a destination_aet)')
+    parser.add_argument('--series_expansion_threshold', type=int, default=None, help='Studies with more instances are transferred series by series by all the workers')
+    parser.add_argument('--retry_failed_only', default=False, action='store_true', help='Only retry the studies that have failed according to the journal')
 
     Scheduler.add_parser_arguments(parser)
 
@@ -114,6 +157,22 @@ if __name__ == '__main__':
     else:
         use_get_not_move = args.use_get_not_move
 
+    journal_path = os.environ.get("JOURNAL_PATH", args.journal_path)
+    if os.environ.get("RETRY_FAILED_ONLY", None) is not None:
+        retry_failed_only = os.environ.get("RETRY_FAILED_ONLY") in ["true", "True"]
+    else:
+        retry_failed_only = args.retry_failed_only
+
+    destination_query_modality = os.environ.get("DESTINATION_QUERY_MODALITY", args.destination_query_modality)
+    if os.environ.get("SKIP_EXISTING_STUDIES", None) is not None:
+        skip_existing_studies = os.environ.get("SKIP_EXISTING_STUDIES") in ["true", "True"]
+    else:
+        skip_existing_studies = args.skip_existing_studies
+
+    series_expansion_threshold = os.environ.get("SERIES_EXPANSION_THRESHOLD", args.series_expansion_threshold)
+    if series_expansion_threshold is not None:
+        series_expansion_threshold = int(series_expansion_threshold)
+
     scheduler = Scheduler.create_from_args_and_env_var(args)
 
     if os.environ.get("DELETE_FROM_SOURCE", None) is not None:
@@ -136,7 +195,12 @@ if __name__ == '__main__':
         scheduler=scheduler,
         worker_threads_count=worker_threads_count,
         exit_on_error=exit_on_error,
-        use_get_not_move=use_get_not_move
+        use_get_not_move=use_get_not_move,
+        journal_path=journal_path,
+        retry_failed_only=retry_failed_only,
+        skip_existing_studies=skip_existing_studies,
+        destination_query_modality=destination_query_modality,
+        series_expansion_threshold=series_expansion_threshold
     )
 
     migrator.execute()
@@ -2,7 +2,12 @@ import os, time
 import logging
 import argparse
 import datetime
+import threading
+import concurrent.futures
+from typing import Callable, Dict, List, Union
 from .helpers.scheduler import Scheduler
+from .helpers.study_date_range_splitter import StudyDateRangeSplitter, StudyDateRange
+from .helpers.modality_query_cache import ModalityQueryCache
 from orthanc_api_client import helpers
 import logging
 from orthanc_api_client import OrthancApiClient
@@ -10,6 +15,21 @@ import schedule
 
 logger = logging.getLogger(__name__)
 
+
+def _group_by(items: List, get_key: Callable) -> Dict[str, List]:
+    # indexes the items by key (there might be multiple items with the same key)
+    groups = {}
+    for item in items:
+        groups.setdefault(get_key(item), []).append(item)
+    return groups
+
+
+def _is_identical(local_items_by_id: Dict[str, List], remote_items_by_id: Dict[str, List]) -> bool:
+    return local_items_by_id.keys() == remote_items_by_id.keys() \
+        and all(len(items) == 1 for items in local_items_by_id.values()) \
+        and all(len(items) == 1 for items in remote_items_by_id.values())
+
+
 class OrthancComparator:
 
     def __init__(self,
@@ -26,7 +46,14 @@ class OrthancComparator:
                  error_log_file_path: str = None,
                  days_to_compare: int = None,
                  execution_time: str = None,
-                 execution_day: str = None
+                 execution_day: str = None,
+                 date_workers_count: int = 1,           # the number of dates compared concurrently
+                 max_concurrent_queries: int = None,    # the maximum number of concurrent C-FIND to the modality (default: date_workers_count)
+                 max_cfind_study_count: int = None,     # Known maximum amount of studies retrievable from the modality at once (enables the date ranges queries)
+                 query_cache_path: str = None,          # path to a SQLite file to cache the C-FIND results (the modality is queried again only for recent dates or if the Orthanc content has changed)
+                 query_cache_ttl_ratio: float = 0.1,    # the time-to-live of the cached results relative to the age of the study date
+                 transfer_workers_count: int = 1,       # the number of batches of missing resources transferred/retrieved concurrently (in the background of the comparison)
+                 series_retrieve_threshold: float = 0.5 # above this ratio of missing instances, the whole series is retrieved at once
                  ):
 
         if level not in ["Study", "Series", "Instance"]:
@@ -52,7 +79,21 @@ class OrthancComparator:
         if self._days_to_compare is not None and self._execution_day is not None and self._execution_time is not None:
             self._periodic_mode_enabled = True
 
-        self._current_date = None
+        self._date_workers_count = date_workers_count
+        self._max_cfind_study_count = max_cfind_study_count
+        self._queries_semaphore = threading.Semaphore(max_concurrent_queries or date_workers_count)
+        self._error_log_lock = threading.Lock()
+
+        self._query_cache = None
+        if query_cache_path is not None:
+            self._query_cache = ModalityQueryCache(path=query_cache_path, ttl_ratio=query_cache_ttl_ratio)
+
+        self._series_retrieve_threshold = series_retrieve_threshold
+        self._transfer_workers_count = transfer_workers_count
+        self._transfers_executor = None     # created when the first transfer is scheduled and shut down once all transfers are completed
+        self._available_transfer_workers = threading.Semaphore(transfer_workers_count)
+        self._pending_transfers = []
+        self._pending_transfers_lock = threading.Lock()
 
     def execute(self):
 
@@ -75,42 +116,138 @@ class OrthancComparator:
             self._from_study_date = datetime.date.today() - datetime.timedelta(days=self._days_to_compare)
             self._to_study_date = datetime.date.today()
 
-        if self._from_study_date < self._to_study_date:
-            # ex 20220101 -> 20220131
-            inc_date = 1
-            to_date = self._to_study_date + datetime.timedelta(days=1)
+        # the date ranges are compared by a pool of workers; the load on the modality is limited by max_concurrent_queries
+        if self._max_cfind_study_count is None:
+            # one date at a time: each worker queries its own date
+            date_ranges = ((StudyDateRange(from_date=d, to_date=d), None) for d in self._iterate_dates())
         else:
-            # ex 20220131 -> 20220101
-            inc_date = -1
-            to_date = self._to_study_date - datetime.timedelta(days=1)
+            # the splitter needs the results of a query to choose the next date range -> it runs ahead of the workers
+            splitter = StudyDateRangeSplitter(query_studies=self._query_remote_studies, max_results_count=self._max_cfind_study_count)
+            date_ranges = splitter.iterate(self._from_study_date, self._to_study_date)
+
+        # the next date range is only submitted once a worker is available
+        available_workers = threading.Semaphore(self._date_workers_count)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._date_workers_count, thread_name_prefix="Comparator date worker") as executor:
+            futures = []
+            try:
+                for date_range, remote_studies in date_ranges:
+                    available_workers.acquire()
+                    future = executor.submit(self.compare_date_range, date_range, remote_studies)
+                    future.add_done_callback(lambda _: available_workers.release())
+                    futures.append(future)
+            except Exception as ex:
+                logger.error(f"ERROR: {str(ex)}")
+
+            for future in futures:
+                future.result()
+
+        self._wait_transfers_completed()
+
+    def _iterate_dates(self):
+        direction = 1 if self._from_study_date <= self._to_study_date else -1
+        for days in range(0, abs((self._to_study_date - self._from_study_date).days) + 1):
+            yield self._from_study_date + datetime.timedelta(days=days * direction)
+
+    def _query_modality(self, query: Callable):
+        with self._queries_semaphore:
+            return query()
+
+    @staticmethod
+    def _get_most_recent_date(date_query: Dict[str, str]) -> datetime.date:
+        return helpers.from_dicom_date(date_query['StudyDate'].split('-')[-1])
+
+    def _query_modality_with_cache(self, query_key: str, date_query: Dict[str, str], local_ids: List[str], query: Dict[str, str], query_function: Callable):
+        # the cached results are reused only if the date is old enough and if the Orthanc content has not changed
+        # since (note: the date ranges are more stable keys when querying one date at a time)
+        if self._query_cache is None or date_query is None:
+            return self._query_modality(lambda: query_function(query))
 
-        self._current_date = self._from_study_date
+        return self._query_cache.query(
+            query_key=query_key,
+            study_date=self._get_most_recent_date(date_query),
+            local_ids=local_ids,
+            query=query,
+            query_function=lambda q: self._query_modality(lambda: query_function(q)))
 
-        while self._current_date != to_date:
-            self.compare_date(self._current_date)
-            self._current_date += datetime.timedelta(days=inc_date)
-            time.sleep(1) # throttling
+    def _invalidate_cached_query(self, query_key: str):
+        # the results of a query are not reused as long as a difference has been found
+        if self._query_cache is not None:
+            self._query_cache.remove(query_key)
+
+    def _query_remote_studies(self, date_query: Dict[str, str], local_studies: List = None) -> List:
+        if self._scheduler:
+            self._scheduler.wait_right_time_to_run()
+
+        query = {
+            'PatientID': '',
+            'PatientName': '',
+            'StudyInstanceUID': '',
+            'StudyDescription': ''
+        }
+        query.update(date_query)
+
+        local_ids = []
+        if self._query_cache is not None:
+            if local_studies is None:
+                local_studies = self._api_client.studies.find(query=date_query)
+            local_ids = [s.dicom_id for s in local_studies]
+
+        return self._query_modality_with_cache(
+            query_key=f"studies:{'/'.join(date_query.values())}",
+            date_query=date_query,
+            local_ids=local_ids,
+            query=query,
+            query_function=lambda q: self._api_client.modalities.query_studies(from_modality=self._modality, query=q))
+
+    def _schedule_transfer(self, summary: str, resources_count: int, transfer: Callable):
+        # the missing resources are transferred/retrieved by batches in the background while the comparison goes on
+        def _transfer():
+            try:
+                transfer()
+                logger.warning(f"WARNING {summary}, transferred: {resources_count} resources")
+            except Exception as ex:
+                logger.error(f"ERROR {summary}, transferring/retrieving {resources_count} resources: {str(ex)}")
+
+        # the next transfer is only submitted once a worker is available (the comparison waits meanwhile)
+        self._available_transfer_workers.acquire()
+        with self._pending_transfers_lock:
+            if self._transfers_executor is None:
+                self._transfers_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._transfer_workers_count, thread_name_prefix="Comparator transfer worker")
+            future = self._transfers_executor.submit(_transfer)
+            future.add_done_callback(lambda _: self._available_transfer_workers.release())
+            self._pending_transfers = [f for f in self._pending_transfers if not f.done()] + [future]
+
+    def _wait_transfers_completed(self):
+        while True:
+            with self._pending_transfers_lock:
+                pending_transfers = self._pending_transfers
+                self._pending_transfers = []
+
+                if len(pending_transfers) == 0:
+                    if self._transfers_executor is not None:
+                        self._transfers_executor.shutdown(wait=False)   # all its transfers are completed
+                        self._transfers_executor = None
+                    return
+
+            for future in pending_transfers:
+                future.result()
 
     def compare_date(self, current_date: datetime.date):
+        self.compare_date_range(StudyDateRange(from_date=current_date, to_date=current_date))
+        self._wait_transfers_completed()
+
+    def compare_date_range(self, date_range: StudyDateRange, remote_studies: List = None):
         if self._scheduler:
             self._scheduler.wait_right_time_to_run()
 
+        current_date = str(date_range)
         try:
-            logger.info("Processing date {date}".format(date=str(current_date)))
+            logger.info("Processing date {date}".format(date=current_date))
 
-            local_studies = self._api_client.studies.find(
-                query={
-                    'StudyDate': helpers.to_dicom_date(current_date)
-                })
-            remote_studies = self._api_client.modalities.query_studies(
-                from_modality=self._modality,
-                query={
-                    'StudyDate': helpers.to_dicom_date(current_date),
-                    'PatientID': '',
-                    'PatientName': '',
-                    'StudyInstanceUID': '',
-                    'StudyDescription': ''
-                })
+            local_studies = self._api_client.studies.find(query=date_range.get_query())
+            if remote_studies is None:
+                remote_studies = self._query_remote_studies(date_range.get_query(), local_studies=local_studies)
 
             logger.info(f"{str(current_date)}")
             logger.info(f"=======================================")
@@ -119,35 +256,50 @@ class OrthancComparator:
             else:
                 logger.info(f"found {len(local_studies)} studies on both side")
 
+            local_studies_by_dicom_id = _group_by(local_studies, lambda s: s.dicom_id)
+            remote_studies_by_dicom_id = _group_by(remote_studies, lambda s: s.dicom_id)
+            if not _is_identical(local_studies_by_dicom_id, remote_studies_by_dicom_id):
+                self._invalidate_cached_query(f"studies:{current_date}")
+
+            studies_to_store = []
             for local_study in local_studies:
 
                 try:
-                    remote_match = [r for r in remote_studies if r.dicom_id == local_study.dicom_id]
+                    remote_match = remote_studies_by_dicom_id.get(local_study.dicom_id, [])
                     study_summary = f"{local_study.patient_main_dicom_tags.get('PatientID')} - {local_study.patient_main_dicom_tags.get('PatientName')} - {local_study.main_dicom_tags.get('StudyDescription')}"
 
                     if len(remote_match) == 0 and not self._ignore_missing_on_modality:
                         logger.warning(f"WARNING {str(current_date)}, study missing on modality: {study_summary}")
                         if self._transfer_missing_to_modality:
                             logger.warning(f"WARNING {str(current_date)}, transferring study to modality: {study_summary}")
-                            self.store_resource(target_modality=self._modality, orthanc_id=local_study.orthanc_id)
+                            studies_to_store.append(local_study.orthanc_id)
                     elif len(remote_match) > 1:
                         logger.warning(f"WARNING {str(current_date)}, study found multiple times on modality: {study_summary}")
                     elif len(remote_match) == 1:
                         if self._level in ['Series', 'Instance']:
-                            self.compare_study(orthanc_id=local_study.orthanc_id, dicom_id=local_study.dicom_id, study_summary=study_summary)
+                            self.compare_study(orthanc_id=local_study.orthanc_id, dicom_id=local_study.dicom_id, study_summary=study_summary, date_range=date_range)
                 except Exception as ex:
                     logger.error(f"ERROR: {str(ex)}")
 
+            if len(studies_to_store) > 0:
+                self._schedule_transfer(
+                    summary=str(current_date),
+                    resources_count=len(studies_to_store),
+                    transfer=lambda: self.store_resource(target_modality=self._modality, orthanc_id=studies_to_store))
+
             if not self._ignore_missing_from_orthanc:
                 for remote_study in remote_studies:
                     try:
 
-                        local_match = [l for l in local_studies if l.dicom_id == remote_study.dicom_id]
+                        local_match = local_studies_by_dicom_id.get(remote_study.dicom_id, [])
                         if len(local_match) == 0:
                             logger.warning(f"WARNING {str(current_date)}, study missing from Orthanc: {remote_study.tags.get('PatientID')} - {remote_study.tags.get('PatientName')} - {remote_study.tags.get('StudyDescription')}")
                             if self._retrieve_missing_from_orthanc:
                                 logger.warning(f"WARNING {str(current_date)}, retrieving missing study from Orthanc: {remote_study.tags.get('PatientID')} - {remote_study.tags.get('PatientName')} - {remote_study.tags.get('StudyDescription')}")
-                                self.move_resource(from_modality=self._modality, dicom_id=remote_study.dicom_id)
+                                self._schedule_transfer(
+                                    summary=str(current_date),
+                                    resources_count=1,
+                                    transfer=lambda study_dicom_id=remote_study.dicom_id: self.move_resource(from_modality=self._modality, dicom_id=study_dicom_id, date_range=date_range))
                         elif len(local_match) > 1:
                             logger.warning(f"WARNING {str(current_date)}, study found multiple times on Orthanc: {remote_study.tags.get('PatientID')} - {remote_study.tags.get('PatientName')} - {remote_study.tags.get('StudyDescription')}")
                         # elif self._ignore_missing_on_modality: # in this case only, study comparison has not been performed above -> do it now
@@ -158,7 +310,7 @@ class OrthancComparator:
             logger.error(f"ERROR: {str(ex)}")
 
 
-    def compare_study(self, orthanc_id: str, dicom_id: str, study_summary: str):
+    def compare_study(self, orthanc_id: str, dicom_id: str, study_summary: str, date_range: StudyDateRange = None):
         if self._scheduler:
             self._scheduler.wait_right_time_to_run()
 
@@ -166,25 +318,34 @@ class OrthancComparator:
 
             local_series = self._api_client.get_json(f"studies/{orthanc_id}/series?expand")
 
-            remote_series = self._api_client.modalities.query_series(
-                from_modality=self._modality,
+            remote_series = self._query_modality_with_cache(
+                query_key=f"series:{dicom_id}",
+                date_query=date_range.get_query() if date_range is not None else None,
+                local_ids=[s.get('MainDicomTags').get('SeriesInstanceUID') for s in local_series],
                 query={
                     'StudyInstanceUID': dicom_id,
                     'SeriesInstanceUID': '',
                     'SeriesDescription': ''
-                })
+                },
+                query_function=lambda q: self._api_client.modalities.query_series(from_modality=self._modality, query=q))
 
             if len(local_series) != len(remote_series):
                 logger.warning(f"WARNING STUDY {study_summary}: {len(local_series)} series in Orthanc, {len(remote_series)} series in modality")
 
+            local_series_by_dicom_id = _group_by(local_series, lambda s: s.get('MainDicomTags').get('SeriesInstanceUID'))
+            remote_series_by_dicom_id = _group_by(remote_series, lambda s: s.dicom_id)
+            if not _is_identical(local_series_by_dicom_id, remote_series_by_dicom_id):
+                self._invalidate_cached_query(f"series:{dicom_id}")
+
+            series_to_store = []
             for local_serie in local_series:
                 local_dicom_id = local_serie.get('MainDicomTags').get('SeriesInstanceUID')
-                remote_match = [r for r in remote_series if r.dicom_id == local_dicom_id]
+                remote_match = remote_series_by_dicom_id.get(local_dicom_id, [])
                 if len(remote_match) == 0 and not self._ignore_missing_on_modality:
                     logger.warning(f"WARNING STUDY {study_summary}, series missing from modality: {local_dicom_id}")
                     if self._transfer_missing_to_modality:
                         logger.warning(f"WARNING STUDY {study_summary}, transferring series to modality: {local_dicom_id}")
-                        self.store_resource(target_modality=self._modality, orthanc_id=local_serie.get('ID'))
+                        series_to_store.append(local_serie.get('ID'))
                 elif len(remote_match) > 1:
                     logger.warning(f"WARNING STUDY {study_summary}, series found multiple times on modality: {local_dicom_id}")
                 elif len(remote_match) == 1:
@@ -194,90 +355,120 @@ class OrthancComparator:
                             orthanc_id=local_serie.get('ID'),
                             dicom_id=local_dicom_id,
                             study_dicom_id=dicom_id,
-                            series_summary=series_summary)
+                            series_summary=series_summary,
+                            date_range=date_range)
+
+            if len(series_to_store) > 0:
+                self._schedule_transfer(
+                    summary=f"STUDY {study_summary}",
+                    resources_count=len(series_to_store),
+                    transfer=lambda: self.store_resource(target_modality=self._modality, orthanc_id=series_to_store))
 
             if not self._ignore_missing_from_orthanc:
                 for remote_serie in remote_series:
-                    local_match = [l for l in local_series if l.get('MainDicomTags').get('SeriesInstanceUID') == remote_serie.dicom_id]
+                    local_match = local_series_by_dicom_id.get(remote_serie.dicom_id, [])
                     if len(local_match) == 0:
                         logger.warning(f"WARNING STUDY {dicom_id}, series missing from Orthanc: {remote_serie.dicom_id}")
                         if self._retrieve_missing_from_orthanc:
                             logger.warning(f"WARNING STUDY {dicom_id}, retrieving missing series from Orthanc: {remote_serie.dicom_id}")
-                            self.move_resource(
-                                from_modality=self._modality,
-                                dicom_id=remote_serie.dicom_id,
-                                study_dicom_id=dicom_id
-                            )
+                            self._schedule_transfer(
+                                summary=f"STUDY {dicom_id}",
+                                resources_count=1,
+                                transfer=lambda series_dicom_id=remote_serie.dicom_id: self.move_resource(
+                                    from_modality=self._modality,
+                                    dicom_id=series_dicom_id,
+                                    study_dicom_id=dicom_id,
+                                    date_range=date_range
+                                ))
                     elif len(local_match) > 1:
                         logger.warning(f"WARNING STUDY {dicom_id}, series found multiple times on Orthanc: {remote_serie.dicom_id}")
         except Exception as ex:
             logger.exception(f"ERROR: {str(ex)}")
 
 
-    def compare_series(self, orthanc_id: str, dicom_id: str, study_dicom_id: str, series_summary: str):
+    def compare_series(self, orthanc_id: str, dicom_id: str, study_dicom_id: str, series_summary: str, date_range: StudyDateRange = None):
 
         try:
             local_instances = self._api_client.get_json(f"series/{orthanc_id}/instances?expand")
 
-            remote_instances = self._api_client.modalities.query_instances(
-                from_modality=self._modality,
+            remote_instances = self._query_modality_with_cache(
+                query_key=f"instances:{dicom_id}",
+                date_query=date_range.get_query() if date_range is not None else None,
+                local_ids=[i.get('MainDicomTags').get('SOPInstanceUID') for i in local_instances],
                 query={
                     'SeriesInstanceUID': dicom_id,
                     'SOPInstanceUID': ''
-                })
+                },
+                query_function=lambda q: self._api_client.modalities.query_instances(from_modality=self._modality, query=q))
 
             if len(local_instances) != len(remote_instances):
                 logger.warning(f"WARNING SERIES {series_summary}: {len(local_instances)} instances in Orthanc, {len(remote_instances)} instances in modality")
 
-            success_count = 0
-            failure_count = 0
+            local_instances_by_dicom_id = _group_by(local_instances, lambda i: i.get('MainDicomTags').get('SOPInstanceUID'))
+            remote_instances_by_dicom_id = _group_by(remote_instances, lambda i: i.dicom_id)
+            if not _is_identical(local_instances_by_dicom_id, remote_instances_by_dicom_id):
+                self._invalidate_cached_query(f"instances:{dicom_id}")
 
+            instances_to_store = []
             for local_instance in local_instances:
-                try:
-                    local_dicom_id = local_instance.get('MainDicomTags').get('SOPInstanceUID')
-                    remote_match = [r for r in remote_instances if r.dicom_id == local_dicom_id]
+                local_dicom_id = local_instance.get('MainDicomTags').get('SOPInstanceUID')
+                remote_match = remote_instances_by_dicom_id.get(local_dicom_id, [])
 
-                    if len(remote_match) == 0 and not self._ignore_missing_on_modality:
-                        logger.warning(f"WARNING SERIES {series_summary}, instance missing from modality: {local_dicom_id}")
-                        if self._transfer_missing_to_modality:
-                            logger.warning(f"WARNING SERIES {series_summary}, transferring instance to modality: {local_dicom_id}")
-                            self.store_resource(target_modality=self._modality, orthanc_id=local_instance.get('ID'))
-                            success_count += 1
-                    elif len(remote_match) > 1:
-                        logger.warning(f"WARNING SERIES {series_summary}, instance found multiple times on modality: {local_dicom_id}")
-                except:
-                    failure_count += 1
+                if len(remote_match) == 0 and not self._ignore_missing_on_modality:
+                    logger.warning(f"WARNING SERIES {series_summary}, instance missing from modality: {local_dicom_id}")
+                    if self._transfer_missing_to_modality:
+                        logger.warning(f"WARNING SERIES {series_summary}, transferring instance to modality: {local_dicom_id}")
+                        instances_to_store.append(local_instance.get('ID'))
+                elif len(remote_match) > 1:
+                    logger.warning(f"WARNING SERIES {series_summary}, instance found multiple times on modality: {local_dicom_id}")
+
+            if len(instances_to_store) > 0:
+                self._schedule_transfer(
+                    summary=f"SERIES {series_summary}",
+                    resources_count=len(instances_to_store),
+                    transfer=lambda: self.store_resource(target_modality=self._modality, orthanc_id=instances_to_store))
 
             if not self._ignore_missing_from_orthanc:
+                instances_to_retrieve = []
                 for remote_instance in remote_instances:
-                    try:
-                        local_match = [l for l in local_instances if l.get('MainDicomTags').get('SOPInstanceUID') == remote_instance.dicom_id]
-                        if len(local_match) == 0:
-                            logger.warning(f"WARNING SERIES {series_summary}, instance missing from Orthanc: {remote_instance.dicom_id}")
-                            if self._retrieve_missing_from_orthanc:
-                                logger.warning(f"WARNING SERIES {series_summary}, retrieving instance missing from Orthanc: {remote_instance.dicom_id}")
-                                self.move_resource(
-                                    from_modality=self._modality,
-                                    dicom_id=remote_instance.dicom_id,
-                                    series_dicom_id=dicom_id,
-                                    study_dicom_id=study_dicom_id
-                                )
-                                success_count += 1
-                        elif len(local_match) > 1:
-                            logger.warning(f"WARNING SERIES {series_summary}, instance found multiple times on Orthanc: {remote_instance.dicom_id}")
-                    except Exception as ex:
-                        failure_count += 1
-
-            if failure_count > 0:
-                logger.error(f"ERROR SERIES {series_summary}, transferring/retrieving instances: {failure_count} failure, {success_count} success")
-            elif success_count > 0:
-                logger.warning(f"WARNING SERIES {series_summary}, transferred: {success_count} instances")
+                    local_match = local_instances_by_dicom_id.get(remote_instance.dicom_id, [])
+                    if len(local_match) == 0:
+                        logger.warning(f"WARNING SERIES {series_summary}, instance missing from Orthanc: {remote_instance.dicom_id}")
+                        if self._retrieve_missing_from_orthanc:
+                            logger.warning(f"WARNING SERIES {series_summary}, retrieving instance missing from Orthanc: {remote_instance.dicom_id}")
+                            instances_to_retrieve.append(remote_instance.dicom_id)
+                    elif len(local_match) > 1:
+                        logger.warning(f"WARNING SERIES {series_summary}, instance found multiple times on Orthanc: {remote_instance.dicom_id}")
+
+                if len(instances_to_retrieve) > 0:
+                    if len(instances_to_retrieve) > self._series_retrieve_threshold * len(remote_instances):
+                        # a single C-MOVE for the whole series instead of one per instance
+                        self._schedule_transfer(
+                            summary=f"SERIES {series_summary}",
+                            resources_count=len(instances_to_retrieve),
+                            transfer=lambda: self.move_resource(
+                                from_modality=self._modality,
+                                dicom_id=dicom_id,
+                                study_dicom_id=study_dicom_id,
+                                date_range=date_range
+                            ))
+                    else:
+                        self._schedule_transfer(
+                            summary=f"SERIES {series_summary}",
+                            resources_count=len(instances_to_retrieve),
+                            transfer=lambda: self.move_instances(
+                                from_modality=self._modality,
+                                dicom_ids=instances_to_retrieve,
+                                series_dicom_id=dicom_id,
+                                study_dicom_id=study_dicom_id,
+                                date_range=date_range
+                            ))
 
         except Exception as ex:
             logger.error(f"ERROR: {str(ex)}")
 
 
-    def move_resource(self, from_modality, dicom_id, study_dicom_id = None, series_dicom_id = None):
+    def move_resource(self, from_modality, dicom_id, study_dicom_id = None, series_dicom_id = None, date_range: StudyDateRange = None):
         retry_count = 0
         while retry_count < 5:
             level = None
@@ -305,12 +496,12 @@ class OrthancComparator:
                     #     dicom_id=dicom_id
                     # )
                     level = 'study'
-                    remote_series = self._api_client.modalities.query_series(
+                    remote_series = self._query_modality(lambda: self._api_client.modalities.query_series(
                         from_modality=from_modality,
                         query={
                             'StudyInstanceUID': dicom_id,
                             'SeriesInstanceUID': ''
-                        })
+                        }))
                     for series in remote_series:
                         # self.move_resource(from_modality=from_modality, dicom_id=series.dicom_id, study_dicom_id=dicom_id)
                         self._api_client.modalities.move_series(
@@ -327,18 +518,54 @@ class OrthancComparator:
                         self.log_error_in_file(
                             file_path=self._error_log_file_path,
                             id=dicom_id,
-                            date=helpers.to_dicom_date(self._current_date),
+                            date=date_range.get_query()['StudyDate'] if date_range is not None else '',
                             level=level
                         )
                     raise ex
                 else:
                     logger.warning(f"Error while transferring, retrying... {dicom_id} {str(ex)}")
 
-    def store_resource(self, target_modality, orthanc_id):
+    def move_instances(self, from_modality, dicom_ids: List[str], series_dicom_id: str, study_dicom_id: str, date_range: StudyDateRange = None):
+        # a single move job for all the instances of the list
+        retry_count = 0
+        while retry_count < 5:
+            try:
+                logger.info(f"C-Move {len(dicom_ids)} instances from source {from_modality} to Orthanc...")
+                self._api_client.post(
+                    endpoint=f"modalities/{from_modality}/move",
+                    json={
+                        'Level': 'Instance',
+                        'Resources': [{
+                            'StudyInstanceUID': study_dicom_id,
+                            'SeriesInstanceUID': series_dicom_id,
+                            'SOPInstanceUID': dicom_id
+                        } for dicom_id in dicom_ids],
+                        'Asynchronous': False
+                    })
+                break
+            except Exception as ex:
+                retry_count += 1
+                if retry_count == 5:
+                    logger.error(f"Error (retried 5 times) while transferring {len(dicom_ids)} instances from series {series_dicom_id} {str(ex)}")
+                    if self._error_log_file_path is not None:
+                        for dicom_id in dicom_ids:
+                            self.log_error_in_file(
+                                file_path=self._error_log_file_path,
+                                id=dicom_id,
+                                date=date_range.get_query()['StudyDate'] if date_range is not None else '',
+                                level='instance'
+                            )
+                    raise ex
+                else:
+                    logger.warning(f"Error while transferring, retrying... {len(dicom_ids)} instances from series {series_dicom_id} {str(ex)}")
+
+    def store_resource(self, target_modality, orthanc_id: Union[str, List[str]]):
+        # a batch of resources is logged by its size only
+        resources_summary = f"{len(orthanc_id)} resources" if isinstance(orthanc_id, list) else f"resource {orthanc_id}"
         retry_count = 0
         while retry_count < 5:
             try:
-                logger.info(f"C-Store resource {orthanc_id} to remote modality {target_modality}...")
+                logger.info(f"C-Store {resources_summary} to remote modality {target_modality}...")
                 self._api_client.modalities.send(
                     target_modality=target_modality,
                     resources_ids=orthanc_id
@@ -347,15 +574,16 @@ class OrthancComparator:
             except Exception as ex:
                 retry_count += 1
                 if retry_count == 5:
-                    logger.error(f"Error (retried 5 times) while storing {orthanc_id} {str(ex)}")
+                    logger.error(f"Error (retried 5 times) while storing {resources_summary} {str(ex)}")
                     raise ex
                 else:
-                    logger.warning(f"Error while storing, retrying... {orthanc_id} {str(ex)}")
+                    logger.warning(f"Error while storing, retrying... {resources_summary} {str(ex)}")
 
     def log_error_in_file(self, file_path, id, date, level):
-        with open(file_path, "a") as f:
-            f.write(f"{id},{date},{level}")
-            f.write('\n')
+        with self._error_log_lock:
+            with open(file_path, "a") as f:
+                f.write(f"{id},{date},{level}")
+                f.write('\n')
 
 
 if __name__ == '__main__':
@@ -382,6 +610,13 @@ if __name__ == '__main__':
     parser.add_argument('--ignore_missing_on_modality', default=False, action='store_true', help="Don't generate a warning if resources are missing on the remote modality")
     # TODO parser.add_argument('--retrieve_missing_in_orthanc', default=False, action='store_true', help='Retrieve missing resources from remote modality into Orthanc')
     parser.add_argument('--error_log_file_path', type=str, default='/errors.log', help='Path to the file to write errors log')
+    parser.add_argument('--date_workers_count', type=int, default=1, help='Number of dates compared concurrently')
+    parser.add_argument('--max_concurrent_queries', type=int, default=None, help='Maximum number of concurrent C-FIND to the modality (default: date_workers_count)')
+    parser.add_argument('--max_cfind_study_count', type=int, default=None, help='Known maximum amount of studies retrievable from the modality at once (enables querying by date ranges)')
+    parser.add_argument('--query_cache_path', type=str, default=None, help='Path to a SQLite file to cache the C-FIND results of the old dates')
+    parser.add_argument('--query_cache_ttl_ratio', type=float, default=0.1, help='Time-to-live of the cached C-FIND results relative to the age of the study date')
+    parser.add_argument('--transfer_workers_count', type=int, default=1, help='Number of batches of missing resources transferred/retrieved concurrently')
+    parser.add_argument('--series_retrieve_threshold', type=float, default=0.5, help='Ratio of missing instances above which the whole series is retrieved at once')
     parser.add_argument('--days_to_compare', type=int, default=None, help='Enables periodic mode. This is the number of days to compare. The range will start at current day and will end x days before.')
     parser.add_argument('--execution_time', type=str, default=None,
                         help='Enables periodic mode. The time when the periodic run will start (format: 23:30 or 23:30:14).')
@@ -409,14 +644,26 @@ if __name__ == '__main__':
         days_to_compare = int(days_to_compare)
     execution_time = os.environ.get("EXECUTION_TIME", args.execution_time)
     execution_day = os.environ.get("EXECUTION_DAY", args.execution_day)
+    date_workers_count = int(os.environ.get("DATE_WORKERS_COUNT", str(args.date_workers_count)))
+    max_concurrent_queries = os.environ.get("MAX_CONCURRENT_QUERIES", args.max_concurrent_queries)
+    if max_concurrent_queries is not None:
+        max_concurrent_queries = int(max_concurrent_queries)
+    max_cfind_study_count = os.environ.get("MAX_CFIND_STUDY_COUNT", args.max_cfind_study_count)
+    if max_cfind_study_count is not None:
+        max_cfind_study_count = int(max_cfind_study_count)
+    query_cache_path = os.environ.get("QUERY_CACHE_PATH", args.query_cache_path)
+    query_cache_ttl_ratio = float(os.environ.get("QUERY_CACHE_TTL_RATIO", str(args.query_cache_ttl_ratio)))
+    transfer_workers_count = int(os.environ.get("TRANSFER_WORKERS_COUNT", str(args.transfer_workers_count)))
+    series_retrieve_threshold = float(os.environ.get("SERIES_RETRIEVE_THRESHOLD", str(args.series_retrieve_threshold)))
 
     scheduler = Scheduler.create_from_args_and_env_var(args)
 
+    # the date workers and the transfer workers share the same client
     api_client = None
     if api_key is not None:
-        api_client=OrthancApiClient(url, headers={"api-key":api_key})
+        api_client=OrthancApiClient(url, headers={"api-key":api_key}, pool_maxsize=max(10, date_workers_count + transfer_workers_count), pool_block=True)
     else:
-        api_client=OrthancApiClient(url, user=user, pwd=password)
+        api_client=OrthancApiClient(url, user=user, pwd=password, pool_maxsize=max(10, date_workers_count + transfer_workers_count), pool_block=True)
 
     comparator = OrthancComparator(
         api_client=api_client,
@@ -432,7 +679,14 @@ if __name__ == '__main__':
         error_log_file_path=error_log_file_path,
         days_to_compare = days_to_compare,
         execution_time = execution_time,
-        execution_day = execution_day
+        execution_day = execution_day,
+        date_workers_count = date_workers_count,
+        max_concurrent_queries = max_concurrent_queries,
+        max_cfind_study_count = max_cfind_study_count,
+        query_cache_path = query_cache_path,
+        query_cache_ttl_ratio = query_cache_ttl_ratio,
+        transfer_workers_count = transfer_workers_count,
+        series_retrieve_threshold = series_retrieve_threshold
     )
 
     comparator.execute()
@@ -5,12 +5,20 @@ import time
 import os
 import threading
 import queue
+import heapq
+import io
+import zipfile
+import concurrent.futures
+import multiprocessing
 from strenum import StrEnum
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from orthanc_api_client import OrthancApiClient, InstancesSet, ResourceType, exceptions
 from .orthanc_monitor import ChangeType
+from .helpers.circuit_breaker import CircuitBreaker
+from .helpers.timer import Timer
+from .helpers.bulk_deleter import BulkDeleter
 
 logger = logging.getLogger(__name__)
 
@@ -27,12 +35,51 @@ class ForwarderMode(StrEnum):
 class ForwarderDestination:
     destination: str                        # the alias of the destination Modality, Peer or DicomWeb server
     forwarder_mode: ForwarderMode           # the mode to use to forward to the destination
-    alternate_destination: str = None       # an alternate destination in case this one can not be contacted
+    alternate_destination: str = None       # the alias of an alternate destination (using the same forwarder_mode) in case this one can not be contacted
+    job_priority: int = 0                   # the priority of the Orthanc jobs sending to this destination (only with use_async_jobs)
 
 @dataclass
 class ResourceToForward:
     type: str
     resource_id: str
+    priority: Optional[int] = None          # the priority class of the resource (only when a scheduling policy is configured)
+    queued_at: Optional[float] = None       # the time at which the resource has been seen for the first time
+
+
+@dataclass
+class ForwarderPriorityRule:
+    priority: int                           # the priority class of the matching resources (the lower, the more urgent)
+    tag: str = None                         # a DICOM tag (e.g. 'ModalitiesInStudy', 'StationName', 'Modality') ...
+    value: str = None                       # ... and the value it must contain to match the rule
+    label: str = None                       # or an Orthanc label the resource must have to match the rule
+
+    def matches(self, tags: Dict[str, str], labels: List[str]) -> bool:
+        if self.label is not None and self.label not in labels:
+            return False
+        if self.tag is not None:
+            # multi-valued tags like ModalitiesInStudy are backslash separated
+            if self.value not in (tags.get(self.tag) or "").split("\\"):
+                return False
+        return True
+
+
+@dataclass
+class ScheduledResource:
+    priority: int                           # the priority class obtained from the rules
+    size: int                               # the disk size of the resource (used for shortest-job-first)
+    first_seen: float                       # the time at which the resource has been seen for the first time
+    wait_recorded: bool = False             # True once the queue wait time has been recorded in the statistics
+
+
+@dataclass
+class QueueWaitStatistics:
+    count: int = 0
+    total_wait: float = 0
+    max_wait: float = 0
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.count if self.count > 0 else 0
 
 # class ForwarderMetadata(Enum):
 #     INSTANCE_PROCESSED = 4600
@@ -46,6 +93,16 @@ class ForwarderInstancesSetStatus:
     sent_to_destinations: List[str] = field(default_factory=list)
     retry_count: int = field(init=False, default=0)
     next_retry: Optional[datetime.datetime] = None
+    pending_jobs: Dict[str, str] = field(default_factory=dict)     # the ids of the jobs that are still running -> the destination they are sending to
+    forwarding: bool = field(init=False, default=False)             # True while a worker thread is submitting the transfers
+
+
+@dataclass
+class ForwarderPendingJob:
+    job_id: str
+    instances_set: InstancesSet
+    destination: str                        # the destination as configured in the Forwarder
+    target: str                             # the destination actually used (might be the alternate_destination)
 
 
 class OrthancForwarder:
@@ -58,6 +115,11 @@ class OrthancForwarder:
     - or override process() in a subclass
     The modifications shall be idempotent:  it shall always give the same result if you repeat the modification multiple times
 
+    When the processing is CPU bound (e.g. re-encoding the pixel data with pydicom), the callbacks running in the forwarder
+    threads are serialized by the GIL.  In that case, you should rather provide an instance_file_processor and/or an
+    instance_file_filter: they are run in a pool of processes on the downloaded DICOM files and the modified files are
+    re-uploaded in batches (as zip files).  These callbacks must be picklable (i.e. defined at the top level of a module).
+
     The images may be filtered out before being processed and forwarded.  In that case, you should:
     - either provide an instance_filter callback
     - or override filter() in a subclass
@@ -74,11 +136,32 @@ class OrthancForwarder:
     -> it will send to A and B
 
     You might also define alternate destinations that will be used when the primary destination is unreachable.
-    i.e: destinations = [Destination(A, PEER, alternateDestination = Destination(B, DICOM))]
+    i.e: destinations = [Destination(A, PEER, alternate_destination = B)]
     -> it will try to send to A and, if A is down, will send to B
 
+    Each destination is protected by a circuit breaker: after a few consecutive failures (or too slow transfers), the
+    destination is considered as down and is not contacted anymore (the data is sent to the alternate destination or
+    kept for a later retry) until a cheap probe (a DICOM echo or a call to the remote Orthanc /system route) succeeds.
+
     If the forwarding fails, the Forwarder will retry to send the instances later on.
 
+    By default, the studies/series are handled in the order they are listed by Orthanc.  You may define a scheduling policy:
+    - priority_rules assign a priority class to the resources based on their DICOM tags or labels
+      i.e: priority_rules = [ForwarderPriorityRule(priority=0, tag='ModalitiesInStudy', value='CR'), ForwarderPriorityRule(priority=1, label='URGENT')]
+      The resources that do not match any rule get the default_priority.
+    - shortest_job_first handles the smallest resources first within a priority class
+    - to avoid starvation, a resource gains one priority class every aging_interval_in_seconds while it is waiting
+    The time spent waiting in the queue is measured per priority class (see get_queue_wait_statistics()).
+
+    By default, the instances are deleted right after they have been forwarded.  On heavily loaded Orthancs, you may
+    set bulk_delete_batch_size to buffer the deletions and issue them in batches from a dedicated thread.  The instances
+    waiting for deletion are not forwarded again.
+
+    With use_async_jobs, the DICOM and PEERING transfers are submitted as asynchronous Orthanc jobs (with the job_priority
+    of the destination) and a single thread monitors them.  The worker threads are therefore not blocked during the
+    transfers and many studies can be in flight at the same time.  The callbacks are called once the jobs have completed.
+    Make sure the JobsHistorySize of your Orthanc is large enough to keep track of the completed jobs.
+
     The OrthancForwarder uses Orthanc metadata ranging between [4600, 4700[
     """
 
@@ -94,7 +177,22 @@ class OrthancForwarder:
                  instance_filter = None,                    # a method to filter instances.  Signature: Filter(api_client, instance_id) -> bool (returns True to keep an instance, returns False to delete it)
                  instance_processor = None,                 # a method to process instances before forwarding them.  Signature: Process(api_client, instance_id)
                  on_instances_set_forwarded = None,         # a method that is called each time an InstancesSet has been forwarded to a destination.  Signature: forwarded(instances_set, destination)
-                 on_instances_set_forward_error = None      # a method that is called each time an InstancesSet has failed to be forwarded to a destination.  Signature: forward_error(instances_set, destination, error)
+                 on_instances_set_forward_error = None,     # a method that is called each time an InstancesSet has failed to be forwarded to a destination.  Signature: forward_error(instances_set, destination, error)
+                 instance_file_filter = None,               # a method to filter instances, run in a process pool.  Signature: Filter(dicom_file: bytes) -> bool (returns True to keep an instance, returns False to delete it)
+                 instance_file_processor = None,            # a method to process instances before forwarding them, run in a process pool.  Signature: Process(dicom_file: bytes) -> bytes (returns the modified file)
+                 processes_count: int = None,               # number of processes used to run the instance_file_filter/instance_file_processor (default: number of CPUs)
+                 upload_batch_size: int = 50,               # number of instances downloaded, processed and re-uploaded together by the instance_file_processor
+                 circuit_breaker_failure_threshold: int = 2,        # number of consecutive failures after which a destination is considered as down
+                 circuit_breaker_max_latency: float = None,         # duration (in seconds per instance) above which a transfer is considered as a failure
+                 health_check_interval_in_seconds: float = 10,      # interval between two probes of a destination that is down
+                 priority_rules: List[ForwarderPriorityRule] = None,    # rules to assign a priority class to the studies/series (the first matching rule wins)
+                 default_priority: int = 10,                        # priority class of the resources that do not match any rule
+                 shortest_job_first: bool = False,                  # within a priority class, handle the smallest resources first
+                 aging_interval_in_seconds: float = 600,            # a waiting resource gains one priority class every aging_interval_in_seconds
+                 bulk_delete_batch_size: int = None,                # if set, the deletions are buffered and performed in batches of this size from a dedicated thread
+                 bulk_delete_interval_in_seconds: float = 5,        # the maximum delay before an incomplete batch of deletions is performed
+                 use_async_jobs: bool = False,                      # submit the DICOM and PEERING transfers as asynchronous jobs
+                 job_polling_interval_in_seconds: float = 1         # interval between two checks of the asynchronous jobs status
                  ):
 
         self._source = source
@@ -108,6 +206,45 @@ class OrthancForwarder:
         self._instance_processor = instance_processor
         self._on_instances_set_forwarded = on_instances_set_forwarded
         self._on_instances_set_forward_error = on_instances_set_forward_error
+        self._instance_file_filter = instance_file_filter
+        self._instance_file_processor = instance_file_processor
+        self._upload_batch_size = upload_batch_size
+        self._process_pool = None
+        if self._instance_file_filter or self._instance_file_processor:
+            # the processes are only started when the first job is submitted (from a worker thread): they are spawned
+            # instead of forked since forking a multithreaded process may deadlock the children
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes_count, mp_context=multiprocessing.get_context("spawn"))
+        self._circuit_breakers = {}
+        self._destinations_modes = {}
+        for dest in self._destinations:
+            for alias in [dest.destination, dest.alternate_destination]:
+                if alias is not None and alias not in self._circuit_breakers:
+                    self._circuit_breakers[alias] = CircuitBreaker(
+                        name=alias,
+                        failure_threshold=circuit_breaker_failure_threshold,
+                        max_latency=circuit_breaker_max_latency,
+                        probe_interval=health_check_interval_in_seconds
+                    )
+                    self._destinations_modes[alias] = dest.forwarder_mode
+        self._health_check_thread = None
+        self._health_checks_running = False
+        self._priority_rules = priority_rules or []
+        self._default_priority = default_priority
+        self._shortest_job_first = shortest_job_first
+        self._aging_interval_in_seconds = aging_interval_in_seconds
+        self._scheduled_resources = {}
+        self._scheduled_resources_lock = threading.Lock()   # the resources are read by the worker threads when recording the queue wait
+        self._queue_wait_statistics = {}
+        self._queue_wait_statistics_lock = threading.Lock()
+        self._use_async_jobs = use_async_jobs
+        self._job_polling_interval_in_seconds = job_polling_interval_in_seconds
+        self._pending_jobs = {}
+        self._pending_jobs_lock = threading.Lock()     # guards the pending jobs and the InstancesSets status (they are also updated by the job poller thread)
+        self._job_poller_thread = None
+        self._job_poller_running = False
+        self._bulk_deleter = None
+        if bulk_delete_batch_size:
+            self._bulk_deleter = BulkDeleter(api_client=source, batch_size=bulk_delete_batch_size, flush_interval=bulk_delete_interval_in_seconds)
         self._status = {}
         self._resources_to_process = queue.Queue(worker_threads_count + 1)
         self._worker_threads_count = worker_threads_count
@@ -128,12 +265,16 @@ class OrthancForwarder:
         if "OverwriteInstances" not in system:
             logger.warning("Unable to check OverwriteInstances configuration")
         elif not system["OverwriteInstances"]:
-            if self._instance_processor:
+            if self._instance_processor or self._instance_file_processor:
                 logger.error("Orthanc Forwarder: when providing an instance_processor, you should have OverwriteInstances set to true to replace the instance with the new one")
                 raise Exception("Invalid Orthanc configuration: OverwriteInstances is false")
 
     def execute(self):  # runs forever !
         self.wait_orthanc_started()
+        self._start_health_checks()
+        self._start_job_poller()
+        if self._bulk_deleter:
+            self._bulk_deleter.start()
 
         while True:
             self.handle_all_content()
@@ -150,6 +291,9 @@ class OrthancForwarder:
                     self._resources_to_process.task_done()
                     break
 
+                if resource.queued_at is not None:
+                    self._record_queue_wait(resource)
+
                 if resource.type == "study":
                     self._handle_study(study_id=resource.resource_id,
                                        api_client=self._source)
@@ -182,41 +326,160 @@ class OrthancForwarder:
         for wt in self._worker_threads:
             wt.start()
 
-        if self._trigger == ChangeType.STABLE_STUDY:
-            studies_ids = self._source.studies.get_all_ids()
-            if len(studies_ids) > 0:
-                for study_id in studies_ids:
-                    self._resources_to_process.put(ResourceToForward(type="study", resource_id=study_id))
-            else:
-                logger.debug("No studies found in Orthanc")
+        try:
+            if self.is_scheduling_enabled and self._trigger in [ChangeType.STABLE_STUDY, ChangeType.STABLE_SERIES]:
+                self._enqueue_scheduled_resources()
 
-        elif self._trigger == ChangeType.STABLE_SERIES:
-            series_ids = self._source.series.get_all_ids()
-            if len(series_ids) > 0:
-                for series_id in series_ids:
-                    self._resources_to_process.put(ResourceToForward(type="series", resource_id=series_id))
-            else:
-                logger.debug("No series found in Orthanc")
+            elif self._trigger == ChangeType.STABLE_STUDY:
+                studies_ids = self._source.studies.get_all_ids()
+                if len(studies_ids) > 0:
+                    for study_id in studies_ids:
+                        self._resources_to_process.put(ResourceToForward(type="study", resource_id=study_id))
+                else:
+                    logger.debug("No studies found in Orthanc")
 
-        elif self._trigger == ChangeType.NEW_INSTANCE:
-            instances_ids = self._source.instances.get_all_ids()
-            if len(instances_ids) > 0:
-                for instance_id in instances_ids:
-                    self._resources_to_process.put(ResourceToForward(type="instance", resource_id=instance_id))
+            elif self._trigger == ChangeType.STABLE_SERIES:
+                series_ids = self._source.series.get_all_ids()
+                if len(series_ids) > 0:
+                    for series_id in series_ids:
+                        self._resources_to_process.put(ResourceToForward(type="series", resource_id=series_id))
+                else:
+                    logger.debug("No series found in Orthanc")
+
+            elif self._trigger == ChangeType.NEW_INSTANCE:
+                instances_ids = self._source.instances.get_all_ids()
+                if len(instances_ids) > 0:
+                    for instance_id in instances_ids:
+                        self._resources_to_process.put(ResourceToForward(type="instance", resource_id=instance_id))
+                else:
+                    logger.debug("No instances found in Orthanc")
             else:
-                logger.debug("No instances found in Orthanc")
-        else:
-            raise NotImplementedError()
+                raise NotImplementedError()
 
-        # post one 'empty' exit message per thread to unlock the threads from waiting on the process queue
-        for i in range(0, self._worker_threads_count):
-            self._resources_to_process.put(None)
+        finally:
+            # post one 'empty' exit message per thread to unlock the threads from waiting on the process queue
+            # (even if listing the resources has failed, otherwise the workers would wait forever)
+            for i in range(0, self._worker_threads_count):
+                self._resources_to_process.put(None)
 
-        for t in self._worker_threads:
-            t.join()
+            for t in self._worker_threads:
+                t.join()
+
+            self._worker_threads = []
 
-        self._worker_threads = []
 
+    @property
+    def is_scheduling_enabled(self) -> bool:
+        return len(self._priority_rules) > 0 or self._shortest_job_first
+
+    def _get_resources_ids(self, resource_type: str) -> List[str]:
+        if resource_type == "study":
+            return self._source.studies.get_all_ids()
+        else:
+            return self._source.series.get_all_ids()
+
+    def _get_scheduled_resource(self, resource_type: str, resource_id: str) -> ScheduledResource:
+        # the priority and size of a resource are evaluated only once, when it is seen for the first time
+        with self._scheduled_resources_lock:
+            scheduled = self._scheduled_resources.get(resource_id)
+
+        if scheduled is None:
+            url_segment = "studies" if resource_type == "study" else "series"
+            priority = self._default_priority
+
+            if len(self._priority_rules) > 0:
+                requested_tags = [r.tag for r in self._priority_rules if r.tag is not None]
+                resource = self._source.get_json(f"{url_segment}/{resource_id}", params={"requestedTags": ";".join(requested_tags)} if requested_tags else None)
+                tags = dict(resource.get("MainDicomTags", {}))
+                tags.update(resource.get("RequestedTags", {}))
+                for rule in self._priority_rules:
+                    if rule.matches(tags=tags, labels=resource.get("Labels", [])):
+                        priority = rule.priority
+                        break
+
+            size = 0
+            if self._shortest_job_first:
+                size = int(self._source.get_json(f"{url_segment}/{resource_id}/statistics").get("DiskSize", 0))
+
+            scheduled = ScheduledResource(priority=priority, size=size, first_seen=time.time())
+            with self._scheduled_resources_lock:
+                scheduled = self._scheduled_resources.setdefault(resource_id, scheduled)
+
+        return scheduled
+
+    def _get_scheduling_key(self, scheduled: ScheduledResource, now: float):
+        aged_priority = scheduled.priority - int((now - scheduled.first_seen) / self._aging_interval_in_seconds)
+        return aged_priority, scheduled.size if self._shortest_job_first else 0, scheduled.first_seen
+
+    def _enqueue_scheduled_resources(self):
+        resource_type = "study" if self._trigger == ChangeType.STABLE_STUDY else "series"
+        pending = {}            # resource id -> ScheduledResource
+        pending_heap = []       # (scheduling key, resource id), rebuilt at each refresh since the aging changes the keys
+        dispatched_ids = set()
+        last_refresh = None
+
+        while True:
+            # refresh the list of resources regularly such that an urgent study received meanwhile jumps ahead of the queue
+            if last_refresh is None or time.time() - last_refresh > self._polling_interval_in_seconds:
+                resources_ids = set(self._get_resources_ids(resource_type))
+                last_refresh = time.time()
+
+                # forget the resources that are not in Orthanc anymore
+                with self._scheduled_resources_lock:
+                    for resource_id in set(self._scheduled_resources.keys()) - resources_ids:
+                        del self._scheduled_resources[resource_id]
+                for resource_id in set(pending.keys()) - resources_ids:
+                    del pending[resource_id]
+
+                for resource_id in resources_ids - dispatched_ids - set(pending.keys()):
+                    try:
+                        pending[resource_id] = self._get_scheduled_resource(resource_type, resource_id)
+                    except exceptions.ResourceNotFound:
+                        pass  # deleted in the meantime
+
+                now = time.time()
+                pending_heap = [(self._get_scheduling_key(scheduled, now), resource_id) for resource_id, scheduled in pending.items()]
+                heapq.heapify(pending_heap)
+
+            if len(pending_heap) == 0:
+                if len(dispatched_ids) == 0:
+                    logger.debug(f"No {resource_type} found in Orthanc")
+                break
+
+            next_id = heapq.heappop(pending_heap)[1]
+            scheduled = pending.pop(next_id)
+            dispatched_ids.add(next_id)
+
+            self._resources_to_process.put(ResourceToForward(
+                type=resource_type,
+                resource_id=next_id,
+                priority=scheduled.priority,
+                queued_at=scheduled.first_seen
+            ))  # blocks while the workers are busy
+
+        self._log_queue_wait_statistics()
+
+    def _record_queue_wait(self, resource: ResourceToForward):
+        with self._scheduled_resources_lock:
+            scheduled = self._scheduled_resources.get(resource.resource_id)
+            if scheduled is None or scheduled.wait_recorded:
+                return  # only the first handling is relevant, not the retries
+            scheduled.wait_recorded = True
+
+        wait = time.time() - resource.queued_at
+        with self._queue_wait_statistics_lock:
+            statistics = self._queue_wait_statistics.setdefault(resource.priority, QueueWaitStatistics())
+            statistics.count += 1
+            statistics.total_wait += wait
+            statistics.max_wait = max(statistics.max_wait, wait)
+
+    def get_queue_wait_statistics(self) -> Dict[int, QueueWaitStatistics]:
+        with self._queue_wait_statistics_lock:
+            return {p: QueueWaitStatistics(count=s.count, total_wait=s.total_wait, max_wait=s.max_wait) for p, s in self._queue_wait_statistics.items()}
+
+    def _log_queue_wait_statistics(self):
+        for priority, statistics in sorted(self.get_queue_wait_statistics().items()):
+            logger.debug(f"Queue wait for priority {priority}: {statistics.count} resources, average {statistics.average_wait:.1f}s, max {statistics.max_wait:.1f}s")
 
     def _thread_execute(self):
         while self._is_running:
@@ -237,12 +500,24 @@ class OrthancForwarder:
         # start threads
         self._is_running = True
         self._execution_thread.start()
+        self._start_health_checks()
+        self._start_job_poller()
+        if self._bulk_deleter:
+            self._bulk_deleter.start()
 
     def stop(self):
         logger.info("Stopping Orthanc Forwarder")
 
         self._is_running = False
         self._execution_thread.join()
+        self._stop_health_checks()
+        self._stop_job_poller()
+
+        if self._bulk_deleter:
+            self._bulk_deleter.stop()
+
+        if self._process_pool:
+            self._process_pool.shutdown(wait=True)
 
     def __enter__(self):
         self.start()
@@ -269,18 +544,28 @@ class OrthancForwarder:
         if self._instance_filter:
             filtered = instances_set.filter_instances(self._instance_filter)
             logger.info(f"{instances_set} Deleting {len(filtered.instances_ids)} instances / {len(filtered.series_ids)} series that have been filtered out")
-            filtered.delete()
+            self._delete_instances(filtered)
+
+        if self._instance_file_filter:
+            instances_to_keep = self._filter_files_in_process_pool(instances_set.instances_ids)
+            filtered = instances_set.filter_instances(lambda api_client, instance_id: instances_to_keep[instance_id])
+            logger.info(f"{instances_set} Deleting {len(filtered.instances_ids)} instances / {len(filtered.series_ids)} series that have been filtered out")
+            self._delete_instances(filtered)
 
         return instances_set
 
     def process(self, instances_set: InstancesSet) -> bool:
         # this method can be overriden in a derived class.
 
-        if self._instance_processor:
+        if self._instance_processor or self._instance_file_processor:
             try:
                 logger.info(f"{instances_set} Processing ...")
 
-                instances_set.process_instances(self._instance_processor)
+                if self._instance_processor:
+                    instances_set.process_instances(self._instance_processor)
+
+                if self._instance_file_processor:
+                    self._process_files_in_process_pool(instances_set.instances_ids)
 
                 logger.info(f"{instances_set} Processing ... done")
             except exceptions.OrthancApiException as ex:
@@ -291,6 +576,55 @@ class OrthancForwarder:
 
         return True
 
+    def _get_batches(self, instances_ids: List[str]) -> List[List[str]]:
+        return [instances_ids[i:i + self._upload_batch_size] for i in range(0, len(instances_ids), self._upload_batch_size)]
+
+    def _filter_files_in_process_pool(self, instances_ids: List[str]) -> Dict[str, bool]:
+        instances_to_keep = {}
+
+        for batch in self._get_batches(instances_ids):
+            files = [self._source.instances.get_file(instance_id) for instance_id in batch]
+            for instance_id, keep in zip(batch, self._process_pool.map(self._instance_file_filter, files)):
+                instances_to_keep[instance_id] = keep
+
+        return instances_to_keep
+
+    def _process_files_in_process_pool(self, instances_ids: List[str]):
+        # download the next batch while the processes are working on the current one
+        pending_batch = None
+        pending_futures = None
+
+        for batch in self._get_batches(instances_ids):
+            files = [self._source.instances.get_file(instance_id) for instance_id in batch]
+            futures = [self._process_pool.submit(self._instance_file_processor, f) for f in files]
+
+            if pending_futures:
+                self._upload_processed_files(pending_batch, [f.result() for f in pending_futures])
+
+            pending_batch = batch
+            pending_futures = futures
+
+        if pending_futures:
+            self._upload_processed_files(pending_batch, [f.result() for f in pending_futures])
+
+    def _upload_processed_files(self, instances_ids: List[str], files: List[bytes]):
+        if len(files) == 1:
+            uploaded_instances_ids = self._source.upload(files[0])
+        else:
+            # upload all files of the batch at once in a zip
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as z:
+                for i, f in enumerate(files):
+                    z.writestr(f"{i:06d}.dcm", f)
+            uploaded_instances_ids = self._source.upload(zip_buffer.getvalue())
+
+        if set(uploaded_instances_ids) != set(instances_ids):
+            # do not leave the new instances in Orthanc (the original instances will be processed again)
+            new_instances_ids = sorted(set(uploaded_instances_ids) - set(instances_ids))
+            if len(new_instances_ids) > 0:
+                self._source.instances.delete(orthanc_ids=new_instances_ids, ignore_errors=True)
+            raise Exception("The instance_file_processor shall not modify the DICOM UIDs of the instances")
+
     def forward(self, instances_set, already_sent_to_destinations: List[str]) -> List[str]:  # returns a list of destinations where the data has been sent
         sent_to_destinations = []
 
@@ -299,13 +633,28 @@ class OrthancForwarder:
         #has_been_sent_to = self._source.instances.get_string_metadata(instances_set.instances_ids[0], metadata_name=str(ForwarderMetadata.SENT_TO_DESTINATIONS.value), default_value="").split(",")
 
         for dest in self._destinations:
+            target = dest
             try:
 
                 if dest.destination not in already_sent_to_destinations:
-                    logger.info(f"{instances_set} Sending to {dest.destination} using {dest.forwarder_mode}")
-                    self._forward_to_destination(
+                    target = self._get_available_destination(dest)
+                    if target is None:
+                        logger.warning(f"{instances_set} Not sending to {dest.destination}: the destination is unavailable")
+                        if self._on_instances_set_forward_error:
+                            self._on_instances_set_forward_error(instances_set=instances_set,
+                                                                 destination=dest.destination,
+                                                                 error="destination unavailable")
+                        continue
+
+                    logger.info(f"{instances_set} Sending to {target.destination} using {target.forwarder_mode}")
+                    if self._use_async_jobs and target.forwarder_mode in [ForwarderMode.DICOM, ForwarderMode.PEERING]:
+                        # the job poller will complete the transfer and call the callbacks
+                        self._submit_forward_job(instances_set=instances_set, destination=dest, target=target)
+                        continue
+
+                    self._forward_to_destination_with_circuit_breaker(
                         instances_set=instances_set,
-                        destination=dest
+                        destination=target
                     )
                     logger.info(f"{instances_set} Sent")
                 else:
@@ -314,19 +663,19 @@ class OrthancForwarder:
                 sent_to_destinations.append(dest.destination)
                 if self._on_instances_set_forwarded:
                     self._on_instances_set_forwarded(instances_set=instances_set,
-                                                     destination=dest.destination)
+                                                     destination=target.destination)
 
             except exceptions.OrthancApiException as ex:
-                logger.error(f"{instances_set} Error while forwarding to {dest.destination}: {ex.msg}")
+                logger.error(f"{instances_set} Error while forwarding to {target.destination}: {ex.msg}")
                 if self._on_instances_set_forward_error:
                     self._on_instances_set_forward_error(instances_set=instances_set,
-                                                         destination=dest.destination,
+                                                         destination=target.destination,
                                                          error=ex.msg)
             except Exception as ex:
-                logger.error(f"{instances_set} Error while forwarding to {dest.destination}: {ex}", exc_info=True)
+                logger.error(f"{instances_set} Error while forwarding to {target.destination}: {ex}", exc_info=True)
                 if self._on_instances_set_forward_error:
                     self._on_instances_set_forward_error(instances_set=instances_set,
-                                                         destination=dest.destination,
+                                                         destination=target.destination,
                                                          error=str(ex))
 
         return sent_to_destinations
@@ -339,20 +688,40 @@ class OrthancForwarder:
         # self._status[instances_set.id].sent_to_destinations = sent_to_destinations
 
 
+    def _delete_instances(self, instances_set: InstancesSet):
+        if len(instances_set.instances_ids) == 0:
+            return
+
+        if self._bulk_deleter:
+            self._bulk_deleter.add(instances_set.instances_ids)
+        else:
+            instances_set.delete()
+
     def delete(self, instances_set):
         logger.info(f"{instances_set} Deleting ...")
-        del self._status[instances_set.id]
-        instances_set.delete()
+        with self._pending_jobs_lock:
+            self._status.pop(instances_set.id, None)
+        self._delete_instances(instances_set)
         logger.info(f"{instances_set} Deleting ... Done")
 
     def handle_instances_set(self, instances_set: InstancesSet):
 
-        if instances_set.id not in self._status:
-            self._status[instances_set.id] = ForwarderInstancesSetStatus()
-        elif self._status[instances_set.id].next_retry:  # this is a retry !
-            if datetime.datetime.now() < self._status[instances_set.id].next_retry:
-                logger.debug(f"{instances_set} Skipping while waiting for retry")
+        if self._bulk_deleter:
+            # the instances that are waiting for deletion have already been handled
+            instances_set.filter_instances(lambda api_client, instance_id: not self._bulk_deleter.is_pending(instance_id))
+            if len(instances_set.instances_ids) == 0:
+                return
+
+        with self._pending_jobs_lock:
+            if instances_set.id not in self._status:
+                self._status[instances_set.id] = ForwarderInstancesSetStatus()
+            elif len(self._status[instances_set.id].pending_jobs) > 0 or self._status[instances_set.id].forwarding:
+                logger.debug(f"{instances_set} Skipping while waiting for jobs to complete")
                 return
+            elif self._status[instances_set.id].next_retry:  # this is a retry !
+                if datetime.datetime.now() < self._status[instances_set.id].next_retry:
+                    logger.debug(f"{instances_set} Skipping while waiting for retry")
+                    return
 
         logger.info(f"{instances_set} Handling ...")
 
@@ -366,23 +735,214 @@ class OrthancForwarder:
             logger.info(f"{instances_set} Skipping processing that has already been performed")
 
         # forward
-        sent_to_destinations = self.forward(instances_set, self._status[instances_set.id].sent_to_destinations)
-        if len(sent_to_destinations) == len(self._destinations):
-            # delete
-            self.delete(instances_set)
-        else:
-            self._status[instances_set.id].sent_to_destinations = sent_to_destinations
+        status = self._status[instances_set.id]
+        status.forwarding = True
+        sent_to_destinations = self.forward(instances_set, status.sent_to_destinations)
+
+        with self._pending_jobs_lock:
+            status.forwarding = False
+            # the job poller might already have added some destinations
+            for destination in sent_to_destinations:
+                if destination not in status.sent_to_destinations:
+                    status.sent_to_destinations.append(destination)
+
+            if len(status.pending_jobs) > 0:
+                logger.info(f"{instances_set} Waiting for {len(status.pending_jobs)} job(s) to complete")
+                return
 
-            retry_count = self._status[instances_set.id].retry_count
-            next_retry = datetime.datetime.now() + datetime.timedelta(seconds=self.retry_intervals[min(retry_count, len(self.retry_intervals) - 1)])
-            logger.info(f"{instances_set} Failed, will retry at {next_retry}")
+        self._complete_instances_set(instances_set)
+
+    def _complete_instances_set(self, instances_set: InstancesSet):
+        # called from a worker thread or from the job poller thread
+        with self._pending_jobs_lock:
+            status = self._status[instances_set.id]
+            is_sent_to_all_destinations = len(status.sent_to_destinations) == len(self._destinations)
+
+            if not is_sent_to_all_destinations:
+                retry_count = status.retry_count
+                next_retry = datetime.datetime.now() + datetime.timedelta(seconds=self.retry_intervals[min(retry_count, len(self.retry_intervals) - 1)])
+                status.next_retry = next_retry
+                status.retry_count = retry_count + 1
 
-            self._status[instances_set.id].next_retry = next_retry
-            self._status[instances_set.id].retry_count = retry_count + 1
+        if not is_sent_to_all_destinations:
+            logger.info(f"{instances_set} Failed, will retry at {next_retry}")
             return
 
+        # delete
+        self.delete(instances_set)
+
         logger.info(f"{instances_set} Handling ... Done")
 
+    def _submit_forward_job(self, instances_set: InstancesSet, destination: ForwarderDestination, target: ForwarderDestination):
+        if target.forwarder_mode == ForwarderMode.DICOM:
+            endpoint = f"modalities/{target.destination}/store"
+        else:
+            endpoint = f"peers/{target.destination}/store"
+
+        try:
+            job_id = self._source.post(
+                endpoint=endpoint,
+                json={
+                    "Resources": instances_set.instances_ids,
+                    "Synchronous": False,
+                    "Priority": destination.job_priority
+                }).json()["ID"]
+        except Exception:
+            self._circuit_breakers[target.destination].record_failure()
+            raise
+
+        with self._pending_jobs_lock:
+            self._pending_jobs[job_id] = ForwarderPendingJob(job_id=job_id, instances_set=instances_set, destination=destination.destination, target=target.destination)
+            self._status[instances_set.id].pending_jobs[job_id] = destination.destination
+
+        logger.info(f"{instances_set} Sending to {target.destination}: job {job_id} submitted")
+
+    def _check_pending_jobs(self):
+        with self._pending_jobs_lock:
+            pending_jobs = list(self._pending_jobs.values())
+
+        # only the pending jobs are polled (the jobs history might be large)
+        for pending_job in pending_jobs:
+            try:
+                job = self._source.get_json(f"jobs/{pending_job.job_id}")
+            except exceptions.ResourceNotFound:
+                job = None
+
+            if job is None:
+                self._complete_job(pending_job, success=False, error="job not found, it might have been removed from the jobs history (check JobsHistorySize)")
+            elif job["State"] == "Success":
+                self._complete_job(pending_job, success=True, runtime=job.get("EffectiveRuntime"))
+            elif job["State"] == "Failure":
+                self._complete_job(pending_job, success=False, error=job.get("ErrorDetails") or job.get("ErrorDescription"))
+
+    def _complete_job(self, pending_job: ForwarderPendingJob, success: bool, error: str = None, runtime: float = None):
+        instances_set = pending_job.instances_set
+        circuit_breaker = self._circuit_breakers[pending_job.target]
+
+        if success:
+            logger.info(f"{instances_set} Sent to {pending_job.target} (job {pending_job.job_id})")
+            # the latency is measured per instance to be independent of the size of the InstancesSet
+            circuit_breaker.record_success(latency=runtime / max(1, len(instances_set.instances_ids)) if runtime is not None else None)
+            if self._on_instances_set_forwarded:
+                self._on_instances_set_forwarded(instances_set=instances_set,
+                                                 destination=pending_job.target)
+        else:
+            logger.error(f"{instances_set} Error while forwarding to {pending_job.target} (job {pending_job.job_id}): {error}")
+            circuit_breaker.record_failure()
+            if self._on_instances_set_forward_error:
+                self._on_instances_set_forward_error(instances_set=instances_set,
+                                                     destination=pending_job.target,
+                                                     error=error)
+
+        with self._pending_jobs_lock:
+            del self._pending_jobs[pending_job.job_id]
+            status = self._status.get(instances_set.id)
+            if status is None:
+                return
+
+            del status.pending_jobs[pending_job.job_id]
+            if success and pending_job.destination not in status.sent_to_destinations:
+                status.sent_to_destinations.append(pending_job.destination)
+
+            # if a worker thread is still submitting transfers, it will complete the InstancesSet itself
+            if len(status.pending_jobs) > 0 or status.forwarding:
+                return
+
+        self._complete_instances_set(instances_set)
+
+    def _poll_jobs(self):
+        while self._job_poller_running:
+            try:
+                self._check_pending_jobs()
+            except Exception as ex:
+                logger.exception(f"Error while checking the jobs status: {str(ex)}")
+            time.sleep(self._job_polling_interval_in_seconds)
+
+    def _start_job_poller(self):
+        if not self._use_async_jobs:
+            return
+
+        self._job_poller_running = True
+        self._job_poller_thread = threading.Thread(
+            target=self._poll_jobs,
+            name='OrthancForwarder job poller thread',
+            daemon=True
+        )
+        self._job_poller_thread.start()
+
+    def _stop_job_poller(self):
+        self._job_poller_running = False
+        if self._job_poller_thread:
+            self._job_poller_thread.join()
+            self._job_poller_thread = None
+
+        if len(self._pending_jobs) > 0:
+            logger.warning(f"Stopping while {len(self._pending_jobs)} job(s) are still running, their InstancesSets will be handled again at next startup")
+
+    def _get_available_destination(self, destination: ForwarderDestination) -> Optional[ForwarderDestination]:
+        # returns the destination to send to, taking the circuit breakers into account (or None if all are down)
+        if self._circuit_breakers[destination.destination].is_available():
+            return destination
+
+        if destination.alternate_destination is not None and self._circuit_breakers[destination.alternate_destination].is_available():
+            logger.info(f"{destination.destination} is unavailable, using the alternate destination {destination.alternate_destination}")
+            return ForwarderDestination(destination=destination.alternate_destination, forwarder_mode=destination.forwarder_mode)
+
+        return None
+
+    def _forward_to_destination_with_circuit_breaker(self, instances_set: InstancesSet, destination: ForwarderDestination):
+        circuit_breaker = self._circuit_breakers[destination.destination]
+        timer = Timer()
+        try:
+            self._forward_to_destination(instances_set=instances_set, destination=destination)
+        except Exception:
+            circuit_breaker.record_failure()
+            raise
+
+        # the latency is measured per instance to be independent of the size of the InstancesSet
+        circuit_breaker.record_success(latency=timer.get_elapsed_seconds() / max(1, len(instances_set.instances_ids)))
+
+    def _probe_destination(self, alias: str, forwarder_mode: ForwarderMode) -> bool:
+        # perform a cheap request to check if the destination is reachable
+        try:
+            if forwarder_mode in [ForwarderMode.DICOM, ForwarderMode.DICOM_SERIES_BY_SERIES]:
+                self._source.post(endpoint=f"modalities/{alias}/echo", json={"Timeout": 5})
+            elif forwarder_mode in [ForwarderMode.PEERING, ForwarderMode.TRANSFER]:
+                self._source.get(endpoint=f"peers/{alias}/system")
+            elif forwarder_mode in [ForwarderMode.DICOM_WEB, ForwarderMode.DICOM_WEB_SERIES_BY_SERIES]:
+                self._source.post(endpoint=f"dicom-web/servers/{alias}/get", json={"Uri": "/studies", "Arguments": {"limit": "1"}})
+            else:
+                raise NotImplementedError
+            return True
+        except exceptions.OrthancApiException as ex:
+            logger.debug(f"{alias} probe failed: {ex.msg}")
+            return False
+
+    def _check_destinations_health(self):
+        while self._health_checks_running:
+            for alias, circuit_breaker in self._circuit_breakers.items():
+                try:
+                    if circuit_breaker.should_probe():
+                        circuit_breaker.record_probe(self._probe_destination(alias, self._destinations_modes[alias]))
+                except Exception as ex:
+                    logger.exception(f"Error while checking the health of {alias}: {str(ex)}")
+            time.sleep(1)
+
+    def _start_health_checks(self):
+        self._health_checks_running = True
+        self._health_check_thread = threading.Thread(
+            target=self._check_destinations_health,
+            name='OrthancForwarder health check thread',
+            daemon=True
+        )
+        self._health_check_thread.start()
+
+    def _stop_health_checks(self):
+        self._health_checks_running = False
+        if self._health_check_thread:
+            self._health_check_thread.join()
+            self._health_check_thread = None
+
     def _forward_to_destination(self, instances_set: InstancesSet, destination: ForwarderDestination):
         if destination.forwarder_mode == ForwarderMode.DICOM:
             self._source.modalities.send(
@@ -0,0 +1,429 @@
+import os, time
+import logging
+import argparse
+import datetime
+import threading
+import queue
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from .helpers.scheduler import Scheduler
+from .helpers.orthanc_snapshot import OrthancSnapshot, StudySummary, get_study_content
+from orthanc_api_client import OrthancApiClient, ResourceType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MultiSyncherTransfer:
+    source: str                     # the name of the node the resources are read from
+    destination: str                # the name of the node the resources are written to
+    study_id: str
+    resources_ids: List[str]
+    resource_type: ResourceType     # the level of the resources (a whole study, some series or some instances)
+
+
+class OrthancMultiSyncher:
+    '''
+    ## Goal
+    The MultiSyncher ensures that all the studies/series/instances stored in one of N Orthanc (the nodes)
+    are stored in all the other nodes.  It is the N-way version of the `OrthancSyncher`.
+
+    ## How it works
+    - Each node is listed only once (concurrently) through an `OrthancSnapshot`, until `LastUpdate` < the
+      LastUpdate processed in the previous execution for this node.
+    - For each study that has been updated in any node, the presence matrix of the study is computed in memory:
+        - if all nodes have the study with the same series/instances counts, the study is considered as identical;
+        - else, the series and instances of the study are listed in each node that has the study (one request
+          per node) to find which nodes have each series and each instance.
+    - A transfer plan is then computed: each missing study/series/instance is read from a single node that has it:
+      the least loaded one (the one that has been chosen as a source for the smallest number of instances so far)
+      among the ones that have the most complete version of the study/series.
+    - The transfers are grouped by (source, destination) pair.  Each pair has its own queue and
+      `transfer_threads_per_pair` threads such that the transfers between different pairs run concurrently.
+
+    A transfer that still fails after all retries is logged in `error_log_file_path` and the execution goes on.
+    If a scheduler is provided, the transfers are paused outside the allowed periods.
+    '''
+
+    retry_delays = [5, 20, 60]      # delays between the retries of a failed transfer
+
+    def __init__(self,
+                 api_clients: Dict[str, OrthancApiClient],     # the nodes (name -> api client)
+                 level: str = 'Series',
+                 scheduler: Scheduler = None,
+                 error_log_file_path: str = None,
+                 persist_status_path: str = None,              # the file where the LastUpdate processed for each node is stored (one 'name;LastUpdate' line per node)
+                 orthanc_queries_batch_size: int = 100,
+                 transfer_threads_per_pair: int = 2,           # the number of threads transferring between 2 given nodes
+                 transfer_queue_size: int = 100                # the maximum number of transfers waiting to be performed for 2 given nodes
+                 ):
+
+        if level not in ["Study", "Series", "Instance"]:
+            raise RuntimeError("Invalid value for argument 'level'")
+
+        if len(api_clients) < 2:
+            raise RuntimeError("At least 2 Orthanc are required")
+
+        self._api_clients = api_clients
+        self._nodes = list(api_clients.keys())
+        self._level = level
+        self._scheduler = scheduler
+        self._error_log_file_path = error_log_file_path
+        self._error_log_lock = threading.Lock()
+        self._persist_status_path = persist_status_path
+        self._batch_size = orthanc_queries_batch_size
+        self._transfer_threads_per_pair = transfer_threads_per_pair
+        self._transfer_queue_size = transfer_queue_size
+
+        self._last_update_limits = {n: None for n in self._nodes}   # None = process all studies
+        if self._persist_status_path is not None:
+            self._last_update_limits = self._read_status_from_file()
+
+        self._load = {n: 0 for n in self._nodes}        # the number of instances planned to be read from each node
+        self._pairs_queues = {}                         # (source, destination) -> queue of transfers
+        self._pairs_threads = {}                        # (source, destination) -> transfer threads
+        self._pending_transfers_count = 0
+        self._transfers_condition = threading.Condition()
+
+    def _read_status_from_file(self) -> Dict[str, Optional[datetime.datetime]]:
+        """
+        The file should contain the LastUpdate of each node, prefixed by the node name:
+
+        http://orthanc-a:8042;2025-05-20 14:01:58
+        http://orthanc-b:8042;2025-05-19 15:44:36
+        http://orthanc-c:8042;2025-05-19 16:12:03
+
+        The nodes that are not in the file (i.e. new nodes) are processed completely.
+        """
+        limits = {n: None for n in self._nodes}
+        try:
+            with open(self._persist_status_path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            logger.warning("Could not read LastUpdate values from file, processing all studies")
+            return limits
+
+        for line in lines:
+            node, separator, last_update_string = line.rpartition(";")
+            if node not in limits:
+                if len(line.strip()) > 0:
+                    logger.warning(f"Ignoring the LastUpdate value of an unknown node from file: {line}")
+                continue
+
+            try:
+                limits[node] = datetime.datetime.strptime(last_update_string, "%Y-%m-%d %H:%M:%S")
+                logger.info(f"{node} till value from file = {limits[node]}")
+            except ValueError:
+                logger.warning(f"Could not read the LastUpdate value of {node} from file, processing all its studies")
+
+        return limits
+
+    def _save_status_to_file(self):
+        lines = []
+        for node in self._nodes:
+            last_update = self._last_update_limits[node] or datetime.datetime(year=1950, month=1, day=1, hour=1, minute=1, second=1)
+            lines.append(f"{node};" + datetime.datetime.strftime(last_update, "%Y-%m-%d %H:%M:%S") + '\n')
+
+        # first write to a temp file and then move the file such that the file is never left half-written
+        tmp = self._persist_status_path + ".tmp"
+        try:
+            with open(tmp, "wt") as f:
+                f.writelines(lines)
+            os.replace(tmp, self._persist_status_path)  # this is an 'atomic' operation
+        except OSError as e:
+            logger.error(f"Could not write LastUpdate values to file: {str(e)}")
+
+    def execute(self):
+        logger.info(f"----- Starting Orthanc multi syncher ({', '.join(self._nodes)})...")
+
+        # list the content of each node only once (concurrently)
+        snapshots = {n: OrthancSnapshot(api_client=self._api_clients[n], batch_size=self._batch_size) for n in self._nodes}
+        self._run_concurrently([lambda n=n: snapshots[n].load(last_update_limit=self._last_update_limits[n]) for n in self._nodes])
+
+        # the studies to check (the ones that have been updated in at least one node)
+        studies_ids = {}
+        new_last_update_limits = dict(self._last_update_limits)
+        for node in self._nodes:
+            updated_studies = snapshots[node].get_studies_updated_since(self._last_update_limits[node] or datetime.datetime.min)
+            if len(updated_studies) > 0:
+                new_last_update_limits[node] = updated_studies[0].last_update
+            for study in updated_studies:
+                studies_ids[study.orthanc_id] = None
+
+        # if there are many studies to check, it is faster to list the nodes completely than to look up each study
+        self._run_concurrently([lambda n=n: self._complete_snapshot_if_needed(snapshots[n], len(studies_ids)) for n in self._nodes])
+
+        self._load = {n: 0 for n in self._nodes}
+        identical_count = 0
+        try:
+            for study_id in studies_ids.keys():
+                try:
+                    if self.synch_study(study_id, {n: snapshots[n].get(study_id) for n in self._nodes}):
+                        identical_count += 1
+                except Exception as e:
+                    self._log_error(study_id, f"Error while comparing the study: {str(e)}")
+
+            logger.info("Comparison completed, waiting for the transfers to complete...")
+            self._wait_transfers_completed()
+        finally:
+            self._stop_transfer_threads()
+
+        self._last_update_limits = new_last_update_limits
+        if self._persist_status_path is not None:
+            self._save_status_to_file()
+
+        logger.info(f"Processed {len(studies_ids)} studies ({identical_count} identical), instances read from each node: " +
+                    ", ".join(f"{n}: {self._load[n]}" for n in self._nodes))
+
+    def _run_concurrently(self, functions):
+        errors = []
+
+        def run(function):
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(f,), name=f"MultiSyncher thread {i}") for i, f in enumerate(functions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _complete_snapshot_if_needed(self, snapshot: OrthancSnapshot, studies_to_check_count: int):
+        # listing all studies costs one request per batch while looking up the studies costs one request per study
+        if not snapshot.is_complete and studies_to_check_count * self._batch_size >= snapshot.api_client.get_statistics().studies_count:
+            snapshot.load()
+
+    def synch_study(self, study_id: str, summaries: Dict[str, Optional[StudySummary]]) -> bool:  # returns True if the study was identical
+        holders = [n for n in self._nodes if summaries.get(n) is not None]
+        if len(holders) == 0:
+            return True  # the study has been deleted in the meantime
+
+        missing_nodes = [n for n in self._nodes if n not in holders]
+
+        if len(missing_nodes) == 0:
+            if self._level == "Study":
+                return True
+
+            # if the counts are the same everywhere, there is no need to go deeper
+            if len(set(summaries[n].series_count for n in holders)) == 1 \
+                    and (self._level == "Series" or len(set(summaries[n].instances_count for n in holders)) == 1):
+                return True
+
+        if self._level == "Study":
+            for destination in missing_nodes:
+                source = self._choose_source(holders, lambda n: summaries[n].instances_count)
+                self._load[source] += summaries[source].instances_count
+                self.schedule_transfer(MultiSyncherTransfer(source=source, destination=destination, study_id=study_id,
+                                                            resources_ids=[study_id], resource_type=ResourceType.STUDY))
+            return False
+
+        # compute the presence matrix of the series and instances of the study
+        series_presence, instances_presence, series_instances_count = self.get_presence_matrix(study_id, holders)
+
+        # and plan the transfers (grouped by source -> destination pair)
+        plan = {}   # (source, destination) -> resources ids
+        for destination in self._nodes:
+            if self._level == "Series":
+                for series_id, series_holders in series_presence.items():
+                    if destination not in series_holders:
+                        source = self._choose_source(series_holders, lambda n: series_instances_count[(n, series_id)])
+                        self._load[source] += series_instances_count[(source, series_id)]
+                        plan.setdefault((source, destination), []).append(series_id)
+            else:
+                for instance_id, instance_holders in instances_presence.items():
+                    if destination not in instance_holders:
+                        source = self._choose_source(instance_holders)
+                        self._load[source] += 1
+                        plan.setdefault((source, destination), []).append(instance_id)
+
+        for (source, destination), resources_ids in plan.items():
+            self.schedule_transfer(MultiSyncherTransfer(source=source, destination=destination, study_id=study_id, resources_ids=resources_ids,
+                                                        resource_type=ResourceType.SERIES if self._level == "Series" else ResourceType.INSTANCE))
+
+        return len(plan) == 0
+
+    def get_presence_matrix(self, study_id: str, holders: List[str]) -> Tuple[Dict[str, Set[str]], Dict[str, Set[str]], Dict[Tuple[str, str], int]]:
+        """
+        Returns:
+        - the nodes that have each series (series_id -> nodes),
+        - the nodes that have each instance (instance_id -> nodes),
+        - the number of instances of each series in each node ((node, series_id) -> count)
+        """
+        contents = {}
+        self._run_concurrently([lambda n=n: contents.__setitem__(n, get_study_content(self._api_clients[n], study_id)) for n in holders])
+
+        series_presence = {}
+        instances_presence = {}
+        series_instances_count = {}
+        for node in holders:
+            for series_id, instances_ids in contents[node].items():
+                series_presence.setdefault(series_id, set()).add(node)
+                series_instances_count[(node, series_id)] = len(instances_ids)
+                for instance_id in instances_ids:
+                    instances_presence.setdefault(instance_id, set()).add(node)
+
+        return series_presence, instances_presence, series_instances_count
+
+    def _choose_source(self, holders, get_instances_count=None) -> str:
+        # when sending a whole study/series, only consider the nodes that have the most complete version of it
+        if get_instances_count is not None:
+            max_instances_count = max(get_instances_count(n) for n in holders)
+            holders = [n for n in holders if get_instances_count(n) == max_instances_count]
+
+        # the least loaded node (and always the same one in case of equality)
+        return min(holders, key=lambda n: (self._load[n], self._nodes.index(n)))
+
+    def schedule_transfer(self, transfer: MultiSyncherTransfer):
+        pair = (transfer.source, transfer.destination)
+        if pair not in self._pairs_queues:
+            self._start_transfer_threads(pair)
+
+        with self._transfers_condition:
+            self._pending_transfers_count += 1
+        self._pairs_queues[pair].put(transfer)  # blocks while the queue is full
+
+    def _start_transfer_threads(self, pair: Tuple[str, str]):
+        self._pairs_queues[pair] = queue.Queue(maxsize=self._transfer_queue_size)
+        self._pairs_threads[pair] = [threading.Thread(
+            target=self._process_transfers,
+            name=f"MultiSyncher transfer thread {pair[0]} -> {pair[1]} {thread_id}",
+            args=(self._pairs_queues[pair], )
+        ) for thread_id in range(0, self._transfer_threads_per_pair)]
+
+        logger.debug(f"Starting transfer threads {pair[0]} -> {pair[1]}")
+        for t in self._pairs_threads[pair]:
+            t.start()
+
+    def _stop_transfer_threads(self):
+        for pair, threads in self._pairs_threads.items():
+            for t in threads:
+                self._pairs_queues[pair].put(None)
+        for threads in self._pairs_threads.values():
+            for t in threads:
+                t.join()
+        self._pairs_threads = {}
+        self._pairs_queues = {}
+
+    def _process_transfers(self, transfers_queue: queue.Queue):
+        while True:
+            transfer = transfers_queue.get()
+            if transfer is None:  # sent by _stop_transfer_threads()
+                break
+
+            try:
+                self._transfer_with_retries(transfer)
+            except Exception as e:
+                logger.exception(f"Unexpected error while transfering resources of study {transfer.study_id}: {str(e)}")
+            finally:
+                # whatever happens, the transfer must not be waited for forever
+                with self._transfers_condition:
+                    self._pending_transfers_count -= 1
+                    self._transfers_condition.notify_all()
+
+    def _transfer_with_retries(self, transfer: MultiSyncherTransfer):
+        retry_count = 0
+        while True:
+            try:
+                if self._scheduler is not None:
+                    self._scheduler.wait_right_time_to_run()
+
+                self.transfer_resources(transfer)
+                return
+            except Exception as e:
+                if retry_count >= len(self.retry_delays):
+                    self._log_error(transfer.study_id, f"Error while transfering resources from {transfer.source} to {transfer.destination}. Exception: {str(e)}")
+                    return
+
+                delay = self.retry_delays[retry_count]
+                logger.warning(f"Error while transfering resources of study {transfer.study_id} from {transfer.source} to {transfer.destination}, will retry in {delay} seconds. Exception: {str(e)}")
+                retry_count += 1
+                time.sleep(delay)
+
+    def _wait_transfers_completed(self):
+        with self._transfers_condition:
+            self._transfers_condition.wait_for(lambda: self._pending_transfers_count == 0)
+
+    def transfer_resources(self, transfer: MultiSyncherTransfer):
+        source = self._api_clients[transfer.source]
+        destination = self._api_clients[transfer.destination]
+
+        if transfer.resource_type == ResourceType.STUDY:
+            instances_ids = [i for study_id in transfer.resources_ids for i in source.studies.get_instances_ids(study_id)]
+        elif transfer.resource_type == ResourceType.SERIES:
+            instances_ids = [i for series_id in transfer.resources_ids for i in source.series.get_instances_ids(series_id)]
+        else:
+            instances_ids = transfer.resources_ids
+
+        for instance_id in instances_ids:
+            data = source.instances.get_file(instance_id)
+            destination.upload(data)
+
+    def _log_error(self, study_id: str, message: str):
+        logger.error(f"{message} (study {study_id})")
+
+        if self._error_log_file_path is not None:
+            with self._error_log_lock:
+                try:
+                    with open(self._error_log_file_path, "at") as f:
+                        f.write(f"{study_id}\n")
+                except OSError as e:
+                    logger.error(f"Could not write to the error log file: {str(e)}")
+
+
+if __name__ == '__main__':
+    level = logging.INFO
+
+    if os.environ.get('VERBOSE_ENABLED'):
+        level = logging.DEBUG
+
+    logging.basicConfig(level=level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Ensure that all the studies/series/instances stored in one of N Orthanc are stored in all of them.')
+    parser.add_argument('--urls', type=str, default=None, help='Comma separated list of the Orthanc urls')
+    parser.add_argument('--user', type=str, default=None, help='Orthanc user name (the same for all Orthanc)')
+    parser.add_argument('--password', type=str, default=None, help='Orthanc password (the same for all Orthanc)')
+    parser.add_argument('--api_key', type=str, default=None, help='Orthanc api-key (the same for all Orthanc)')
+    parser.add_argument('--level', type=str, default='Series', help='Compare resources up to Study/Series/Instance level')
+    parser.add_argument('--error_log_file_path', type=str, default='/errors.log', help='Path to the file to write errors log')
+    parser.add_argument('--persist_status_path', type=str, default='/status.txt', help='Path to the file to write the status')
+    parser.add_argument('--transfer_threads_per_pair', type=int, default=2, help='Number of threads transferring between 2 given Orthanc')
+
+    Scheduler.add_parser_arguments(parser)
+
+    args = parser.parse_args()
+
+    urls = os.environ.get("ORTHANC_URLS", args.urls)
+    user = os.environ.get("ORTHANC_USER", args.user)
+    password = os.environ.get("ORTHANC_PWD", args.password)
+    api_key = os.environ.get("ORTHANC_API_KEY", args.api_key)
+    level = os.environ.get("LEVEL", args.level)
+    error_log_file_path = os.environ.get("ERROR_LOG_FILE_PATH", args.error_log_file_path)
+    persist_status_path = os.environ.get("PERSIST_STATUS_PATH", args.persist_status_path)
+    transfer_threads_per_pair = int(os.environ.get("TRANSFER_THREADS_PER_PAIR", str(args.transfer_threads_per_pair)))
+
+    scheduler = Scheduler.create_from_args_and_env_var(args)
+
+    api_clients = {}
+    for url in urls.split(','):
+        if api_key is not None:
+            api_clients[url] = OrthancApiClient(url, headers={"api-key": api_key})
+        else:
+            api_clients[url] = OrthancApiClient(url, user=user, pwd=password)
+
+    syncher = OrthancMultiSyncher(
+        api_clients=api_clients,
+        level=level,
+        scheduler=scheduler,
+        error_log_file_path=error_log_file_path,
+        persist_status_path=persist_status_path,
+        transfer_threads_per_pair=transfer_threads_per_pair
+    )
+
+    syncher.execute()
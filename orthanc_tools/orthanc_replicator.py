@@ -1,15 +1,31 @@
 import argparse
 import threading
 import time
+import queue
+import io
+import zipfile
+import concurrent.futures
 
 import pika
 import logging
 import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 from orthanc_api_client import OrthancApiClient, ResourceType, JobStatus, ResourceNotFound
+from .replicator_transports import ReplicatorMessage, ReplicatorTransport, RabbitMqTransport
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class ReplicatorStatistics:
+    cancelled_forwards: int = 0         # forwards that have not been performed because the instance was deleted right after
+    skipped_duplicate_forwards: int = 0     # forwards of the same instance received multiple times within the coalescing window
+    coalesced_deletes: int = 0          # individual deletes that have been replaced by a bulk-delete
+    bulk_deletes: int = 0               # number of bulk-delete calls
+
+
 class OrthancReplicator:
     '''
     ## Goal
@@ -43,6 +59,9 @@ class OrthancReplicator:
     ### Broker
     RabbitMQ has to be up and running.
 
+    Alternatively, you may provide another `transport` (see replicator_transports.py), i.e. a SqliteTransport that
+    implements an embedded durable queue and does not require any broker.
+
     ### Replicator
     The replicator needs to connect to both Orthanc (source and destination) and to RabbitMQ.
     So these information should be provided:
@@ -56,28 +75,222 @@ class OrthancReplicator:
     broker_user: Broker user name
     broker_pwd: Broker password
     broker_port: Broker port nr
+
+    ### Concurrency
+    The messages are handled by `worker_threads_count` worker threads with at most `prefetch_count` unacknowledged
+    messages per worker.  All messages related to the same instance are handled by the same worker thread to
+    preserve their order.
+
+    ### Micro-batching
+    With `forward_batch_size` > 1, each worker accumulates up to `forward_batch_size` 'forward' messages (or waits
+    at most `forward_batch_timeout_in_ms`), downloads the instances concurrently and uploads them to the destination
+    as a single zip file.  The successful messages are then acked at once (`multiple=True`) while the failed ones
+    are nacked individually (and therefore moved to the standby queue).
+    Since the messages received on a channel are spread over all the workers, a worker gets about `prefetch_count`
+    unacknowledged messages: `prefetch_count` must therefore be at least `forward_batch_size`, otherwise, the
+    batches could never be complete and would always wait for `forward_batch_timeout_in_ms`.
+
+    ### Coalescing
+    With `coalescing_window_in_ms` > 0, each worker holds the messages for that duration before handling them:
+    - a 'forward' followed by a 'delete' of the same instance is not performed at all (typically when a study is
+      deleted right after it has been received),
+    - the remaining 'deletes' are performed in a single bulk-delete call.
+    The number of operations avoided are available through get_statistics().
     '''
 
     def __init__(self,
                  source: OrthancApiClient,
                  destination: OrthancApiClient,
-                 broker_params: pika.ConnectionParameters
+                 broker_params: pika.ConnectionParameters = None,
+                 worker_threads_count: int = 1,         # the number of worker threads (and broker channels)
+                 prefetch_count: int = 10,              # the maximum number of unacknowledged messages per worker
+                 forward_batch_size: int = 1,           # the maximum number of instances forwarded together
+                 forward_batch_timeout_in_ms: int = 100,    # the maximum delay to wait for a batch to be complete
+                 coalescing_window_in_ms: int = 0,      # the delay during which messages are held to cancel forward/delete pairs and group the deletes
+                 transport: ReplicatorTransport = None  # the transport to get the messages from (by default, a RabbitMqTransport using broker_params)
         ):
 
+        if forward_batch_size > prefetch_count:
+            raise RuntimeError(f"'prefetch_count' ({prefetch_count}) must be greater than or equal to 'forward_batch_size' ({forward_batch_size})")
+
         self._source = source
         self._destination = destination
-        self._broker_params = broker_params
+        self._transport = transport or RabbitMqTransport(broker_params=broker_params)
+        self._worker_threads_count = worker_threads_count
+        self._prefetch_count = prefetch_count
+        self._forward_batch_size = forward_batch_size
+        self._forward_batch_timeout = forward_batch_timeout_in_ms / 1000.0
+        self._download_pool = None
+        if forward_batch_size > 1:
+            self._download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=forward_batch_size, thread_name_prefix="Replicator download thread")
+        self._coalescing_window = coalescing_window_in_ms / 1000.0
+        self._statistics = ReplicatorStatistics()
+        self._statistics_lock = threading.Lock()
         self._consuming_thread = None
+        self._worker_threads = []
+        self._messages_queues = []
+        self._thread_local = threading.local()     # the messages acknowledged by the current worker (see _handle_messages_safely)
+
+    def _dispatch(self, message: ReplicatorMessage):
+        # called from the transport thread.  All messages related to an instance are handled by the same worker to
+        # make sure a 'delete' is not handled before the 'forward'
+        self._messages_queues[hash(message.orthanc_id) % self._worker_threads_count].put(message)
+
+    def _acknowledge(self, message: ReplicatorMessage, success: bool):
+        self._acknowledge_messages([(message, success)])
+
+    def _acknowledge_messages(self, results: List[Tuple[ReplicatorMessage, bool]]):
+        # failed messages are dead-lettered by the transport and will be retried later
+        acknowledged = getattr(self._thread_local, "acknowledged", None)
+        if acknowledged is not None:
+            acknowledged.update(id(m) for m, success in results)
+        self._transport.acknowledge(results)
+
+    def _handle_messages_safely(self, messages: List[ReplicatorMessage]):
+        # an unexpected error must not kill the worker thread (the messages of all the instances hashed to this
+        # worker would then never be handled) -> the messages that have not been acknowledged yet are rejected
+        self._thread_local.acknowledged = set()
+        try:
+            self.handle_messages(messages)
+        except Exception as ex:
+            logger.exception(f"Error while handling {len(messages)} message(s), they will be retried: {str(ex)}")
+            unacknowledged = [m for m in messages if id(m) not in self._thread_local.acknowledged]
+            if len(unacknowledged) > 0:
+                try:
+                    self._acknowledge_messages([(m, False) for m in unacknowledged])
+                except Exception as ex:
+                    logger.exception(f"Unable to reject {len(unacknowledged)} message(s), they will be redelivered: {str(ex)}")
+        finally:
+            self._thread_local.acknowledged = None
+
+    def _process_messages(self, worker_id: int):
+        logger.debug(f"Starting Replicator worker thread {worker_id}")
+
+        # when batching or coalescing, the messages are accumulated during a short window
+        if self._forward_batch_size > 1 or self._coalescing_window > 0:
+            window = max(self._forward_batch_timeout if self._forward_batch_size > 1 else 0, self._coalescing_window)
+            # when coalescing, hold as many messages as possible during the window, otherwise, handle each full batch right away
+            max_messages_count = self._prefetch_count if self._coalescing_window > 0 else self._forward_batch_size
+        else:
+            window = 0
+            max_messages_count = 1
+
+        messages = []
+        deadline = None
+
+        while True:
+            try:
+                timeout = max(0.0, deadline - time.time()) if len(messages) > 0 else None
+                message = self._messages_queues[worker_id].get(timeout=timeout)
+            except queue.Empty:  # the window has expired
+                self._handle_messages_safely(messages)
+                messages = []
+                continue
+
+            if message is None:  # sent by _stop_workers()
+                self._handle_messages_safely(messages)
+                break
 
-        self._stop_requested = False
+            if len(messages) == 0:
+                deadline = time.time() + window
+            messages.append(message)
 
-    def to_delete_callback(self, channel, method, properties, body):
-        orthanc_id = body.decode('utf8')
+            if len(messages) >= max_messages_count:
+                self._handle_messages_safely(messages)
+                messages = []
+
+        logger.debug(f"Stopping Replicator worker thread {worker_id}")
+
+    def handle_messages(self, messages: List[ReplicatorMessage]):
+        if len(messages) == 0:
+            return
+
+        to_forward = {}     # orthanc_id -> message (in order of arrival)
+        to_delete = []
+        avoided = []
+
+        for message in messages:
+            if message.action == 'forward':
+                if message.orthanc_id in to_forward:
+                    avoided.append(message)
+                    with self._statistics_lock:
+                        self._statistics.skipped_duplicate_forwards += 1
+                else:
+                    to_forward[message.orthanc_id] = message
+            else:
+                if message.orthanc_id in to_forward:
+                    # no need to forward an instance that is deleted right after.  The delete is still performed in
+                    # case a previous version of the instance has been forwarded before.
+                    avoided.append(to_forward[message.orthanc_id])
+                    del to_forward[message.orthanc_id]
+                    with self._statistics_lock:
+                        self._statistics.cancelled_forwards += 1
+                to_delete.append(message)
+
+        if len(avoided) > 0:
+            logger.debug(f"Avoided forwarding {len(avoided)} instance(s)")
+            self._acknowledge_messages([(m, True) for m in avoided])
+
+        # a 'delete' followed by a 'forward' must be handled in this order -> handle the deletes first
+        if len(to_delete) == 1:
+            self._acknowledge(to_delete[0], self.delete_instance(to_delete[0].orthanc_id))
+        elif len(to_delete) > 1:
+            self.delete_instances(to_delete)
+
+        to_forward = list(to_forward.values())
+        if self._forward_batch_size > 1:
+            for i in range(0, len(to_forward), self._forward_batch_size):
+                self.forward_instances(to_forward[i:i + self._forward_batch_size])
+        else:
+            for message in to_forward:
+                self._acknowledge(message, self.forward_instance(message.orthanc_id))
+
+    def delete_instances(self, messages: List[ReplicatorMessage]):
+        orthanc_ids = list(set(m.orthanc_id for m in messages))
+        try:
+            # the instances that do not exist in the destination are ignored by Orthanc
+            self._destination.post(
+                endpoint="tools/bulk-delete",
+                json={
+                    "Resources": orthanc_ids
+                })
+            with self._statistics_lock:
+                self._statistics.bulk_deletes += 1
+                self._statistics.coalesced_deletes += len(messages)
+            logger.debug(f"Deleted {len(orthanc_ids)} instances from destination.")
+            self._acknowledge_messages([(m, True) for m in messages])
+
+        except Exception as ex:
+            logger.warning(f"Unable to bulk-delete {len(orthanc_ids)} instances from destination, retrying one by one: {str(ex)}")
+            self._acknowledge_messages([(m, self.delete_instance(m.orthanc_id)) for m in messages])
+
+    def get_statistics(self) -> ReplicatorStatistics:
+        with self._statistics_lock:
+            return ReplicatorStatistics(**self._statistics.__dict__)
+
+    def _start_workers(self):
+        self._messages_queues = [queue.Queue() for i in range(0, self._worker_threads_count)]
+        self._worker_threads = [threading.Thread(
+            target=self._process_messages,
+            name=f"Replicator worker thread {worker_id}",
+            args=(worker_id,)
+        ) for worker_id in range(0, self._worker_threads_count)]
+
+        for t in self._worker_threads:
+            t.start()
+
+    def _stop_workers(self):
+        for q in self._messages_queues:
+            q.put(None)
+        for t in self._worker_threads:
+            t.join()
+        self._worker_threads = []
+
+    def delete_instance(self, orthanc_id: str) -> bool:  # returns True if the message can be acked
         try:
             self._destination.instances.delete(orthanc_id)
-            channel.basic_ack(delivery_tag=method.delivery_tag)
             logger.debug(f"Deleted instance from destination ({orthanc_id}).")
-            return
+            return True
 
         except ResourceNotFound as ex:
             # The instance may have been deleted (by a user, a script,...) from the destination between the moment
@@ -85,16 +298,53 @@ class OrthancReplicator:
             # and the moment we try to handle it. So, the destination will return a 404 http error.
             # In this case, simply log the error and ack the message (don't raise the Exception)
             logger.info(f"Unable (404) to delete instance from destination ({orthanc_id}), probably already deleted...")
-            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return True
 
         except Exception as ex:
             logger.warning(f"Unable to delete instance from destination ({orthanc_id}), requeueing...")
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return False
+
+    def forward_instances(self, messages: List[ReplicatorMessage]):
+        if len(messages) == 0:
+            return
 
-    def to_forward_callback(self, channel, method, properties, body):
-        orthanc_id = body.decode('utf8')
+        # download concurrently
+        downloads = list(self._download_pool.map(lambda m: self._download_instance(m.orthanc_id), messages))
+
+        results = [None] * len(messages)
+        to_upload = []
+        for i, (dicom, success) in enumerate(downloads):
+            if dicom is None:
+                results[i] = success
+            else:
+                to_upload.append((i, dicom))
+
+        if len(to_upload) > 0:
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+                for i, dicom in to_upload:
+                    zip_file.writestr(f"{messages[i].orthanc_id}.dcm", dicom)
+
+            uploaded_ids = set()
+            try:
+                uploaded_ids = set(self._destination.upload(zip_buffer.getvalue()))
+            except Exception as ex:
+                logger.warning(f"Unable to upload a batch of {len(to_upload)} instances to destination, retrying one by one: {str(ex)}")
+
+            # the orthanc ids are the same in the source and the destination
+            for i, dicom in to_upload:
+                if messages[i].orthanc_id in uploaded_ids:
+                    results[i] = True
+                else:
+                    results[i] = self._upload_instance(messages[i].orthanc_id, dicom)
+
+            logger.debug(f"Forwarded a batch of {len(uploaded_ids)} instances to destination.")
+
+        self._acknowledge_messages(list(zip(messages, results)))
+
+    def _download_instance(self, orthanc_id: str) -> Tuple[Optional[bytes], bool]:  # returns the file or None + False if the message must be retried
         try:
-            dicom = self._source.instances.get_file(orthanc_id)
+            return self._source.instances.get_file(orthanc_id), True
 
         except ResourceNotFound as ex:
             # The instance may have been deleted (by a user, a script,...) from the source between the moment
@@ -102,24 +352,28 @@ class OrthancReplicator:
             # and the moment we try to handle it. So, the source will return a 404 http error.
             # In this case, simply log the error and ack the message (don't raise the Exception)
             logger.warning(f"Unable (404) to get instance instance from source ({orthanc_id}), probably already deleted...")
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-            return
+            return None, True
         except Exception as ex:
             logger.warning(f"Unable to get instance from source ({orthanc_id}), requeueing...")
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-            return
+            return None, False
 
+    def forward_instance(self, orthanc_id: str) -> bool:  # returns True if the message can be acked
+        dicom, success = self._download_instance(orthanc_id)
+        if dicom is None:
+            return success
+
+        return self._upload_instance(orthanc_id, dicom)
+
+    def _upload_instance(self, orthanc_id: str, dicom: bytes) -> bool:
         try:
             self._destination.upload(dicom)
 
-            channel.basic_ack(delivery_tag=method.delivery_tag)
             logger.debug(f"Forwarded instance to destination ({orthanc_id}).")
-            return
+            return True
 
         except Exception as ex:
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
             logger.warning(f"Unable to upload instance to destination ({orthanc_id}), requeueing...")
-            return
+            return False
 
     def wait_orthanc_started(self):
         retry = 0
@@ -144,88 +398,20 @@ class OrthancReplicator:
     def _consume(self):
         logger.info("----- Initializing Orthanc Replicator...")
 
-        # TODO: allow multithreading?
-        # see https://blog.boot.dev/python/using-concurrent-subscribers-rabbitmq-in-python-pika/
-
         self.wait_orthanc_started()
+        self._start_workers()
 
-        # we want the replicator to retry to connect to the broker if there is a trouble...
-        while not self._stop_requested:
-            try:
+        self._transport.consume(on_message=self._dispatch,
+                                consumers_count=self._worker_threads_count,
+                                prefetch_count=self._prefetch_count)  # this blocks until stop() is called
 
-                # initialize connection to rabbitmq
-                connection = pika.BlockingConnection(self._broker_params)
-                channel = connection.channel()
-
-                # These steps should have been done in the lua, but they are idempotent
-                channel.exchange_declare(exchange="orthanc-exchange", exchange_type="direct", durable=True)
-
-                # "Main" queues
-                channel.queue_declare(queue='to-forward-queue',
-                                      durable=True,
-                                      arguments={
-                                          'x-dead-letter-exchange': 'orthanc-exchange',
-                                          'x-dead-letter-routing-key': 'standby-forward-queue'
-                                      })
-                channel.queue_declare(queue='to-delete-queue', durable=True,
-                                      arguments={
-                                          'x-dead-letter-exchange': 'orthanc-exchange',
-                                          'x-dead-letter-routing-key': 'standby-delete-queue'
-                                      })
-
-                # "Standby" queues (messages are waiting there is they were nacked)
-                channel.queue_declare(queue='standby-delete-queue', durable=True,
-                                      arguments={
-                                          'x-message-ttl': 10000,
-                                          'x-dead-letter-exchange': 'orthanc-exchange',
-                                          'x-dead-letter-routing-key': 'to-delete-queue'
-                                      })
-                channel.queue_declare(queue='standby-forward-queue', durable=True,
-                                      arguments={
-                                          'x-message-ttl': 10000,
-                                          'x-dead-letter-exchange': 'orthanc-exchange',
-                                          'x-dead-letter-routing-key': 'to-forward-queue'
-                                      })
-
-                channel.queue_bind(exchange="orthanc-exchange", queue="to-forward-queue", routing_key="to-forward-queue")
-                channel.queue_bind(exchange="orthanc-exchange", queue="to-delete-queue", routing_key="to-delete-queue")
-                channel.queue_bind(exchange="orthanc-exchange", queue="standby-delete-queue", routing_key="standby-delete-queue")
-                channel.queue_bind(exchange="orthanc-exchange", queue="standby-forward-queue", routing_key="standby-forward-queue")
-
-                channel.basic_consume(queue='to-forward-queue', on_message_callback=self.to_forward_callback)
-                channel.basic_consume(queue='to-delete-queue', on_message_callback=self.to_delete_callback)
-
-                # we declare a "stop-queue" which allows to gracefully stop the connection with rabbitmq
-                channel.queue_declare(queue='stop-queue')
-                channel.queue_bind(exchange="orthanc-exchange", queue="stop-queue", routing_key="stop-queue")
-                channel.basic_consume(queue='stop-queue', on_message_callback=self.stop_callback, auto_ack=True)
-
-                logger.info("Broker connection configured, waiting for messages...")
-                channel.start_consuming() # this never ends
-
-                channel.stop_consuming()
-                connection.close()
-
-            except Exception as e:
-                logger.info("Broker consuming error, will retry soon...")
-                time.sleep(1)
-
-    def stop_callback(self, channel, method, properties, body):
-        channel.stop_consuming()
-        channel.close()
-
-        logger.info("Broker connection stop requested...")
+        self._stop_workers()
+        if self._download_pool:
+            self._download_pool.shutdown(wait=True)
 
     def stop(self):
         logger.info("Stopping Replicator...")
-        self._stop_requested = True
-
-        connection = pika.BlockingConnection(self._broker_params)
-        channel = connection.channel()
-
-        channel.basic_publish(exchange='orthanc-exchange', routing_key='stop-queue', body="stop")
-
-        connection.close()
+        self._transport.stop()
 
     def execute(self):
         self._consuming_thread = threading.Thread(target=self._consume)
@@ -256,7 +442,11 @@ if __name__ == '__main__':
     parser.add_argument('--broker_user', type=str, default='rabbit', help='Broker user name')
     parser.add_argument('--broker_pwd', type=str, default='123456', help='Broker password')
     parser.add_argument('--broker_port', type=int, default=5672, help='Broker port nr')
-    #parser.add_argument('--worker_threads_count', type=int, default=1, help='Number of worker threads')
+    parser.add_argument('--worker_threads_count', type=int, default=1, help='Number of worker threads')
+    parser.add_argument('--prefetch_count', type=int, default=10, help='Maximum number of unacknowledged messages per worker thread')
+    parser.add_argument('--forward_batch_size', type=int, default=1, help='Maximum number of instances forwarded together (must not be greater than prefetch_count)')
+    parser.add_argument('--forward_batch_timeout_in_ms', type=int, default=100, help='Maximum delay to wait for a batch to be complete')
+    parser.add_argument('--coalescing_window_in_ms', type=int, default=0, help='Delay during which messages are held to cancel forward/delete pairs and group the deletes')
 
     args = parser.parse_args()
 
@@ -275,27 +465,36 @@ if __name__ == '__main__':
     broker_pwd = os.environ.get("BROKER_PWD", args.broker_pwd)
     broker_port = int(os.environ.get("BROKER_PORT", args.broker_port))
     
-    #worker_threads_count = int(os.environ.get("WORKER_THREADS_COUNT", str(args.worker_threads_count)))
+    worker_threads_count = int(os.environ.get("WORKER_THREADS_COUNT", str(args.worker_threads_count)))
+    prefetch_count = int(os.environ.get("PREFETCH_COUNT", str(args.prefetch_count)))
+    forward_batch_size = int(os.environ.get("FORWARD_BATCH_SIZE", str(args.forward_batch_size)))
+    forward_batch_timeout_in_ms = int(os.environ.get("FORWARD_BATCH_TIMEOUT_IN_MS", str(args.forward_batch_timeout_in_ms)))
+    coalescing_window_in_ms = int(os.environ.get("COALESCING_WINDOW_IN_MS", str(args.coalescing_window_in_ms)))
 
     broker_connection_parameters = pika.ConnectionParameters(broker_url, broker_port, credentials=pika.PlainCredentials(broker_user, broker_pwd))
 
     destination = None
     if dest_api_key is not None:
-        destination=OrthancApiClient(dest_url, headers={"api-key":dest_api_key})
+        destination=OrthancApiClient(dest_url, headers={"api-key":dest_api_key}, pool_maxsize=max(10, worker_threads_count), pool_block=True)
     else:
-        destination=OrthancApiClient(dest_url, user=dest_user, pwd=dest_pwd)
+        destination=OrthancApiClient(dest_url, user=dest_user, pwd=dest_pwd, pool_maxsize=max(10, worker_threads_count), pool_block=True)
     
     source = None
     if source_api_key is not None:
-        source=OrthancApiClient(source_url, headers={"api-key":source_api_key})
+        source=OrthancApiClient(source_url, headers={"api-key":source_api_key}, pool_maxsize=max(10, worker_threads_count + forward_batch_size), pool_block=True)
     else:
-        source=OrthancApiClient(source_url, user=source_user, pwd=source_pwd)
+        source=OrthancApiClient(source_url, user=source_user, pwd=source_pwd, pool_maxsize=max(10, worker_threads_count + forward_batch_size), pool_block=True)
 
 
     replicator = OrthancReplicator(
         source=source,
         destination=destination,
-        broker_params=broker_connection_parameters
+        broker_params=broker_connection_parameters,
+        worker_threads_count=worker_threads_count,
+        prefetch_count=prefetch_count,
+        forward_batch_size=forward_batch_size,
+        forward_batch_timeout_in_ms=forward_batch_timeout_in_ms,
+        coalescing_window_in_ms=coalescing_window_in_ms
     )
 
     replicator.execute()
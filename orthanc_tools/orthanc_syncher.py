@@ -1,18 +1,51 @@
 import os, time
+import json
 import logging
 import argparse
 import tempfile
 import datetime
-from typing import List
+import threading
+import queue
+from dataclasses import dataclass
+from typing import List, Optional
+from strenum import StrEnum
 
 from .helpers.scheduler import Scheduler
+from .helpers.orthanc_snapshot import OrthancSnapshot, StudySummary, get_study_summary, get_study_content
 from orthanc_api_client import helpers
 import logging
-from orthanc_api_client import OrthancApiClient
+from orthanc_api_client import OrthancApiClient, ResourceType
 import schedule
 
 logger = logging.getLogger(__name__)
 
+
+class SyncherTransferMode(StrEnum):
+    FILES = 'files'             # download each instance and upload it to the other Orthanc (through the syncher)
+    ZIP = 'zip'                 # download the instances by zip archives and upload the archives to the other Orthanc (through the syncher)
+    PEERING = 'peering'         # use peering between the 2 orthancs (the data does not go through the syncher)
+    TRANSFER = 'transfer'       # use the transfer plugin accelerator between the 2 orthancs (the data does not go through the syncher)
+
+
+@dataclass
+class SyncherBatch:
+    index: int
+    cursor: datetime.datetime               # the LastUpdate of the last study of the batch
+    pending_transfers_count: int = 0        # the transfers scheduled while comparing the batch that are not completed yet (including the retries)
+
+
+@dataclass
+class SyncherTransfer:
+    orthanc_source: OrthancApiClient
+    orthanc_destination: OrthancApiClient
+    study_id: str
+    resources_ids: List[str]
+    resource_type: ResourceType = ResourceType.INSTANCE   # the level of the resources (a whole study, some series or some instances)
+    retry_count: int = 0
+    next_retry: float = 0
+    batch: Optional[SyncherBatch] = None                  # the batch the transfer has been scheduled for
+
+
 class OrthancSyncher:
     '''
     ## Goal
@@ -42,22 +75,50 @@ class OrthancSyncher:
     First run to process the studies from Orthanc-1;
     Second run to process the studies from Orthanc-2.
 
-    Each run will:
-    - Get the list of all studies (by batches of 100)
-    - For each study:
-        - read the `LastUpdate` value
-        - if `LastUpdate` < `LastProcessedLastUpdate`:
-            - end of run.
+    Both runs are executed concurrently and share a snapshot of each Orthanc:
+    - Get the list of all studies with their series/instances counts (by batches of 100) until
+      `LastUpdate` < `LastProcessedLastUpdate`.  Each Orthanc is listed only once.
+    - If there are many studies to check, list all the studies of the other Orthanc too (otherwise, the studies
+      are looked up one by one)
+
+    Each run will then:
+    - For each study (a study that has been updated in both Orthanc is handled only once for both runs):
         - if the study is not present in the other Orthanc:
             - send the study to the other Orthanc
-        - else for each series of the study:
-            - if the series is not present in the other Orthanc:
-                - send the series to the other Orthanc
-            - else for each instance of the series:
-                - if the instance is not present in the other Orthanc:
-                    - send the instance to the other Orthanc
+        - else, if the series/instances counts are the same in both Orthanc:
+            - the study is considered as identical
+        - else, get the list of series and instances of the study from both Orthanc (one request on each side):
+            - send the series that are not present in the other Orthanc (in both directions)
+            - send the instances that are not present in the other Orthanc (in both directions, if level is 'Instance')
+
+    The comparison and the transfers run concurrently: the comparison feeds a bounded queue of transfers that are
+    performed by `transfer_threads_count` threads.  A failed transfer is retried later on (without blocking the
+    other transfers).  If a scheduler is provided, the transfers are paused outside the allowed periods.
+
+    ## Transfer modes
+    - `files` (default): each instance is downloaded from one Orthanc and uploaded to the other one.
+    - `zip`: the instances are downloaded by zip archives of `zip_batch_size` instances and each archive is uploaded
+      in a single request.
+    - `peering`: the source Orthanc sends the resources to the other Orthanc (declared as a peer, see
+      `peer_alias_1` and `peer_alias_2`).
+    - `transfer`: same as `peering` but through the transfers accelerator plugin (compressed, multiple connections).
+      This requires the plugin to be loaded in both Orthanc, otherwise, the syncher falls back to `files`.
+    With `peering` and `transfer`, the data does not go through the syncher and a missing study/series is sent as
+    a whole.
+
+    ## Checkpoints
+    The studies are processed by batches of `orthanc_queries_batch_size`.  If a `persist_status_path` is provided,
+    the progress of each run (the LastUpdate cursor and the batch index) is saved in a checkpoint file
+    (`persist_status_path` + '.checkpoint') once all the transfers of a batch (and of the previous ones) are
+    completed.  The comparison does not wait for the transfers: the checkpoint simply lags behind while some
+    transfers are still pending or waiting for a retry.  If the process is interrupted, the next execution
+    resumes the runs from their checkpoints instead of starting over.
+    A study that can not be synched (after all retries) is quarantined: it is written in `error_log_file_path`
+    and the run goes on.
     '''
 
+    retry_delays = [5, 20, 60, 300, 900]    # delays between the retries of a failed transfer
+
     def __init__(self,
                  api_client_1: OrthancApiClient,
                  api_client_2: OrthancApiClient,
@@ -69,12 +130,21 @@ class OrthancSyncher:
                  run_till_last_update_2: datetime.datetime = None,
                  execution_time: str = None,
                  execution_day: str = None,
-                 orthanc_queries_batch_size: int = 100
+                 orthanc_queries_batch_size: int = 100,
+                 transfer_threads_count: int = 4,       # the number of threads transferring the missing instances
+                 transfer_queue_size: int = 100,        # the maximum number of transfers waiting to be performed
+                 transfer_mode: SyncherTransferMode = SyncherTransferMode.FILES,
+                 peer_alias_1: str = None,              # the alias of Orthanc-1 in the peers of Orthanc-2 (for the 'peering' and 'transfer' modes)
+                 peer_alias_2: str = None,              # the alias of Orthanc-2 in the peers of Orthanc-1 (for the 'peering' and 'transfer' modes)
+                 zip_batch_size: int = 100              # the maximum number of instances per zip archive (for the 'zip' mode)
                  ):
 
         if level not in ["Study", "Series", "Instance"]:
             raise RuntimeError("Invalid value for argument 'level'")
 
+        if transfer_mode in [SyncherTransferMode.PEERING, SyncherTransferMode.TRANSFER] and (peer_alias_1 is None or peer_alias_2 is None):
+            raise RuntimeError(f"Arguments 'peer_alias_1' and 'peer_alias_2' are required for transfer mode '{transfer_mode}'")
+
         self._api_client_1 = api_client_1
         self._api_client_2 = api_client_2
         self._scheduler = scheduler
@@ -82,7 +152,13 @@ class OrthancSyncher:
         self._error_log_file_path = error_log_file_path
         self._persist_status_path = persist_status_path
 
-        self._current_run = "unknown"
+        self._handled_studies = set()       # the studies that have already been handled by one of the 2 concurrent runs
+        self._handled_studies_lock = threading.Lock()
+
+        self._checkpoints = {}              # run index -> progress of the run (see _save_checkpoint)
+        self._checkpoints_lock = threading.Lock()
+        self._quarantined_studies = set()
+        self._quarantine_lock = threading.Lock()
 
         # first, we get the `run till` value from the file...
         if self._persist_status_path is not None:
@@ -111,6 +187,17 @@ class OrthancSyncher:
 
         self._batch_size = orthanc_queries_batch_size
 
+        self._transfer_threads_count = transfer_threads_count
+        self._transfers_queue = queue.Queue(maxsize=transfer_queue_size)
+        self._transfer_threads = []
+        self._transfers_to_retry = []
+        self._transfers_condition = threading.Condition()
+
+        self._transfer_mode = transfer_mode
+        self._peer_alias_1 = peer_alias_1
+        self._peer_alias_2 = peer_alias_2
+        self._zip_batch_size = zip_batch_size
+
     def _read_status_from_file(self):
         """
         The file should contain something like that:
@@ -153,64 +240,185 @@ class OrthancSyncher:
                 schedule.run_pending()
                 time.sleep(1)
 
-    def _execute(self):
-        # First run (Orthanc-1 studies are processed and pushed to Orthanc-2 if needed)
-
-        self._current_run = "1 -> 2"
-        logger.info(f"Starting run 1 ({self._current_run})...")
+    def _check_transfer_mode(self):
+        if self._transfer_mode == SyncherTransferMode.TRANSFER:
+            if not self._api_client_1.has_loaded_plugin("transfers") or not self._api_client_2.has_loaded_plugin("transfers"):
+                logger.warning("The transfers plugin is not loaded in both Orthanc, falling back to 'files' transfer mode")
+                self._transfer_mode = SyncherTransferMode.FILES
 
-        self._run_till_last_update_1 = self.synch(
-            orthanc_source=self._api_client_1,
-            orthanc_destination=self._api_client_2,
-            last_update_limit=self._run_till_last_update_1
+    def _execute(self):
+        self._check_transfer_mode()
+
+        # list the content of both Orthanc only once (concurrently)
+        snapshot_1 = OrthancSnapshot(api_client=self._api_client_1, batch_size=self._batch_size)
+        snapshot_2 = OrthancSnapshot(api_client=self._api_client_2, batch_size=self._batch_size)
+        self._run_concurrently(
+            lambda: snapshot_1.load(last_update_limit=self._run_till_last_update_1),
+            lambda: snapshot_2.load(last_update_limit=self._run_till_last_update_2)
         )
 
-        if self._persist_status_path is not None:
-            self.save_last_update_limit(self._run_till_last_update_1, 0)
+        # if there are many studies to check, it is faster to list the other Orthanc completely than to look up each study
+        self._run_concurrently(
+            lambda: self.complete_snapshot_if_needed(snapshot_2, studies_to_check_count=len(snapshot_1.get_studies_updated_since(self._run_till_last_update_1))),
+            lambda: self.complete_snapshot_if_needed(snapshot_1, studies_to_check_count=len(snapshot_2.get_studies_updated_since(self._run_till_last_update_2)))
+        )
 
-        # Second run (Orthanc-2 studies are processed and pushed to Orthanc-1 if needed)
+        self._handled_studies = set()
+        self._quarantined_studies = set()
+        self._checkpoints = self._read_checkpoints()
+        new_last_update_limits = [None, None]
+
+        def run_1():
+            # First run (Orthanc-1 studies are processed and pushed to Orthanc-2 if needed)
+            logger.info("Starting run 1 (1 -> 2)...")
+            new_last_update_limits[0] = self.synch(
+                orthanc_source=self._api_client_1,
+                orthanc_destination=self._api_client_2,
+                last_update_limit=self._run_till_last_update_1,
+                run_name="1 -> 2",
+                source_snapshot=snapshot_1,
+                destination_snapshot=snapshot_2,
+                checkpoint_index=0
+            )
+
+        def run_2():
+            # Second run (Orthanc-2 studies are processed and pushed to Orthanc-1 if needed)
+            logger.info("Starting run 2 (2 -> 1)...")
+            new_last_update_limits[1] = self.synch(
+                orthanc_source=self._api_client_2,
+                orthanc_destination=self._api_client_1,
+                last_update_limit=self._run_till_last_update_2,
+                run_name="2 -> 1",
+                source_snapshot=snapshot_2,
+                destination_snapshot=snapshot_1,
+                checkpoint_index=1
+            )
+
+        # both runs share the same transfer threads
+        self._start_transfer_threads()
+        try:
+            self._run_concurrently(run_1, run_2)
+        finally:
+            self._stop_transfer_threads()
 
-        self._current_run = "2 -> 1"
-        logger.info(f"Starting run 2 ({self._current_run})...")
+        self._run_till_last_update_1, self._run_till_last_update_2 = new_last_update_limits
 
-        self._run_till_last_update_2 = self.synch(
-            orthanc_source=self._api_client_2,
-            orthanc_destination=self._api_client_1,
-            last_update_limit=self._run_till_last_update_2
-        )
         if self._persist_status_path is not None:
+            self.save_last_update_limit(self._run_till_last_update_1, 0)
             self.save_last_update_limit(self._run_till_last_update_2, 1)
+            self._clear_checkpoints()
 
-    def synch(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, last_update_limit: datetime.datetime) -> datetime.datetime:
+        if len(self._quarantined_studies) > 0:
+            logger.warning(f"{len(self._quarantined_studies)} studies could not be synched and have been quarantined")
 
-        index=0
-        while True:
-            # Get a batch of studies
-            studies = self.get_studies(orthanc_client=orthanc_source, batch_size=self._batch_size, index=index)
+    def _run_concurrently(self, *functions):
+        errors = []
 
-            logger.info(f"[{self._current_run}] Processing batch index {index}...")
-
-            if index == 0:
-                new_last_update_limit = studies[0].last_update
-
-            for study in studies:
-                if study.last_update >= last_update_limit:
-                    self.compare_studies(orthanc_source, orthanc_destination, study.orthanc_id)
-                else:
-                    # the current study LastUpdate value is older than the most recent value checked during the last run, so it's over
-                    # let's return the new_last_update_limit
-
-                    logger.info(f"[{self._current_run}] Reached the 'LastUpdate' value already processed during last run, end of this run!")
-                    return new_last_update_limit
-
-            if len(studies) < self._batch_size:
-                # if the actual batch size is less than the expected, all studies have been processed --> stop
-                logger.info(f"[{self._current_run}] Processed all studies, end of this run!")
-                return new_last_update_limit
-
-            else:
-                # if not, let's fetch the next batch
-                index = index + self._batch_size
+        def run(function):
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(f,), name=f"Syncher run thread {i}") for i, f in enumerate(functions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def synch(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, last_update_limit: datetime.datetime,
+              run_name: str = "1 -> 2", source_snapshot: OrthancSnapshot = None, destination_snapshot: OrthancSnapshot = None,
+              checkpoint_index: int = None) -> datetime.datetime:
+
+        if source_snapshot is None:
+            source_snapshot = OrthancSnapshot(api_client=orthanc_source, batch_size=self._batch_size)
+            source_snapshot.load(last_update_limit=last_update_limit)
+
+        source_studies = source_snapshot.get_studies_updated_since(last_update_limit)
+        if len(source_studies) == 0:
+            logger.info(f"[{run_name}] No studies to process, end of this run!")
+            return last_update_limit
+
+        new_last_update_limit = source_studies[0].last_update
+
+        # resume from the checkpoint of an interrupted run (if any)
+        first_batch_index = 0
+        checkpoint = self._get_checkpoint(checkpoint_index, last_update_limit)
+        if checkpoint is not None:
+            first_batch_index = checkpoint["batch_index"]
+            checkpoint_new_last_update_limit = self._parse_datetime(checkpoint["new_last_update_limit"])
+            checkpoint_cursor = self._parse_datetime(checkpoint["cursor"])
+
+            # skip the studies that have been processed before the interruption (but not those that have been updated since)
+            source_studies = [s for s in source_studies if s.last_update >= checkpoint_new_last_update_limit or s.last_update <= checkpoint_cursor]
+            logger.info(f"[{run_name}] Resuming from checkpoint at batch {first_batch_index} (LastUpdate {checkpoint['cursor']}), {len(source_studies)} studies left to process")
+
+        if destination_snapshot is None:
+            destination_snapshot = OrthancSnapshot(api_client=orthanc_destination, batch_size=self._batch_size)
+            self.complete_snapshot_if_needed(destination_snapshot, studies_to_check_count=len(source_studies))
+
+        owns_transfer_threads = len(self._transfer_threads) == 0
+        if owns_transfer_threads:
+            self._start_transfer_threads()
+        try:
+            identical_count = 0
+            in_flight_batches = []  # the batches of this run whose transfers are not all completed yet (in order)
+            for i in range(0, len(source_studies), self._batch_size):
+                batch = source_studies[i:i + self._batch_size]
+                syncher_batch = SyncherBatch(index=first_batch_index + i // self._batch_size, cursor=batch[-1].last_update)
+                in_flight_batches.append(syncher_batch)
+
+                for study in batch:
+                    # a study that has been updated on both sides is handled only once, in both directions
+                    with self._handled_studies_lock:
+                        if study.orthanc_id in self._handled_studies:
+                            continue
+                        self._handled_studies.add(study.orthanc_id)
+
+                    try:
+                        if self.compare_studies(orthanc_source, orthanc_destination, study.orthanc_id,
+                                                source_study=study, destination_study=destination_snapshot.get(study.orthanc_id),
+                                                bidirectional=True, batch=syncher_batch):
+                            identical_count += 1
+                    except Exception as e:
+                        self._quarantine_study(study.orthanc_id, f"Error while comparing the study: {str(e)}")
+
+                # the checkpoint can only move forward once all the transfers of the previous batches are completed
+                # (the comparison goes on meanwhile)
+                self._checkpoint_completed_batches(in_flight_batches, checkpoint_index, last_update_limit, new_last_update_limit, run_name)
+
+            # the run ends once all its transfers are completed
+            self._checkpoint_completed_batches(in_flight_batches, checkpoint_index, last_update_limit, new_last_update_limit, run_name, wait=True)
+        finally:
+            if owns_transfer_threads:
+                self._stop_transfer_threads()
+
+        logger.info(f"[{run_name}] Processed {len(source_studies)} studies ({identical_count} identical), end of this run!")
+        return new_last_update_limit
+
+    def _checkpoint_completed_batches(self, in_flight_batches: List[SyncherBatch], checkpoint_index: Optional[int], last_update_limit: datetime.datetime,
+                                      new_last_update_limit: datetime.datetime, run_name: str, wait: bool = False):
+        last_completed_batch = None
+        with self._transfers_condition:
+            if wait:
+                self._transfers_condition.wait_for(lambda: all(b.pending_transfers_count == 0 for b in in_flight_batches))
+
+            while len(in_flight_batches) > 0 and in_flight_batches[0].pending_transfers_count == 0:
+                last_completed_batch = in_flight_batches.pop(0)
+
+        if last_completed_batch is None:
+            return
+
+        self._save_checkpoint(checkpoint_index, last_update_limit, new_last_update_limit, cursor=last_completed_batch.cursor, batch_index=last_completed_batch.index + 1)
+        logger.info(f"[{run_name}] Batches up to {last_completed_batch.index} completed")
+
+    def complete_snapshot_if_needed(self, snapshot: OrthancSnapshot, studies_to_check_count: int):
+        # listing all studies costs one request per batch while looking up the studies costs one request per study
+        if not snapshot.is_complete and studies_to_check_count * self._batch_size >= snapshot.api_client.get_statistics().studies_count:
+            snapshot.load()
 
     def save_last_update_limit(self, new_last_update_value: datetime.datetime, index: int):
         try:
@@ -222,75 +430,287 @@ class OrthancSyncher:
             last_update_strings[index] = datetime.datetime.strftime(new_last_update_value, "%Y-%m-%d %H:%M:%S")
 
             # write file
-            with open(self._persist_status_path, 'w') as f:
-                f.writelines(line + '\n' for line in last_update_strings)
+            self._write_file_atomically(self._persist_status_path, ''.join(line + '\n' for line in last_update_strings))
 
         except (ValueError, FileNotFoundError):
             logger.error("Could not write LastUpdate values to file!")
-            exit(0)
 
-    def compare_studies(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, orthanc_study_id):
-        # check if study is in distant Orthanc
-        if not orthanc_destination.studies.exists(orthanc_study_id):
-            # if not there, transfer it
-            instances_ids = orthanc_source.studies.get_instances_ids(orthanc_study_id)
-            self.transfer_instances(orthanc_source, orthanc_destination, instances_ids)
-
-        # study is there, let's check series/instances according to level
-        elif self._level != "Study":
-            source_series = orthanc_source.studies.get_series_ids(orthanc_study_id)
-            for series_id in source_series:
-                if not orthanc_destination.series.exists(series_id):
-                    # this series is not in destination, transfer it
-                    instances_ids = orthanc_source.series.get_instances_ids(series_id)
-                    self.transfer_instances(orthanc_source, orthanc_destination, instances_ids)
-                # series is there, let's check instances according to level
-                elif self._level == "Instance":
-                    source_instances = orthanc_source.series.get_instances_ids(series_id)
-                    for instance_id in source_instances:
-                        if not orthanc_destination.instances.exists(instance_id):
-                            self.transfer_instances(orthanc_source, orthanc_destination, [instance_id])
+    @staticmethod
+    def _format_datetime(value: datetime.datetime) -> str:
+        return datetime.datetime.strftime(value, "%Y-%m-%d %H:%M:%S")
 
+    @staticmethod
+    def _parse_datetime(value: str) -> datetime.datetime:
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
 
-    def transfer_instances(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, instances_ids: List[str]):
+    @staticmethod
+    def _write_file_atomically(path: str, content: str):
+        # first write to a temp file and then move the file such that the file is never left half-written
+        tmp = path + ".tmp"
+        with open(tmp, "wt") as f:
+            f.write(content)
+        os.replace(tmp, path)  # this is an 'atomic' operation
 
-        retry_count = 0
-        retry_delays = [5, 20, 60, 300, 900, 1800, 3600, 7200]
+    def _get_checkpoint_path(self) -> Optional[str]:
+        if self._persist_status_path is None:
+            return None
+        return self._persist_status_path + ".checkpoint"
 
-        while retry_count <= 5:
-            if retry_count >= 1:
-                delay = retry_delays[retry_count - 1]
-                logger.info(f"waiting {delay} seconds before retrying transfer for resource from study {orthanc_source.instances.get_parent_study_id(instances_ids[0])}")
-                time.sleep(delay)
+    def _read_checkpoints(self) -> dict:
+        checkpoint_path = self._get_checkpoint_path()
+        if checkpoint_path is None or not os.path.exists(checkpoint_path):
+            return {}
 
+        try:
+            with open(checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the checkpoint file, the runs will start over: {str(e)}")
+            return {}
+
+    def _get_checkpoint(self, checkpoint_index: Optional[int], last_update_limit: datetime.datetime) -> Optional[dict]:
+        if checkpoint_index is None:
+            return None
+
+        with self._checkpoints_lock:
+            checkpoint = self._checkpoints.get(str(checkpoint_index))
+
+        # a checkpoint is only valid for the run it has been saved for
+        if checkpoint is None or checkpoint["last_update_limit"] != self._format_datetime(last_update_limit):
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint_index: Optional[int], last_update_limit: datetime.datetime, new_last_update_limit: datetime.datetime,
+                         cursor: datetime.datetime, batch_index: int):
+        checkpoint_path = self._get_checkpoint_path()
+        if checkpoint_index is None or checkpoint_path is None:
+            return
+
+        with self._checkpoints_lock:
+            self._checkpoints[str(checkpoint_index)] = {
+                "last_update_limit": self._format_datetime(last_update_limit),              # the limit of the run
+                "new_last_update_limit": self._format_datetime(new_last_update_limit),      # the most recent study of the run
+                "cursor": self._format_datetime(cursor),                                    # all studies updated between the cursor and new_last_update_limit have been processed
+                "batch_index": batch_index
+            }
             try:
-                for instance_id in instances_ids:
-                    data = orthanc_source.instances.get_file(instance_id)
-                    orthanc_destination.upload(data)
+                self._write_file_atomically(checkpoint_path, json.dumps(self._checkpoints))
+            except OSError as e:
+                logger.error(f"Could not write the checkpoint file: {str(e)}")
+
+    def _clear_checkpoints(self):
+        checkpoint_path = self._get_checkpoint_path()
+        with self._checkpoints_lock:
+            self._checkpoints = {}
+            if checkpoint_path is not None and os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
+    def _quarantine_study(self, study_id: str, reason: str):
+        # the study is skipped for this run and logged in the error file such that it can be handled manually
+        logger.error(f"Quarantining study {study_id}: {reason}")
+
+        with self._quarantine_lock:
+            if study_id in self._quarantined_studies:
+                return
+            self._quarantined_studies.add(study_id)
+
+            if self._error_log_file_path is not None:
+                try:
+                    with open(self._error_log_file_path, "at") as f:
+                        f.write(f"{study_id}\n")
+                except OSError as e:
+                    logger.error(f"Could not write to the error log file: {str(e)}")
+
+    def get_quarantined_studies(self) -> List[str]:
+        with self._quarantine_lock:
+            return sorted(self._quarantined_studies)
+
+    def compare_studies(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, orthanc_study_id,
+                        source_study: StudySummary = None, destination_study: StudySummary = None,
+                        bidirectional: bool = False, batch: SyncherBatch = None) -> bool:  # returns True if the study was identical
+        if source_study is None:
+            source_study = get_study_summary(orthanc_source, orthanc_study_id)
+        if destination_study is None:
+            destination_study = get_study_summary(orthanc_destination, orthanc_study_id)
+
+        # check if study is in distant Orthanc
+        if destination_study is None:
+            # if not there, transfer it
+            self.schedule_transfer(orthanc_source, orthanc_destination, orthanc_study_id, [orthanc_study_id], ResourceType.STUDY, batch=batch)
+            return False
+
+        if self._level == "Study":
+            return True
+
+        # if the counts are the same, there is no need to go deeper
+        if source_study.series_count == destination_study.series_count \
+                and (self._level == "Series" or source_study.instances_count == destination_study.instances_count):
+            return True
+
+        # study is there but differs, let's check series/instances according to level
+        source_content = get_study_content(orthanc_source, orthanc_study_id)
+        destination_content = get_study_content(orthanc_destination, orthanc_study_id)
+
+        self._schedule_missing_content(orthanc_source, orthanc_destination, orthanc_study_id, source_content, destination_content, batch)
+
+        if bidirectional:
+            # since we have the content of both sides, also transfer what is missing in the source
+            self._schedule_missing_content(orthanc_destination, orthanc_source, orthanc_study_id, destination_content, source_content, batch)
+
+        return False
+
+    def _schedule_missing_content(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, orthanc_study_id: str,
+                                  source_content, destination_content, batch: SyncherBatch = None):
+        # the series that are not in destination are transferred as a whole
+        missing_series_ids = sorted(series_id for series_id in source_content.keys() if series_id not in destination_content)
+        if len(missing_series_ids) > 0:
+            self.schedule_transfer(orthanc_source, orthanc_destination, orthanc_study_id, missing_series_ids, ResourceType.SERIES, batch=batch)
+
+        # series are there, let's check instances according to level
+        if self._level == "Instance":
+            missing_instances_ids = set()
+            for series_id, source_instances_ids in source_content.items():
+                if series_id in destination_content:
+                    missing_instances_ids.update(source_instances_ids - destination_content[series_id])
+            if len(missing_instances_ids) > 0:
+                self.schedule_transfer(orthanc_source, orthanc_destination, orthanc_study_id, sorted(missing_instances_ids), batch=batch)
+
+    def schedule_transfer(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, study_id: str, resources_ids: List[str],
+                          resource_type: ResourceType = ResourceType.INSTANCE, batch: SyncherBatch = None):
+        transfer = SyncherTransfer(orthanc_source=orthanc_source, orthanc_destination=orthanc_destination, study_id=study_id,
+                                   resources_ids=resources_ids, resource_type=resource_type, batch=batch)
+
+        if len(self._transfer_threads) == 0:  # not running in the transfer pipeline (e.g. compare_studies called directly)
+            self.transfer_resources(transfer)
+            return
+
+        if batch is not None:
+            with self._transfers_condition:
+                batch.pending_transfers_count += 1
+        self._transfers_queue.put(transfer)  # blocks while the queue is full
+
+    def _get_next_transfer(self) -> Optional[SyncherTransfer]:
+        while True:
+            # the transfers to retry have priority once their delay has expired
+            with self._transfers_condition:
+                now = time.time()
+                due_transfers = [t for t in self._transfers_to_retry if t.next_retry <= now]
+                if len(due_transfers) > 0:
+                    self._transfers_to_retry.remove(due_transfers[0])
+                    return due_transfers[0]
+                timeout = min([t.next_retry - now for t in self._transfers_to_retry] + [1])
+
+            try:
+                return self._transfers_queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+
+    def _process_transfers(self, thread_id: int):
+        logger.debug(f"Starting Syncher transfer thread {thread_id}")
 
+        while True:
+            transfer = self._get_next_transfer()
+            if transfer is None:  # sent by _stop_transfer_threads()
                 break
 
+            if self._scheduler is not None:
+                self._scheduler.wait_right_time_to_run()
+
+            try:
+                self.transfer_resources(transfer)
+                self._complete_transfer(transfer)
+
             except Exception as e:
-                if retry_count == 5:
-                    logger.error(f"Error while transfering a resource from this study: {orthanc_source.instances.get_parent_study_id(instances_ids[0])}. Exception: {str(e)}")
-                    exit(0)
+                if transfer.retry_count >= len(self.retry_delays):
+                    self._quarantine_study(transfer.study_id, f"Error while transfering a resource from this study. Exception: {str(e)}")
+                    self._complete_transfer(transfer)
                 else:
-                    retry_count += 1
-                    logger.warning(f"Error while transfering a resource from this study: {orthanc_source.instances.get_parent_study_id(instances_ids[0])}. Exception: {str(e)}")
-
-    def get_studies(self, orthanc_client: OrthancApiClient, batch_size: int, index: int):
-        return orthanc_client.studies.find(
-            query={},
-            limit = batch_size,
-            since = index,
-            order_by = [
-                {
-                    "Type": "Metadata",
-                    "Key": "LastUpdate",
-                    "Direction": "DESC"
-                }
-            ]
-        )
+                    delay = self.retry_delays[transfer.retry_count]
+                    logger.warning(f"Error while transfering a resource from this study: {transfer.study_id}, will retry in {delay} seconds. Exception: {str(e)}")
+                    transfer.retry_count += 1
+                    transfer.next_retry = time.time() + delay
+                    with self._transfers_condition:
+                        self._transfers_to_retry.append(transfer)
+
+        logger.debug(f"Stopping Syncher transfer thread {thread_id}")
+
+    def _complete_transfer(self, transfer: SyncherTransfer):
+        if transfer.batch is None:
+            return
+
+        with self._transfers_condition:
+            transfer.batch.pending_transfers_count -= 1
+            self._transfers_condition.notify_all()
+
+    def _start_transfer_threads(self):
+        self._transfer_threads = [threading.Thread(
+            target=self._process_transfers,
+            name=f"Syncher transfer thread {thread_id}",
+            args=(thread_id,)
+        ) for thread_id in range(0, self._transfer_threads_count)]
+
+        for t in self._transfer_threads:
+            t.start()
+
+    def _stop_transfer_threads(self):
+        for t in self._transfer_threads:
+            self._transfers_queue.put(None)
+        for t in self._transfer_threads:
+            t.join()
+        self._transfer_threads = []
+
+    def transfer_resources(self, transfer: SyncherTransfer):
+        if self._transfer_mode == SyncherTransferMode.PEERING:
+            transfer.orthanc_source.peers.send(
+                target_peer=self._get_peer_alias(transfer.orthanc_destination),
+                resources_ids=transfer.resources_ids
+            )
+
+        elif self._transfer_mode == SyncherTransferMode.TRANSFER:
+            transfer.orthanc_source.transfers.send(
+                target_peer=self._get_peer_alias(transfer.orthanc_destination),
+                resources_ids=transfer.resources_ids,
+                resource_type=transfer.resource_type
+            )
+
+        else:
+            # the data goes through the syncher -> we need the instances ids
+            instances_ids = self._get_instances_ids(transfer.orthanc_source, transfer.resources_ids, transfer.resource_type)
+
+            if self._transfer_mode == SyncherTransferMode.ZIP:
+                self.transfer_instances_by_zip(transfer.orthanc_source, transfer.orthanc_destination, instances_ids)
+            else:
+                self.transfer_instances(transfer.orthanc_source, transfer.orthanc_destination, instances_ids)
+
+    def _get_peer_alias(self, orthanc_destination: OrthancApiClient) -> str:
+        if orthanc_destination == self._api_client_1:
+            return self._peer_alias_1
+        else:
+            return self._peer_alias_2
+
+    def _get_instances_ids(self, orthanc: OrthancApiClient, resources_ids: List[str], resource_type: ResourceType) -> List[str]:
+        if resource_type == ResourceType.STUDY:
+            return [i for study_id in resources_ids for i in orthanc.studies.get_instances_ids(study_id)]
+        elif resource_type == ResourceType.SERIES:
+            return [i for series_id in resources_ids for i in orthanc.series.get_instances_ids(series_id)]
+        else:
+            return resources_ids
+
+    def transfer_instances(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, instances_ids: List[str]):
+        for instance_id in instances_ids:
+            data = orthanc_source.instances.get_file(instance_id)
+            orthanc_destination.upload(data)
+
+    def transfer_instances_by_zip(self, orthanc_source: OrthancApiClient, orthanc_destination: OrthancApiClient, instances_ids: List[str]):
+        # one request on each side for each batch of instances
+        for i in range(0, len(instances_ids), self._zip_batch_size):
+            archive = orthanc_source.post(
+                endpoint="tools/create-archive",
+                json={
+                    "Synchronous": True,
+                    "Resources": instances_ids[i:i + self._zip_batch_size]
+                }).content
+            orthanc_destination.upload(archive)
 
 
 if __name__ == '__main__':
@@ -314,6 +734,11 @@ if __name__ == '__main__':
     parser.add_argument('--level', type=str, default='Series', help='Compare resources up to Study/Series/Instance level')
     parser.add_argument('--error_log_file_path', type=str, default='/errors.log', help='Path to the file to write errors log')
     parser.add_argument('--persist_status_path', type=str, default='/status.txt', help='Path to the file to write the status')
+    parser.add_argument('--transfer_threads_count', type=int, default=4, help='Number of threads transferring the missing instances')
+    parser.add_argument('--transfer_mode', type=str, default='files', help='The way the missing resources are transferred: files, zip, peering or transfer')
+    parser.add_argument('--peer_alias_1', type=str, default=None, help='The alias of Orthanc-1 in the peers of Orthanc-2 (for peering and transfer modes)')
+    parser.add_argument('--peer_alias_2', type=str, default=None, help='The alias of Orthanc-2 in the peers of Orthanc-1 (for peering and transfer modes)')
+    parser.add_argument('--zip_batch_size', type=int, default=100, help='The maximum number of instances per zip archive (for zip mode)')
 
     parser.add_argument('--execution_time', type=str, default=None,
                         help='Enables periodic mode. The time when the periodic run will start (format: 23:30 or 23:30:14).')
@@ -338,6 +763,11 @@ if __name__ == '__main__':
 
     error_log_file_path = os.environ.get("ERROR_LOG_FILE_PATH", args.error_log_file_path)
     persist_status_path = os.environ.get("PERSIST_STATUS_PATH", args.persist_status_path)
+    transfer_threads_count = int(os.environ.get("TRANSFER_THREADS_COUNT", str(args.transfer_threads_count)))
+    transfer_mode = SyncherTransferMode(os.environ.get("TRANSFER_MODE", args.transfer_mode))
+    peer_alias_1 = os.environ.get("PEER_ALIAS_1", args.peer_alias_1)
+    peer_alias_2 = os.environ.get("PEER_ALIAS_2", args.peer_alias_2)
+    zip_batch_size = int(os.environ.get("ZIP_BATCH_SIZE", str(args.zip_batch_size)))
     
     execution_time = os.environ.get("EXECUTION_TIME", args.execution_time)
     execution_day = os.environ.get("EXECUTION_DAY", args.execution_day)
@@ -366,7 +796,12 @@ if __name__ == '__main__':
         error_log_file_path=error_log_file_path,
         persist_status_path=persist_status_path,
         execution_time=execution_time,
-        execution_day=execution_day
+        execution_day=execution_day,
+        transfer_threads_count=transfer_threads_count,
+        transfer_mode=transfer_mode,
+        peer_alias_1=peer_alias_1,
+        peer_alias_2=peer_alias_2,
+        zip_batch_size=zip_batch_size
     )
 
     syncher.execute()
@@ -9,14 +9,25 @@ import datetime
 import multiprocessing
 from orthanc_api_client import helpers
 from .helpers.scheduler import Scheduler
+from .helpers.study_date_range_splitter import StudyDateRangeSplitter
+from .helpers.migration_journal import MigrationStatus
+from .helpers.watermark_flow_controller import WatermarkFlowController
 from .dicom_migrator import DicomMigrator, Message
 
 from orthanc_api_client import OrthancApiClient
+from typing import Optional
 logger = logging.getLogger(__name__)
 
 class PacsMigrator(DicomMigrator):
     """
     Uses the DicomMigrator to migrate a range of dates.
+
+    If `max_cfind_study_count` is known, the source modality is queried by date ranges that are adapted to the
+    density of the studies (see StudyDateRangeSplitter) such that no study is lost because of a truncated C-FIND.
+    Otherwise, the dates are queried one by one.
+
+    With a `journal_path`, an interrupted migration resumes after the last date whose studies have all been
+    recorded in the journal: the pending studies are pushed again from the journal and the completed ones are skipped.
     """
 
     def __init__(self,
@@ -31,12 +42,19 @@ class PacsMigrator(DicomMigrator):
                  scheduler: Scheduler = None,
                  worker_threads_count: int = multiprocessing.cpu_count() - 1,  # by default, use all CPUs but one
                  exit_on_error: bool = False,
-                 orthanc_space_threshold: int = 0,
-                 waiting_time_for_space_threshold: int = 600, # useful for unit tests
+                 orthanc_space_threshold: int = 0,      # [MB] high watermark of the disk space used by Orthanc: above it, the transfers are paused
+                 waiting_time_for_space_threshold: int = 10,  # [s] the interval between 2 samples of the disk space used by Orthanc
+                 orthanc_space_low_threshold: int = None,     # [MB] low watermark of the disk space used by Orthanc: below it, all the workers are active (default: 80% of orthanc_space_threshold)
                  use_get_not_move: bool = False,
                  max_retries: int = 5,
                  constant_retry_delays: bool = False,
-                 error_log_path: str = None             # path to a file that will contain a CSV with the failed studies
+                 error_log_path: str = None,            # path to a file that will contain a CSV with the failed studies
+                 adaptive_concurrency: bool = False,    # adapt the number of concurrent C-MOVE/C-GET (up to worker_threads_count) to the throughput and failures of the source
+                 journal_path: str = None,              # path to a SQLite file recording the outcome of each study (to resume an interrupted migration)
+                 retry_failed_only: bool = False,       # only retry the studies that have failed according to the journal
+                 skip_existing_studies: bool = False,   # check by batches which studies are already complete at the destination and skip them
+                 destination_query_modality: str = None,  # alias of the destination modality (in this Orthanc config) to query when skip_existing_studies is enabled and the destination is a destination_aet
+                 series_expansion_threshold: int = None  # the studies with more instances are transferred series by series by all the workers
                  ):
 
         super().__init__(
@@ -52,30 +70,70 @@ class PacsMigrator(DicomMigrator):
             use_get_not_move=use_get_not_move,
             max_retries=max_retries,
             constant_retry_delays=constant_retry_delays,
-            error_log_path=error_log_path
+            error_log_path=error_log_path,
+            adaptive_concurrency=adaptive_concurrency,
+            journal_path=journal_path,
+            retry_failed_only=retry_failed_only,
+            skip_existing_studies=skip_existing_studies,
+            destination_query_modality=destination_query_modality,
+            series_expansion_threshold=series_expansion_threshold
         )
 
         self._from_study_date = from_study_date
         self._to_study_date = to_study_date
-        self._orthanc_space_threshold = orthanc_space_threshold
-        self._waiting_time_for_space_threshold = waiting_time_for_space_threshold
-
-    def wait_for_space_in_orthanc(self):
-        '''
-        At some point, we need to migrate a local PACS to a cloud Orthanc.
-        To do that, we use current class, with an Orthanc which is also a dicomweb-forwarder.
-        The problem is that the transfer from the local DICOM PACS to the forwarder is faster
-        than the transfer from the forwarder to the cloud Orthanc.
-        And so, the local server HD is full.
-        
-        Goal of this method: wait until the disk space used by Orthanc is above a threshold.
-        '''
-
-        total_disk_size_mb = self._api_client.get_statistics().total_disk_size_mb
-        while total_disk_size_mb > self._orthanc_space_threshold:
-            logger.info(f"Wait {self._waiting_time_for_space_threshold}s until Orthanc disk space used ({total_disk_size_mb}MB) is lower than {self._orthanc_space_threshold}MB")
-            time.sleep(self._waiting_time_for_space_threshold)
-            total_disk_size_mb = self._api_client.get_statistics().total_disk_size_mb
+
+        # At some point, we need to migrate a local PACS to a cloud Orthanc.
+        # To do that, we use current class, with an Orthanc which is also a dicomweb-forwarder.
+        # The problem is that the transfer from the local DICOM PACS to the forwarder is faster
+        # than the transfer from the forwarder to the cloud Orthanc.
+        # And so, the local server HD is full.
+        # -> the number of active workers is reduced as the disk space used by Orthanc grows between the watermarks
+        if orthanc_space_threshold > 0:
+            self._flow_controller = WatermarkFlowController(
+                name="Orthanc disk space",
+                get_usage=lambda: self._api_client.get_statistics().total_disk_size_mb,
+                low_watermark=orthanc_space_low_threshold if orthanc_space_low_threshold is not None else 0.8 * orthanc_space_threshold,
+                high_watermark=orthanc_space_threshold,
+                max_active_count=worker_threads_count,
+                sampling_interval=waiting_time_for_space_threshold
+            )
+
+    def _query_local_studies(self, date_query):
+        logger.info("Querying Orthanc")
+
+        query = dict(self._dicom_tags_to_query)
+        query.update(date_query)
+        return self._api_client.studies.find(query=query)
+
+    def _query_remote_studies(self, date_query):
+        logger.info(f"Querying remote modality {self._source_modality}")
+
+        query = dict(self._dicom_tags_to_query)
+        query.update(date_query)
+
+        # get more details if we are going to log the errors
+        if self._error_log_path:
+            query["PatientID"] = ""
+            query["PatientName"] = ""
+            query["StudyDescription"] = ""
+
+        retry_count = 0
+        while True:
+            try:
+                return self._api_client.modalities.query_studies(
+                    from_modality=self._source_modality,
+                    query=query
+                )
+            except Exception as ex:
+                retry_count += 1
+                if retry_count >= self._max_retries:
+                    raise
+
+    @staticmethod
+    def _get_instances_count(remote_study) -> Optional[int]:
+        # None if the source has not provided it
+        instances_count = remote_study.tags.get('NumberOfStudyRelatedInstances')
+        return int(instances_count) if instances_count else None
 
     def execute(self):
         super().execute()
@@ -83,72 +141,80 @@ class PacsMigrator(DicomMigrator):
         logger.info("From Date: " + str(self._from_study_date))
         logger.info("To Date  : " + str(self._to_study_date))
 
-        if self._from_study_date < self._to_study_date:
-            # ex 20220101 -> 20220131
-            inc_date = 1
-            to_date = self._to_study_date + datetime.timedelta(days=1)
+        if self._retry_failed_only:
+            self.push_journal_entries(MigrationStatus.FAILED)
+            self.stop_threads()
+            logger.info("--------------------------------------------------------------------")
+            logger.info("Retry of the failed studies completed")
+            return
+
+        from_study_date = self._from_study_date
+        direction = 1 if self._from_study_date <= self._to_study_date else -1
+        journal_range_key = f"{helpers.to_dicom_date(self._from_study_date)}-{helpers.to_dicom_date(self._to_study_date)}"
+
+        resumed_studies = set()
+        if self._journal:
+            recorded_until = self._journal.get_recorded_until(journal_range_key)
+            if recorded_until is not None:
+                logger.info(f"Resuming the migration after {recorded_until}")
+                from_study_date = recorded_until + datetime.timedelta(days=direction)
+                # the studies of this range still pending when the migration was interrupted (the last date may be queried again)
+                resumed_studies = set(self.push_journal_entries(MigrationStatus.PENDING, journal_range_key=journal_range_key))
+
+        if self.source_is_orthanc:
+            splitter = StudyDateRangeSplitter(query_studies=self._query_local_studies)
         else:
-            # ex 20220131 -> 20220101
-            inc_date = -1
-            to_date = self._to_study_date - datetime.timedelta(days=1)
-
-        current_date = self._from_study_date
-
-        while current_date != to_date:
-            logger.info("Processing date {date}".format(date=str(current_date)))
-
-            query = self._dicom_tags_to_query
-            query["StudyDate"] = helpers.to_dicom_date(current_date)
+            splitter = StudyDateRangeSplitter(query_studies=self._query_remote_studies, max_results_count=self._max_cfind_study_count)
+
+        date_ranges = iter([])
+        if (self._to_study_date - from_study_date).days * direction >= 0:
+            date_ranges = splitter.iterate(from_study_date, self._to_study_date)
+
+        while True:
+            try:
+                date_range, studies = next(date_ranges)
+            except StopIteration:
+                break
+            except Exception as ex:
+                logger.error(f"Could not query the modality (retried {self._max_retries} times), aborting")
+                if self._exit_on_error:
+                    logger.info("exiting due to an error...")
+                    self.stop_threads()
+                    sys.exit(1)
+                return
+
+            logger.info("Processing date {date}".format(date=str(date_range)))
+            logger.info(f"Found {len(studies)} studies")
 
             if self.source_is_orthanc:
-                logger.info("Querying Orthanc")
-                local_studies = self._api_client.studies.find(query=query)
-
-                logger.info(f"Found {len(local_studies)} studies")
-
-                for study in local_studies:
-                    self.push_message(Message(orthanc_id=study.orthanc_id))
+                for study in studies:
+                    if study.orthanc_id not in resumed_studies:
+                        self.push_message(Message(orthanc_id=study.orthanc_id), journal_range_key=journal_range_key)
             else:
-                if self._orthanc_space_threshold > 0:
-                    self.wait_for_space_in_orthanc()
+                if date_range.is_truncated and self._exit_on_error:
+                    logger.info("exiting due to an error...")
+                    self.stop_threads()
+                    sys.exit(1)
+
+                existing_studies = set()
+                source_instances_counts = {s.dicom_id: self._get_instances_count(s) for s in studies}
+                if self._skip_existing_studies and len(studies) > 0:
+                    try:
+                        # the unknown source instances counts are queried and completed in source_instances_counts
+                        existing_studies = set(self.get_existing_studies(source_instances_counts))
+                        logger.info(f"Skipping {len(existing_studies)} studies already at the destination")
+                    except Exception as ex:
+                        logger.warning(f"Could not check the studies already at the destination, transferring all studies of {date_range}: {str(ex)}")
 
-                logger.info(f"Querying remote modality {self._source_modality}")
+                for study in studies:
+                    if study.dicom_id in resumed_studies:
+                        continue
 
-                retry_count = 0
-                while retry_count < self._max_retries:
-                    try:
-                        # get more details if we are going to log the errors
-                        if self._error_log_path:                        
-                            query["PatientID"] = ""
-                            query["PatientName"] = ""
-                            query["StudyDescription"] = ""
-                        
-                        remote_modality_studies = self._api_client.modalities.query_studies(
-                            from_modality=self._source_modality,
-                            query=query
-                        )
-                        break
+                    if study.dicom_id in existing_studies:
+                        if self._journal:
+                            self._journal.set_done(study.dicom_id)
+                        continue
 
-                    except Exception as ex:
-                        retry_count += 1
-                        if retry_count == self._max_retries:
-                            logger.error(f"Could not query the modality (retried {self._max_retries} times), aborting")
-                            if self._exit_on_error:
-                                logger.info("exiting due to an error...")
-                                self.stop_threads()
-                                sys.exit(1)
-                            return
-
-                logger.info(f"Found {len(remote_modality_studies)} studies")
-
-                if self._max_cfind_study_count and len(remote_modality_studies) == self._max_cfind_study_count:
-                    logger.error(f"Too many studies in a single request: {len(remote_modality_studies)}, you'll probably miss some studies")
-                    if self._exit_on_error:
-                        logger.info("exiting due to an error...")
-                        self.stop_threads()
-                        sys.exit(1)
-
-                for study in remote_modality_studies:
                     if self._error_log_path:                        
                         info = ";".join([
                             study.tags.get('StudyDate'),
@@ -161,9 +227,13 @@ class PacsMigrator(DicomMigrator):
                         info = None
 
                     self.push_message(Message(dicom_id=study.dicom_id,
-                                              info=info))
+                                              info=info,
+                                              instances_count=source_instances_counts[study.dicom_id]),
+                                      journal_range_key=journal_range_key)
 
-            current_date += datetime.timedelta(days=inc_date)
+            # a day that is split in StudyTime ranges is recorded with its last range (the studies without StudyTime)
+            if self._journal and date_range.from_time is None:
+                self._journal.set_recorded_until(journal_range_key, date_range.to_date)
 
         self.stop_threads()
 
@@ -205,16 +275,24 @@ if __name__ == '__main__':
     parser.add_argument('--destination_modality', type=str, default=None, help='Destination modality (alias)')
     parser.add_argument('--destination_aet', type=str, default=None, help='Destination AET')
     parser.add_argument('--source_modality', type=str, default=None, help='Source modality (alias)')
+    parser.add_argument('--max_cfind_study_count', type=int, default=None, help='Known maximum amount of studies retrievable from the source modality at once (enables querying by date ranges)')
     parser.add_argument('--from_study_date', type=str, required='FROM_STUDY_DATE' not in os.environ, help='From Study Date (format 20190225)')
     parser.add_argument('--to_study_date', type=str, required='TO_STUDY_DATE' not in os.environ, help='To Study Date (format 20190225)')
     parser.add_argument('--delete_from_source', default=False, action='store_true', help='delete data from source (only if source is an Orthanc)')
     parser.add_argument('--worker_threads_count', type=int, default=1, help='Worker threads count')
     parser.add_argument('--exit_on_error', default=False, action='store_true', help='if True, the script will exit in case of error')
-    parser.add_argument('--orthanc_space_threshold', type=int, default=0, help='[MB] If different from 0, Migrator will wait until disk space used by Orthanc is above this value.')
+    parser.add_argument('--orthanc_space_threshold', type=int, default=0, help='[MB] If different from 0, Migrator will pause the transfers while the disk space used by Orthanc is above this value.')
+    parser.add_argument('--orthanc_space_low_threshold', type=int, default=None, help='[MB] Below this disk space used by Orthanc, all the workers are active (default: 80%% of orthanc_space_threshold).')
     parser.add_argument('--use_get_not_move', default=False, action='store_true', help='use a C-Get in place of C-Move (only if destination is Orthanc)')
     parser.add_argument('--max_retries', type=int, default=5, help='Maximum number of retries')
     parser.add_argument('--constant_retry_delays', default=False, action='store_true', help='Use constant 60 seconds retry instead of the default increasing delay retries')
     parser.add_argument('--error_log_path', type=str, default=None, help='File to record the failed studies in CSV')
+    parser.add_argument('--journal_path', type=str, default=None, help='SQLite file recording the outcome of each study (to resume an interrupted migration)')
+    parser.add_argument('--retry_failed_only', default=False, action='store_true', help='Only retry the studies that have failed according to the journal')
+    parser.add_argument('--skip_existing_studies', default=False, action='store_true', help='Skip the studies that are already complete at the destination (checked by batches)')
+    parser.add_argument('--destination_query_modality', type=str, default=None, help='Alias of the destination modality to query to skip the existing studies (if the destination is a destination_aet)')
+    parser.add_argument('--series_expansion_threshold', type=int, default=None, help='Studies with more instances are transferred series by series by all the workers')
+    parser.add_argument('--adaptive_concurrency', default=False, action='store_true', help='Adapt the number of concurrent transfers (up to worker_threads_count) to the throughput and failures of the source')
 
     Scheduler.add_parser_arguments(parser)
 
@@ -227,10 +305,16 @@ if __name__ == '__main__':
     destination_modality = os.environ.get("DESTINATION_MODALITY", args.destination_modality)
     destination_aet = os.environ.get("DESTINATION_AET", args.destination_aet)
     source_modality = os.environ.get("SOURCE_MODALITY", args.source_modality)
+    max_cfind_study_count = os.environ.get("MAX_CFIND_STUDY_COUNT", args.max_cfind_study_count)
+    if max_cfind_study_count is not None:
+        max_cfind_study_count = int(max_cfind_study_count)
     from_study_date = helpers.from_dicom_date(os.environ.get("FROM_STUDY_DATE", args.from_study_date))
     to_study_date = helpers.from_dicom_date(os.environ.get("TO_STUDY_DATE", args.to_study_date))
     worker_threads_count = int(os.environ.get("WORKER_THREADS_COUNT", str(args.worker_threads_count)))
     orthanc_space_threshold = int(os.environ.get("ORTHANC_SPACE_THRESHOLD", str(args.orthanc_space_threshold)))
+    orthanc_space_low_threshold = os.environ.get("ORTHANC_SPACE_LOW_THRESHOLD", args.orthanc_space_low_threshold)
+    if orthanc_space_low_threshold is not None:
+        orthanc_space_low_threshold = int(orthanc_space_low_threshold)
     max_retries = int(os.environ.get("MAX_RETRIES", str(args.max_retries)))
     error_log_path = os.environ.get("ERROR_LOG_PATH", args.error_log_path)
 
@@ -256,6 +340,27 @@ if __name__ == '__main__':
     else:
         constant_retry_delays = args.constant_retry_delays
 
+    if os.environ.get("ADAPTIVE_CONCURRENCY", None) is not None:
+        adaptive_concurrency = os.environ.get("ADAPTIVE_CONCURRENCY") in ["true", "True"]
+    else:
+        adaptive_concurrency = args.adaptive_concurrency
+
+    journal_path = os.environ.get("JOURNAL_PATH", args.journal_path)
+    if os.environ.get("RETRY_FAILED_ONLY", None) is not None:
+        retry_failed_only = os.environ.get("RETRY_FAILED_ONLY") in ["true", "True"]
+    else:
+        retry_failed_only = args.retry_failed_only
+
+    destination_query_modality = os.environ.get("DESTINATION_QUERY_MODALITY", args.destination_query_modality)
+    if os.environ.get("SKIP_EXISTING_STUDIES", None) is not None:
+        skip_existing_studies = os.environ.get("SKIP_EXISTING_STUDIES") in ["true", "True"]
+    else:
+        skip_existing_studies = args.skip_existing_studies
+
+    series_expansion_threshold = os.environ.get("SERIES_EXPANSION_THRESHOLD", args.series_expansion_threshold)
+    if series_expansion_threshold is not None:
+        series_expansion_threshold = int(series_expansion_threshold)
+
     api_client = None
     if api_key is not None:
         api_client=OrthancApiClient(url, headers={"api-key":api_key}, pool_maxsize=max(10, worker_threads_count), pool_block=True)
@@ -269,15 +374,23 @@ if __name__ == '__main__':
         destination_modality=destination_modality,
         destination_aet=destination_aet,
         source_modality=source_modality,
+        max_cfind_study_count=max_cfind_study_count,
         delete_from_source=delete_from_source,
         scheduler=scheduler,
         worker_threads_count=worker_threads_count,
         exit_on_error=exit_on_error,
         orthanc_space_threshold=orthanc_space_threshold,
+        orthanc_space_low_threshold=orthanc_space_low_threshold,
         use_get_not_move=use_get_not_move,
         max_retries=max_retries,
         constant_retry_delays=constant_retry_delays,
-        error_log_path=error_log_path
+        error_log_path=error_log_path,
+        adaptive_concurrency=adaptive_concurrency,
+        journal_path=journal_path,
+        retry_failed_only=retry_failed_only,
+        skip_existing_studies=skip_existing_studies,
+        destination_query_modality=destination_query_modality,
+        series_expansion_threshold=series_expansion_threshold
     )
 
     migrator.execute()
@@ -0,0 +1,284 @@
+import abc
+import threading
+import time
+import sqlite3
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, List, Tuple
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReplicatorMessage:
+    action: str                 # 'forward' or 'delete'
+    orthanc_id: str
+    delivery_tag: int           # identifies the message in the transport
+    channel: Any = None         # the channel the message has been received on (transport specific, it must be acked on the same channel)
+
+
+class ReplicatorTransport(abc.ABC):
+    """
+    The interface between the OrthancReplicator and the queues of 'forward' and 'delete' messages.
+
+    - consume() blocks and calls on_message for each message until stop() is called.  Messages are delivered
+      at least once: a message that is not acknowledged before a crash/disconnection is delivered again.
+    - acknowledge() can be called from any thread:
+      - successful messages are removed from the queue,
+      - failed messages are dead-lettered and delivered again after a delay.
+    - publish() pushes a new message in the queue (this is usually done by Orthanc itself, i.e. from a lua script).
+    """
+
+    @abc.abstractmethod
+    def consume(self, on_message: Callable[[ReplicatorMessage], None], consumers_count: int, prefetch_count: int):
+        pass
+
+    @abc.abstractmethod
+    def acknowledge(self, results: List[Tuple[ReplicatorMessage, bool]]):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, action: str, orthanc_id: str):
+        pass
+
+    @abc.abstractmethod
+    def stop(self):
+        pass
+
+
+class RabbitMqTransport(ReplicatorTransport):
+    """
+    The messages are pushed by Orthanc (through a lua script) to a RabbitMQ broker:
+    - vhost: "/" (default one)
+    - exchange: "orthanc-exchange"
+    - queue for instances to delete: "to-delete-queue"
+    - queue for instances to forward: "to-forward-queue"
+    Failed messages are moved to "standby-delete-queue" and "standby-forward-queue" where they wait 10 seconds
+    before being moved back to the main queues.
+
+    The messages are consumed on a single connection but through `consumers_count` channels, each one with a
+    `prefetch_count` QoS.  Since pika is not thread-safe, the acks are marshalled back to the connection thread.
+    """
+
+    def __init__(self, broker_params: pika.ConnectionParameters):
+        self._broker_params = broker_params
+        self._connection = None
+        self._on_message = None
+        self._unacked_delivery_tags = {}    # channel -> delivery tags that have not been acked yet (only used from the connection thread)
+        self._is_consuming = False
+        self._stop_requested = False
+
+    def _to_delete_callback(self, channel, method, properties, body):
+        self._unacked_delivery_tags.setdefault(channel, set()).add(method.delivery_tag)
+        self._on_message(ReplicatorMessage(action='delete', orthanc_id=body.decode('utf8'), delivery_tag=method.delivery_tag, channel=channel))
+
+    def _to_forward_callback(self, channel, method, properties, body):
+        self._unacked_delivery_tags.setdefault(channel, set()).add(method.delivery_tag)
+        self._on_message(ReplicatorMessage(action='forward', orthanc_id=body.decode('utf8'), delivery_tag=method.delivery_tag, channel=channel))
+
+    def _stop_callback(self, channel, method, properties, body):
+        self._is_consuming = False
+
+        logger.info("Broker connection stop requested...")
+
+    def consume(self, on_message: Callable[[ReplicatorMessage], None], consumers_count: int, prefetch_count: int):
+        self._on_message = on_message
+
+        # we want the replicator to retry to connect to the broker if there is a trouble...
+        while not self._stop_requested:
+            try:
+
+                # initialize connection to rabbitmq
+                connection = pika.BlockingConnection(self._broker_params)
+                self._connection = connection
+                self._unacked_delivery_tags = {}
+                channel = connection.channel()
+
+                # These steps should have been done in the lua, but they are idempotent
+                channel.exchange_declare(exchange="orthanc-exchange", exchange_type="direct", durable=True)
+
+                # "Main" queues
+                channel.queue_declare(queue='to-forward-queue',
+                                      durable=True,
+                                      arguments={
+                                          'x-dead-letter-exchange': 'orthanc-exchange',
+                                          'x-dead-letter-routing-key': 'standby-forward-queue'
+                                      })
+                channel.queue_declare(queue='to-delete-queue', durable=True,
+                                      arguments={
+                                          'x-dead-letter-exchange': 'orthanc-exchange',
+                                          'x-dead-letter-routing-key': 'standby-delete-queue'
+                                      })
+
+                # "Standby" queues (messages are waiting there is they were nacked)
+                channel.queue_declare(queue='standby-delete-queue', durable=True,
+                                      arguments={
+                                          'x-message-ttl': 10000,
+                                          'x-dead-letter-exchange': 'orthanc-exchange',
+                                          'x-dead-letter-routing-key': 'to-delete-queue'
+                                      })
+                channel.queue_declare(queue='standby-forward-queue', durable=True,
+                                      arguments={
+                                          'x-message-ttl': 10000,
+                                          'x-dead-letter-exchange': 'orthanc-exchange',
+                                          'x-dead-letter-routing-key': 'to-forward-queue'
+                                      })
+
+                channel.queue_bind(exchange="orthanc-exchange", queue="to-forward-queue", routing_key="to-forward-queue")
+                channel.queue_bind(exchange="orthanc-exchange", queue="to-delete-queue", routing_key="to-delete-queue")
+                channel.queue_bind(exchange="orthanc-exchange", queue="standby-delete-queue", routing_key="standby-delete-queue")
+                channel.queue_bind(exchange="orthanc-exchange", queue="standby-forward-queue", routing_key="standby-forward-queue")
+
+                # one channel per consumer
+                for i in range(0, consumers_count):
+                    consumer_channel = connection.channel()
+                    consumer_channel.basic_qos(prefetch_count=prefetch_count)
+                    consumer_channel.basic_consume(queue='to-forward-queue', on_message_callback=self._to_forward_callback)
+                    consumer_channel.basic_consume(queue='to-delete-queue', on_message_callback=self._to_delete_callback)
+
+                # we declare a "stop-queue" which allows to gracefully stop the connection with rabbitmq
+                channel.queue_declare(queue='stop-queue')
+                channel.queue_bind(exchange="orthanc-exchange", queue="stop-queue", routing_key="stop-queue")
+                channel.basic_consume(queue='stop-queue', on_message_callback=self._stop_callback, auto_ack=True)
+
+                logger.info("Broker connection configured, waiting for messages...")
+
+                # process the events of all channels (including the acks posted by the workers) until a stop is requested
+                self._is_consuming = True
+                while self._is_consuming:
+                    connection.process_data_events(time_limit=1)
+
+                connection.close()
+
+            except Exception as e:
+                logger.info("Broker consuming error, will retry soon...")
+                time.sleep(1)
+
+    def acknowledge(self, results: List[Tuple[ReplicatorMessage, bool]]):
+        # the channels can only be used from the connection thread
+        def acknowledge():
+            for channel in set(m.channel for m, success in results):
+                if not channel.is_open:
+                    continue  # the messages will be redelivered on a new channel
+                unacked = self._unacked_delivery_tags.setdefault(channel, set())
+
+                # rejected messages are moved to the standby queue and will be retried later
+                for m, success in results:
+                    if m.channel == channel and not success:
+                        channel.basic_nack(delivery_tag=m.delivery_tag, requeue=False)
+                        unacked.discard(m.delivery_tag)
+
+                acked = sorted(m.delivery_tag for m, success in results if m.channel == channel and success)
+                if len(acked) == 0:
+                    continue
+
+                # a multiple ack acknowledges all the messages up to the delivery tag -> it can only be used up to the
+                # first message that is still being handled (possibly by another worker)
+                first_unacked_by_others = min((t for t in unacked if t not in acked), default=None)
+                acked_at_once = [t for t in acked if first_unacked_by_others is None or t < first_unacked_by_others]
+                if len(acked_at_once) > 0:
+                    channel.basic_ack(delivery_tag=acked_at_once[-1], multiple=len(acked_at_once) > 1)
+                for t in acked[len(acked_at_once):]:
+                    channel.basic_ack(delivery_tag=t)
+
+                unacked.difference_update(acked)
+
+        try:
+            results[0][0].channel.connection.add_callback_threadsafe(acknowledge)
+        except Exception as ex:
+            logger.warning(f"Unable to acknowledge {len(results)} message(s), they will be redelivered: {str(ex)}")
+
+    def publish(self, action: str, orthanc_id: str):
+        connection = pika.BlockingConnection(self._broker_params)
+        channel = connection.channel()
+
+        channel.basic_publish(exchange='orthanc-exchange', routing_key=f"to-{action}-queue", body=orthanc_id)
+
+        connection.close()
+
+    def stop(self):
+        self._stop_requested = True
+
+        connection = pika.BlockingConnection(self._broker_params)
+        channel = connection.channel()
+
+        channel.basic_publish(exchange='orthanc-exchange', routing_key='stop-queue', body="stop")
+
+        connection.close()
+
+
+class SqliteTransport(ReplicatorTransport):
+    """
+    An embedded durable queue stored in a SQLite database.  It does not require any broker and is therefore
+    suited for small deployments where the messages are produced in the same process (through publish()) and
+    for benchmarks/load tests of the Replicator.
+
+    Failed messages stay in the database and are delivered again after `retry_delay` seconds.
+    Messages that have been delivered but not acknowledged when the process stops are delivered again at next
+    startup.
+    """
+
+    def __init__(self, path: str, retry_delay: float = 10, polling_interval: float = 0.05):
+        """
+        :param path: the path of the SQLite database file (':memory:' for a non-durable queue)
+        :param retry_delay: the delay (in seconds) before a failed message is delivered again
+        :param polling_interval: the delay (in seconds) between two checks for new messages when the queue is empty
+        """
+        self._retry_delay = retry_delay
+        self._polling_interval = polling_interval
+        self._lock = threading.Lock()
+        self._in_flight = set()     # the ids of the messages that have been delivered but not acknowledged yet
+        self._is_consuming = False
+        self._stop_requested = False
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, action TEXT NOT NULL, orthanc_id TEXT NOT NULL, available_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS messages_available_at ON messages (available_at)")
+            self._db.commit()
+
+    def consume(self, on_message: Callable[[ReplicatorMessage], None], consumers_count: int, prefetch_count: int):
+        max_in_flight = consumers_count * prefetch_count
+        self._is_consuming = True
+
+        while self._is_consuming and not self._stop_requested:
+            with self._lock:
+                available_slots = max_in_flight - len(self._in_flight)
+                rows = []
+                if available_slots > 0:
+                    rows = self._db.execute("SELECT id, action, orthanc_id FROM messages WHERE available_at <= ? ORDER BY id LIMIT ?",
+                                            (time.time(), available_slots + len(self._in_flight))).fetchall()
+                    rows = [r for r in rows if r[0] not in self._in_flight][:available_slots]
+                    self._in_flight.update(r[0] for r in rows)
+
+            for message_id, action, orthanc_id in rows:
+                on_message(ReplicatorMessage(action=action, orthanc_id=orthanc_id, delivery_tag=message_id))
+
+            if len(rows) == 0:
+                time.sleep(self._polling_interval)
+
+    def acknowledge(self, results: List[Tuple[ReplicatorMessage, bool]]):
+        with self._lock:
+            self._db.executemany("DELETE FROM messages WHERE id = ?",
+                                 [(m.delivery_tag,) for m, success in results if success])
+            self._db.executemany("UPDATE messages SET available_at = ? WHERE id = ?",
+                                 [(time.time() + self._retry_delay, m.delivery_tag) for m, success in results if not success])
+            self._db.commit()
+            self._in_flight.difference_update(m.delivery_tag for m, success in results)
+
+    def publish(self, action: str, orthanc_id: str):
+        with self._lock:
+            self._db.execute("INSERT INTO messages (action, orthanc_id, available_at) VALUES (?, ?, ?)", (action, orthanc_id, time.time()))
+            self._db.commit()
+
+    def get_messages_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def stop(self):
+        self._stop_requested = True
+        self._is_consuming = False
@@ -14,10 +14,12 @@ from orthanc_api_client import helpers
 import orthanc_api_client.exceptions as api_exceptions
 import pathlib
 import os
+import io
+import pydicom
 import logging
 import unittest
 
-from orthanc_tools import OrthancCloner, ClonerMode, OrthancMonitor, OrthancTestDbPopulator, PacsMigrator, IdsMigrator, OrthancComparator, OrthancForwarder, ForwarderMode, ForwarderDestination, OrthancCleaner, OrthancFolderImporter, OrthancSyncher, OrthancFilesChecker
+from orthanc_tools import OrthancCloner, ClonerMode, OrthancMonitor, OrthancTestDbPopulator, PacsMigrator, IdsMigrator, OrthancComparator, OrthancForwarder, ForwarderMode, ForwarderDestination, OrthancCleaner, OrthancFolderImporter, OrthancSyncher, SyncherTransferMode, OrthancMultiSyncher, OrthancFilesChecker, MigrationJournal, MigrationStatus
 
 here = pathlib.Path(__file__).parent.resolve()
 
@@ -33,6 +35,21 @@ logger.addHandler(ch)
 forwarder_count_failed = 0
 forwarder_count_success = 0
 
+
+# the file filters/processors are run in a process pool -> they must be defined at module level
+def filter_instance_file(dicom_file: bytes) -> bool:
+    ds = pydicom.dcmread(io.BytesIO(dicom_file), stop_before_pixels=True)
+    return ds.SeriesDescription == 'sT2W/FLAIR'
+
+
+def process_instance_file(dicom_file: bytes) -> bytes:
+    ds = pydicom.dcmread(io.BytesIO(dicom_file))
+    ds.InstitutionName = "MY"
+    modified = io.BytesIO()
+    ds.save_as(modified)
+    return modified.getvalue()
+
+
 class Test3Orthancs(unittest.TestCase):
 
     @classmethod
@@ -386,6 +403,97 @@ class Test3Orthancs(unittest.TestCase):
         # check all instances have been transferred and are still on the source
         self.assertEqual(len(self.oa.instances.get_all_ids()), len(self.oc.instances.get_all_ids()))
 
+    def test_pacs_migrator_with_date_ranges(self):
+        self.oa.delete_all_content()  # source
+        self.ob.delete_all_content()  # migrator & destination
+
+        populator = OrthancTestDbPopulator(
+            api_client=self.oa,
+            studies_count=12,
+            series_count=1,
+            instances_count=1,
+            from_study_date=datetime.date(2022, 4, 19),
+            to_study_date=datetime.date(2022, 4, 20)
+        )
+        populator.execute()
+
+        # the modality can only return 4 studies at once -> the date ranges must be split, no study shall be missed
+        migrator = PacsMigrator(
+            api_client=self.ob,
+            source_modality="orthanc-a",
+            max_cfind_study_count=4,
+            from_study_date=datetime.date(2022, 1, 1),
+            to_study_date=datetime.date(2022, 12, 31)
+        )
+        migrator.execute()
+
+        self.assertEqual(12, len(self.ob.studies.get_all_ids()))
+
+    def test_pacs_migrator_skip_existing_studies(self):
+        self.oa.delete_all_content()  # source
+        self.ob.delete_all_content()  # migrator & destination
+
+        populator = OrthancTestDbPopulator(
+            api_client=self.oa,
+            studies_count=4,
+            series_count=1,
+            instances_count=2,
+            from_study_date=datetime.date(2022, 4, 19),
+            to_study_date=datetime.date(2022, 4, 20)
+        )
+        populator.execute()
+
+        # one complete study and one incomplete study are already at the destination
+        studies_ids = self.oa.studies.get_all_ids()
+        self.oa.modalities.send('orthanc-b', studies_ids[0])
+        self.oa.modalities.send('orthanc-b', self.oa.studies.get_instances_ids(studies_ids[1])[0])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal_path = os.path.join(temp_dir, 'journal.db')
+            migrator = PacsMigrator(
+                api_client=self.ob,
+                source_modality="orthanc-a",
+                from_study_date=datetime.date(2022, 4, 19),
+                to_study_date=datetime.date(2022, 4, 20),
+                skip_existing_studies=True,
+                journal_path=journal_path
+            )
+            migrator.execute()
+
+            self.assertEqual(len(self.oa.instances.get_all_ids()), len(self.ob.instances.get_all_ids()))
+
+            # the skipped study is recorded as done too
+            journal = MigrationJournal(journal_path)
+            self.assertEqual(4, journal.get_count(MigrationStatus.DONE))
+            journal.close()
+
+    def test_pacs_migrator_series_expansion(self):
+        self.oa.delete_all_content()  # source
+        self.ob.delete_all_content()  # migrator & destination
+
+        populator = OrthancTestDbPopulator(
+            api_client=self.oa,
+            studies_count=3,
+            series_count=3,
+            instances_count=5,
+            from_study_date=datetime.date(2022, 4, 19),
+            to_study_date=datetime.date(2022, 4, 20)
+        )
+        populator.execute()
+
+        # the studies have 15 instances -> they are transferred series by series
+        migrator = PacsMigrator(
+            api_client=self.ob,
+            source_modality="orthanc-a",
+            from_study_date=datetime.date(2022, 4, 19),
+            to_study_date=datetime.date(2022, 4, 20),
+            worker_threads_count=3,
+            series_expansion_threshold=10
+        )
+        migrator.execute()
+
+        self.assertEqual(len(self.oa.instances.get_all_ids()), len(self.ob.instances.get_all_ids()))
+
     def test_pacs_migrator_as_destination(self):
         self.oa.delete_all_content()  # source
         self.ob.delete_all_content()  # migrator & destination
@@ -541,7 +649,8 @@ class Test3Orthancs(unittest.TestCase):
             from_study_date=datetime.date(2022, 4, 19),
             to_study_date=datetime.date(2022, 4, 25),
             ignore_missing_from_orthanc=True,
-            transfer_missing_to_modality=True
+            transfer_missing_to_modality=True,
+            date_workers_count=3
         )
         comparator.execute()
 
@@ -558,7 +667,8 @@ class Test3Orthancs(unittest.TestCase):
             from_study_date=datetime.date(2022, 4, 19),
             to_study_date=datetime.date(2022, 4, 25),
             ignore_missing_on_modality=True,
-            retrieve_missing_from_orthanc=True
+            retrieve_missing_from_orthanc=True,
+            transfer_workers_count=2
         )
         comparator.execute()
 
@@ -726,6 +836,88 @@ class Test3Orthancs(unittest.TestCase):
             self.assertNotEqual(0, forwarder_count_success)
             self.assertNotEqual(0, forwarder_count_failed)
 
+    def test_orthanc_forwarder_filter_and_process_in_process_pool(self):
+        self.ob.delete_all_content()  # destination
+        self.oa.delete_all_content()  # source
+
+        self.oa.upload_folder(here / "stimuli/MR/Brain")
+
+        with OrthancForwarder(
+            source=self.oa,
+            destinations=[ForwarderDestination(destination="orthanc-b", forwarder_mode=ForwarderMode.DICOM)],
+            trigger=ChangeType.STABLE_STUDY,
+            polling_interval_in_seconds=0.1,
+            instance_file_filter=filter_instance_file,
+            instance_file_processor=process_instance_file,
+            processes_count=2,
+            upload_batch_size=2
+            ) as forwarder:
+
+            # wait until the source is empty (= the forwarder has completed its job and deleted them)
+            helpers.wait_until(lambda: len(self.oa.studies.get_all_ids()) == 0, timeout=30)
+
+            # check only the flair series has arrived on b and has been modified
+            self.assertEqual(1, len(self.ob.instances.get_all_ids()))
+            forwarded_instance = self.ob.instances.get(self.ob.instances.get_all_ids()[0])
+            self.assertEqual("MY", forwarded_instance.tags.get('InstitutionName'))
+            self.assertEqual("sT2W/FLAIR", forwarded_instance.series.main_dicom_tags.get('SeriesDescription'))
+
+    def test_orthanc_forwarder_alternate_destination(self):
+        self.ob.delete_all_content()
+        self.oc.delete_all_content()
+        self.oa.delete_all_content()
+
+        # Tell orthanc-b to reject incoming instances -> the forwarder shall switch to orthanc-c
+        orthanc_a_config = self.ob.modalities.get_configuration(modality='orthanc-a')
+        self.ob.modalities.delete(modality='orthanc-a')
+
+        OrthancForwarder.retry_intervals = [1, 2, 3, 4, 5, 6]
+
+        try:
+            with OrthancForwarder(
+                source=self.oa,
+                destinations=[ForwarderDestination(destination="orthanc-b", forwarder_mode=ForwarderMode.DICOM, alternate_destination="orthanc-c")],
+                trigger=ChangeType.STABLE_STUDY,
+                polling_interval_in_seconds=0.1,
+                circuit_breaker_failure_threshold=1,
+                health_check_interval_in_seconds=600
+                ) as forwarder:
+
+                instances_ids = self.oa.upload_folder(here / "stimuli/MR/Brain")
+
+                helpers.wait_until(lambda: len(self.oa.studies.get_all_ids()) == 0, timeout=30)
+
+                self.assertEqual(0, len(self.ob.instances.get_all_ids()))
+                self.assertEqual(len(instances_ids), len(self.oc.instances.get_all_ids()))
+        finally:
+            self.ob.modalities.configure(modality='orthanc-a', configuration=orthanc_a_config)
+
+    def test_orthanc_forwarder_async_jobs(self):
+        self.ob.delete_all_content()
+        self.oc.delete_all_content()
+        self.oa.delete_all_content()
+
+        forwarded = []
+
+        with OrthancForwarder(
+            source=self.oa,
+            destinations=[ForwarderDestination(destination="orthanc-b", forwarder_mode=ForwarderMode.DICOM, job_priority=10),
+                          ForwarderDestination(destination="orthanc-c", forwarder_mode=ForwarderMode.PEERING)],
+            trigger=ChangeType.STABLE_STUDY,
+            polling_interval_in_seconds=0.1,
+            use_async_jobs=True,
+            job_polling_interval_in_seconds=0.1,
+            on_instances_set_forwarded=lambda instances_set, destination: forwarded.append(destination)
+            ) as forwarder:
+
+            instances_ids = self.oa.upload_folder(here / "stimuli/MR/Brain")
+
+            helpers.wait_until(lambda: len(self.oa.studies.get_all_ids()) == 0, timeout=30)
+
+            self.assertEqual(len(instances_ids), len(self.ob.instances.get_all_ids()))
+            self.assertEqual(len(instances_ids), len(self.oc.instances.get_all_ids()))
+            self.assertEqual(["orthanc-b", "orthanc-c"], sorted(forwarded))
+
     def test_orthanc_cleaner_with_past_studies(self):
         self.oa.delete_all_content()
 
@@ -1202,6 +1394,77 @@ class Test3Orthancs(unittest.TestCase):
             syncher.execute()
             self.assertEqual(len(self.oa.instances.get_all_ids()), 108)
 
+    def test_orthanc_syncher_transfer_modes(self):
+
+        for mode in [SyncherTransferMode.ZIP, SyncherTransferMode.PEERING, SyncherTransferMode.TRANSFER]:
+            self.oa.delete_all_content()
+            self.ob.delete_all_content()
+
+            populator_a = OrthancTestDbPopulator(
+                api_client=self.oa,
+                studies_count=5,
+                series_count=3,
+                instances_count=2,
+                from_study_date=datetime.date(2022, 4, 19),
+                to_study_date=datetime.date(2022, 4, 25)
+            )
+            populator_a.execute()
+
+            # send a few instances to make sure that incomplete series are handled too
+            instances_a = self.oa.instances.get_all_ids()
+            self.oa.modalities.send('orthanc-b', [instances_a[0], instances_a[2], instances_a[4]])
+
+            syncher = OrthancSyncher(
+                api_client_1=self.oa,
+                api_client_2=self.ob,
+                level='Instance',
+                orthanc_queries_batch_size=2,
+                transfer_mode=mode,
+                peer_alias_1='orthanc-a',
+                peer_alias_2='orthanc-b',
+                zip_batch_size=4
+            )
+            syncher.execute()
+
+            self.assertEqual(len(self.ob.instances.get_all_ids()), 30)
+
+    def test_orthanc_multi_syncher(self):
+        for level in ['Series', 'Instance']:
+            for o in [self.oa, self.ob, self.oc]:
+                o.delete_all_content()
+
+            # populate each Orthanc with different content
+            for o in [self.oa, self.ob, self.oc]:
+                populator = OrthancTestDbPopulator(
+                    api_client=o,
+                    studies_count=4,
+                    series_count=2,
+                    instances_count=3,
+                    from_study_date=datetime.date(2022, 4, 19),
+                    to_study_date=datetime.date(2022, 4, 25)
+                )
+                populator.execute()
+
+            # and share a few instances such that some studies/series are incomplete
+            instances_a = self.oa.instances.get_all_ids()
+            self.oa.modalities.send('orthanc-b', [instances_a[0], instances_a[2], instances_a[4]])
+            self.oa.modalities.send('orthanc-c', [instances_a[1]])
+
+            syncher = OrthancMultiSyncher(
+                api_clients={'a': self.oa, 'b': self.ob, 'c': self.oc},
+                level=level,
+                orthanc_queries_batch_size=5
+            )
+            syncher.execute()
+
+            self.assertEqual(len(self.oa.studies.get_all_ids()), 12)
+            self.assertEqual(len(self.ob.studies.get_all_ids()), 12)
+            self.assertEqual(len(self.oc.studies.get_all_ids()), 12)
+            if level == 'Instance':
+                self.assertEqual(len(self.oa.instances.get_all_ids()), 72)
+                self.assertEqual(len(self.ob.instances.get_all_ids()), 72)
+                self.assertEqual(len(self.oc.instances.get_all_ids()), 72)
+
 
     def test_files_checker_with_valid_storage(self):
         self.oa.delete_all_content()
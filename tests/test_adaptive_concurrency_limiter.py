@@ -0,0 +1,58 @@
+from unittest import TestCase
+import threading
+import time
+from orthanc_tools import AdaptiveConcurrencyLimiter
+
+
+class TestAdaptiveConcurrencyLimiter(TestCase):
+
+    def test_increases_while_throughput_improves(self):
+        limiter = AdaptiveConcurrencyLimiter(name="test", max_concurrency=3)
+        self.assertEqual(1, limiter.concurrency)
+
+        for i in range(0, 20):
+            limiter.acquire()
+            limiter.record_success(size=10, duration=0.001)
+            limiter.release()
+            time.sleep(0.001)
+
+        self.assertGreater(limiter.concurrency, 1)
+        self.assertLessEqual(limiter.concurrency, 3)
+
+    def test_decreases_on_failures(self):
+        limiter = AdaptiveConcurrencyLimiter(name="test", max_concurrency=8, initial_concurrency=8)
+
+        for i in range(0, 15):
+            limiter.record_success(size=10, duration=0.001)
+        limiter.record_failure()
+
+        self.assertEqual(4, limiter.concurrency)
+
+    def test_decreases_on_latency_spikes(self):
+        limiter = AdaptiveConcurrencyLimiter(name="test", max_concurrency=4, initial_concurrency=4, latency_spike_factor=3)
+
+        for i in range(0, 8):
+            limiter.record_success(size=10, duration=1)
+        self.assertEqual(4, limiter.concurrency)
+
+        for i in range(0, 8):
+            limiter.record_success(size=10, duration=10)
+        self.assertEqual(2, limiter.concurrency)
+
+    def test_acquire_blocks_above_concurrency(self):
+        limiter = AdaptiveConcurrencyLimiter(name="test", max_concurrency=4, initial_concurrency=1)
+        limiter.acquire()
+
+        acquired = threading.Event()
+
+        def _acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        limiter.release()
+        self.assertTrue(acquired.wait(1))
+        thread.join()
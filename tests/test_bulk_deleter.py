@@ -0,0 +1,61 @@
+from unittest import TestCase
+import time
+from orthanc_tools import BulkDeleter
+
+
+class FakeOrthanc:
+
+    def __init__(self):
+        self.deleted_batches = []
+        self.fail = False
+
+    def post(self, endpoint, json):
+        if self.fail:
+            raise Exception("Orthanc is down")
+        self.deleted_batches.append((endpoint, json["Resources"]))
+
+
+class TestBulkDeleter(TestCase):
+
+    def test_batches(self):
+        orthanc = FakeOrthanc()
+        deleter = BulkDeleter(api_client=orthanc, batch_size=3)
+
+        deleter.add(["1", "2"])
+        deleter.add(["2", "3", "4", "5"])  # "2" is already pending
+        self.assertTrue(deleter.is_pending("2"))
+
+        deleter.flush()
+        self.assertEqual([("tools/bulk-delete", ["1", "2", "3"]), ("tools/bulk-delete", ["4", "5"])], orthanc.deleted_batches)
+        self.assertFalse(deleter.is_pending("2"))
+        self.assertEqual(set(), deleter.get_pending_ids())
+
+    def test_retry_after_failure(self):
+        orthanc = FakeOrthanc()
+        deleter = BulkDeleter(api_client=orthanc, batch_size=10)
+
+        orthanc.fail = True
+        deleter.add(["1", "2"])
+        deleter.flush()
+        self.assertEqual({"1", "2"}, deleter.get_pending_ids())
+
+        orthanc.fail = False
+        deleter.flush()
+        self.assertEqual([("tools/bulk-delete", ["1", "2"])], orthanc.deleted_batches)
+        self.assertEqual(set(), deleter.get_pending_ids())
+
+    def test_thread(self):
+        orthanc = FakeOrthanc()
+
+        with BulkDeleter(api_client=orthanc, batch_size=2, flush_interval=0.2, pause_between_batches=0) as deleter:
+            deleter.add(["1", "2", "3"])
+            time.sleep(0.1)
+            self.assertEqual([("tools/bulk-delete", ["1", "2"])], orthanc.deleted_batches)  # a full batch is deleted immediately
+
+            time.sleep(0.3)
+            self.assertEqual([("tools/bulk-delete", ["1", "2"]), ("tools/bulk-delete", ["3"])], orthanc.deleted_batches)
+
+            deleter.add(["4"])
+
+        # stop() flushes the remaining instances
+        self.assertEqual(("tools/bulk-delete", ["4"]), orthanc.deleted_batches[-1])
@@ -0,0 +1,71 @@
+from unittest import TestCase
+import time
+from orthanc_tools import CircuitBreaker, CircuitBreakerState
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(name="test", failure_threshold=2)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.is_available())
+
+        # a success resets the failures count
+        breaker.record_success(latency=0.1)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_available())
+
+        breaker.record_failure()
+        self.assertFalse(breaker.is_available())
+        self.assertEqual(CircuitBreakerState.OPEN, breaker.state)
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker(name="test", failure_threshold=2, max_latency=1.0)
+
+        breaker.record_success(latency=2.0)
+        breaker.record_success(latency=0.5)
+        self.assertTrue(breaker.is_available())
+
+        breaker.record_success(latency=2.0)
+        breaker.record_success(latency=3.0)
+        self.assertFalse(breaker.is_available())
+
+    def test_probe_and_close(self):
+        breaker = CircuitBreaker(name="test", failure_threshold=1, probe_interval=0.1)
+
+        breaker.record_failure()
+        self.assertFalse(breaker.is_available())
+        self.assertFalse(breaker.should_probe())
+
+        time.sleep(0.2)
+        self.assertTrue(breaker.should_probe())
+
+        # a failed probe keeps the breaker open and postpones the next probe
+        breaker.record_probe(success=False)
+        self.assertFalse(breaker.is_available())
+        self.assertFalse(breaker.should_probe())
+
+        time.sleep(0.2)
+        breaker.record_probe(success=True)
+        self.assertEqual(CircuitBreakerState.HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.is_available())
+
+        # a single trial call is admitted while HALF_OPEN
+        self.assertFalse(breaker.is_available())
+
+        breaker.record_success(latency=0.1)
+        self.assertEqual(CircuitBreakerState.CLOSED, breaker.state)
+
+    def test_half_open_reopens_on_first_failure(self):
+        breaker = CircuitBreaker(name="test", failure_threshold=3, probe_interval=0)
+
+        for i in range(0, 3):
+            breaker.record_failure()
+        breaker.record_probe(success=True)
+        self.assertEqual(CircuitBreakerState.HALF_OPEN, breaker.state)
+
+        self.assertTrue(breaker.is_available())
+        breaker.record_failure()
+        self.assertEqual(CircuitBreakerState.OPEN, breaker.state)
+        self.assertFalse(breaker.is_available())
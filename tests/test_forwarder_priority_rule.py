@@ -0,0 +1,27 @@
+from unittest import TestCase
+from orthanc_tools import ForwarderPriorityRule
+
+
+class TestForwarderPriorityRule(TestCase):
+
+    def test_tag_rule(self):
+        rule = ForwarderPriorityRule(priority=0, tag='ModalitiesInStudy', value='CR')
+
+        self.assertTrue(rule.matches(tags={'ModalitiesInStudy': 'CR'}, labels=[]))
+        self.assertTrue(rule.matches(tags={'ModalitiesInStudy': 'SR\\CR'}, labels=[]))
+        self.assertFalse(rule.matches(tags={'ModalitiesInStudy': 'CT'}, labels=[]))
+        self.assertFalse(rule.matches(tags={'ModalitiesInStudy': 'CRX'}, labels=[]))
+        self.assertFalse(rule.matches(tags={}, labels=[]))
+
+    def test_label_rule(self):
+        rule = ForwarderPriorityRule(priority=1, label='URGENT')
+
+        self.assertTrue(rule.matches(tags={}, labels=['URGENT', 'OTHER']))
+        self.assertFalse(rule.matches(tags={}, labels=['OTHER']))
+
+    def test_tag_and_label_rule(self):
+        rule = ForwarderPriorityRule(priority=1, tag='StationName', value='ER', label='URGENT')
+
+        self.assertTrue(rule.matches(tags={'StationName': 'ER'}, labels=['URGENT']))
+        self.assertFalse(rule.matches(tags={'StationName': 'ER'}, labels=[]))
+        self.assertFalse(rule.matches(tags={'StationName': 'CT1'}, labels=['URGENT']))
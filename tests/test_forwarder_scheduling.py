@@ -0,0 +1,85 @@
+from unittest import TestCase
+import queue
+import time
+from types import SimpleNamespace
+from orthanc_tools import OrthancForwarder, ForwarderDestination, ForwarderMode, ForwarderPriorityRule, ScheduledResource, ChangeType
+
+
+class FakeSource:
+
+    def __init__(self, studies):
+        self.studies_ids_lists = [list(studies.keys())]    # the successive results of studies.get_all_ids()
+        self.studies = SimpleNamespace(get_all_ids=self._get_all_studies_ids)
+        self._studies = studies                             # study id -> (modalities, size)
+
+    def _get_all_studies_ids(self):
+        if len(self.studies_ids_lists) > 1:
+            return self.studies_ids_lists.pop(0)
+        return self.studies_ids_lists[0]
+
+    def get_json(self, relative_url, params=None):
+        study_id = relative_url.split("/")[1]
+        modalities, size = self._studies[study_id]
+        if relative_url.endswith("/statistics"):
+            return {"DiskSize": str(size)}
+        return {"MainDicomTags": {}, "RequestedTags": {"ModalitiesInStudy": modalities}, "Labels": []}
+
+
+class TestForwarderScheduling(TestCase):
+
+    def create_forwarder(self, source, **kwargs) -> OrthancForwarder:
+        forwarder = OrthancForwarder(
+            source=source,
+            destinations=[ForwarderDestination(destination="dest", forwarder_mode=ForwarderMode.DICOM)],
+            trigger=ChangeType.STABLE_STUDY,
+            **kwargs
+        )
+        forwarder._resources_to_process = queue.Queue()  # unbounded since there is no worker to consume it
+        return forwarder
+
+    def get_dispatched_ids(self, forwarder: OrthancForwarder):
+        forwarder._enqueue_scheduled_resources()
+        dispatched_ids = []
+        while not forwarder._resources_to_process.empty():
+            dispatched_ids.append(forwarder._resources_to_process.get().resource_id)
+        return dispatched_ids
+
+    def test_priority_order(self):
+        source = FakeSource({"mr": ("MR", 100), "ct": ("CT", 100), "cr": ("CR", 100), "ct-cr": ("CT\\CR", 100)})
+        forwarder = self.create_forwarder(source, priority_rules=[
+            ForwarderPriorityRule(priority=0, tag="ModalitiesInStudy", value="CR"),
+            ForwarderPriorityRule(priority=5, tag="ModalitiesInStudy", value="CT")
+        ])
+
+        dispatched_ids = self.get_dispatched_ids(forwarder)
+
+        self.assertEqual({"cr", "ct-cr"}, set(dispatched_ids[0:2]))
+        self.assertEqual(["ct", "mr"], dispatched_ids[2:])
+
+    def test_aging(self):
+        source = FakeSource({"old-mr": ("MR", 100), "cr": ("CR", 100), "ct": ("CT", 100)})
+        forwarder = self.create_forwarder(source, aging_interval_in_seconds=60, priority_rules=[
+            ForwarderPriorityRule(priority=0, tag="ModalitiesInStudy", value="CR"),
+            ForwarderPriorityRule(priority=5, tag="ModalitiesInStudy", value="CT")
+        ])
+
+        # the MR study (default priority 10) has been waiting for 6 aging intervals -> it is now in priority class 4
+        forwarder._scheduled_resources["old-mr"] = ScheduledResource(priority=10, size=100, first_seen=time.time() - 6 * 60 - 1)
+
+        self.assertEqual(["cr", "old-mr", "ct"], self.get_dispatched_ids(forwarder))
+
+    def test_shortest_job_first(self):
+        source = FakeSource({"large": ("MR", 3000), "small": ("MR", 10), "medium": ("MR", 500), "urgent-large": ("CR", 5000)})
+        forwarder = self.create_forwarder(source, shortest_job_first=True, priority_rules=[
+            ForwarderPriorityRule(priority=0, tag="ModalitiesInStudy", value="CR")
+        ])
+
+        self.assertEqual(["urgent-large", "small", "medium", "large"], self.get_dispatched_ids(forwarder))
+
+    def test_resources_deleted_during_a_refresh(self):
+        source = FakeSource({"a": ("MR", 10), "b": ("MR", 20), "c": ("MR", 30)})
+        source.studies_ids_lists = [["a", "b", "c"], ["c"]]    # 'b' is deleted after 'a' has been dispatched
+        forwarder = self.create_forwarder(source, shortest_job_first=True, polling_interval_in_seconds=0)
+
+        self.assertEqual(["a", "c"], self.get_dispatched_ids(forwarder))
+        self.assertEqual({"c"}, set(forwarder._scheduled_resources.keys()))
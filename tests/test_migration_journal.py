@@ -0,0 +1,54 @@
+from unittest import TestCase
+import datetime
+import os
+import tempfile
+from orthanc_tools import MigrationJournal, MigrationStatus
+
+
+class TestMigrationJournal(TestCase):
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "journal.db")
+
+            journal = MigrationJournal(path, commit_interval=2)
+            journal.set_pending("s1", info="20220105;s1")
+            journal.set_pending("s2")
+            journal.set_pending("s3")
+            journal.set_done("s1", size=1000, duration=1.5)
+            journal.set_failed("s2", duration=30)
+            journal.set_recorded_until("20220101-20221231", datetime.date(2022, 1, 5))
+            journal.close()
+
+            # the outcomes are persisted
+            journal = MigrationJournal(path)
+            self.assertTrue(journal.is_done("s1"))
+            self.assertFalse(journal.is_done("s2"))
+            self.assertEqual(1000, journal.get("s1").size)
+            self.assertEqual("20220105;s1", journal.get("s1").info)
+            self.assertEqual(["s2"], [e.study_id for e in journal.get_entries(MigrationStatus.FAILED)])
+            self.assertEqual(["s3"], [e.study_id for e in journal.get_entries(MigrationStatus.PENDING)])
+            self.assertEqual(datetime.date(2022, 1, 5), journal.get_recorded_until("20220101-20221231"))
+            self.assertIsNone(journal.get_recorded_until("20230101-20231231"))
+
+            # a study that is done stays done when it is found again
+            journal.set_pending("s1")
+            journal.set_pending("s2")
+            self.assertEqual(MigrationStatus.DONE, journal.get("s1").status)
+            self.assertEqual(MigrationStatus.PENDING, journal.get("s2").status)
+            journal.close()
+
+    def test_entries_by_range(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal = MigrationJournal(os.path.join(temp_dir, "journal.db"))
+            journal.set_pending("s1", range_key="20220101-20221231")
+            journal.set_pending("s2", range_key="20230101-20231231")
+            journal.set_pending("s3")
+
+            self.assertEqual(["s1"], [e.study_id for e in journal.get_entries(MigrationStatus.PENDING, range_key="20220101-20221231")])
+            self.assertEqual(["s1", "s2", "s3"], [e.study_id for e in journal.get_entries(MigrationStatus.PENDING)])
+
+            # the range is kept when the study is pushed again without a range (i.e. when it is retried)
+            journal.set_pending("s1")
+            self.assertEqual("20220101-20221231", journal.get("s1").range_key)
+            journal.close()
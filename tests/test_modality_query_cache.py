@@ -0,0 +1,54 @@
+from unittest import TestCase
+import datetime
+import os
+import tempfile
+from orthanc_tools import ModalityQueryCache, CachedQueryResult
+
+
+class FakeModality:
+
+    def __init__(self, results):
+        self.results = results
+        self.queries_count = 0
+
+    def query(self, query):
+        self.queries_count += 1
+        return self.results
+
+
+class TestModalityQueryCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ModalityQueryCache(path=os.path.join(self.tmp_dir.name, "cache.db"), ttl_ratio=0.1)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_old_dates_are_cached(self):
+        modality = FakeModality([CachedQueryResult(dicom_id="1.2", tags={'StudyInstanceUID': "1.2", 'PatientID': "p1", 'Other': "x"})])
+        old_date = datetime.date.today() - datetime.timedelta(days=100)
+
+        for i in range(0, 3):
+            results = self.cache.query(query_key="studies:a", study_date=old_date, local_ids=["1.2"],
+                                       query={'StudyInstanceUID': '', 'PatientID': ''}, query_function=modality.query)
+
+        self.assertEqual(1, modality.queries_count)
+        self.assertEqual("1.2", results[0].dicom_id)
+        self.assertEqual({'StudyInstanceUID': "1.2", 'PatientID': "p1"}, results[0].tags)
+
+        # the modality is queried again when the local content changes or when the entry is removed
+        self.cache.query(query_key="studies:a", study_date=old_date, local_ids=["1.2", "1.3"], query={}, query_function=modality.query)
+        self.assertEqual(2, modality.queries_count)
+
+        self.cache.remove("studies:a")
+        self.assertIsNone(self.cache.get(query_key="studies:a", study_date=old_date, local_ids=["1.2", "1.3"]))
+
+    def test_recent_dates_are_not_cached(self):
+        modality = FakeModality([])
+
+        self.cache.query(query_key="studies:b", study_date=datetime.date.today(), local_ids=[], query={}, query_function=modality.query)
+        self.cache.query(query_key="studies:b", study_date=datetime.date.today(), local_ids=[], query={}, query_function=modality.query)
+
+        self.assertEqual(2, modality.queries_count)
+        self.assertEqual(3 * 24 * 3600, self.cache.get_ttl(datetime.date.today() - datetime.timedelta(days=30)))
@@ -0,0 +1,149 @@
+from unittest import TestCase
+import threading
+from types import SimpleNamespace
+from orthanc_api_client import InstancesSet, exceptions
+from orthanc_tools import OrthancForwarder, ForwarderDestination, ForwarderMode
+
+
+class FakeResponse:
+
+    def __init__(self, content):
+        self._content = content
+
+    def json(self):
+        return self._content
+
+
+class FakeSource:
+    """
+    A fake Orthanc that runs the store jobs (they complete when complete_jobs() is called) and records the deletions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = {}                  # job id -> state
+        self.requests = []
+        self.bulk_deletes = []          # the instances ids of each call to tools/bulk-delete
+
+    def post(self, endpoint: str, json: dict):
+        with self._lock:
+            self.requests.append(endpoint)
+            if endpoint == "tools/bulk-delete":
+                self.bulk_deletes.append(list(json["Resources"]))
+                return FakeResponse({})
+
+            job_id = f"job-{len(self.jobs)}"
+            self.jobs[job_id] = "Running"
+            return FakeResponse({"ID": job_id})
+
+    def get_json(self, relative_url: str, params=None):
+        with self._lock:
+            self.requests.append(relative_url)
+            job_id = relative_url.split("/")[1]
+            if job_id not in self.jobs:
+                raise exceptions.ResourceNotFound()
+            return {"ID": job_id, "State": self.jobs[job_id], "EffectiveRuntime": 0.1}
+
+    def complete_jobs(self):
+        with self._lock:
+            for job_id in self.jobs:
+                self.jobs[job_id] = "Success"
+
+
+def create_instances_set(api_client, series_id: str, instances_ids) -> InstancesSet:
+    instances_set = InstancesSet(api_client=api_client)
+    instances_set._add_series(series_id=series_id, instances_ids=list(instances_ids))
+    return instances_set
+
+
+class TestOrthancForwarder(TestCase):
+
+    def test_async_jobs(self):
+        source = FakeSource()
+        forwarded = []
+        forwarder = OrthancForwarder(
+            source=source,
+            destinations=[ForwarderDestination(destination="dest", forwarder_mode=ForwarderMode.DICOM)],
+            use_async_jobs=True,
+            on_instances_set_forwarded=lambda instances_set, destination: forwarded.append((instances_set.id, destination))
+        )
+
+        instances_set = create_instances_set(source, "series-1", ["i1", "i2"])
+        forwarder.handle_instances_set(instances_set)
+        self.assertEqual(["modalities/dest/store"], source.requests)
+
+        # the job is still running -> the InstancesSet is not handled again
+        forwarder._check_pending_jobs()
+        forwarder.handle_instances_set(instances_set)
+        self.assertEqual(["modalities/dest/store", "jobs/job-0"], source.requests)
+
+        # only the pending job is polled, the InstancesSet is then deleted
+        source.complete_jobs()
+        forwarder._check_pending_jobs()
+        self.assertEqual(["modalities/dest/store", "jobs/job-0", "jobs/job-0", "tools/bulk-delete"], source.requests)
+        self.assertEqual([(instances_set.id, "dest")], forwarded)
+        self.assertEqual({}, forwarder._status)
+
+        # no polling when there is no pending job
+        forwarder._check_pending_jobs()
+        self.assertEqual(4, len(source.requests))
+
+    def test_async_job_removed_from_history(self):
+        source = FakeSource()
+        forwarder = OrthancForwarder(
+            source=source,
+            destinations=[ForwarderDestination(destination="dest", forwarder_mode=ForwarderMode.DICOM)],
+            use_async_jobs=True
+        )
+
+        instances_set = create_instances_set(source, "series-1", ["i1", "i2"])
+        forwarder.handle_instances_set(instances_set)
+        source.jobs.clear()
+        forwarder._check_pending_jobs()
+
+        # the InstancesSet will be retried
+        self.assertEqual(1, forwarder._status[instances_set.id].retry_count)
+        self.assertEqual([], source.bulk_deletes)
+
+    def test_bulk_delete(self):
+        source = FakeSource()
+        forwarder = OrthancForwarder(
+            source=source,
+            destinations=[ForwarderDestination(destination="dest", forwarder_mode=ForwarderMode.DICOM)],
+            use_async_jobs=True,
+            bulk_delete_batch_size=3
+        )
+
+        instances_sets = [create_instances_set(source, "series-1", ["i1", "i2"]), create_instances_set(source, "series-2", ["i3", "i4"])]
+        for instances_set in instances_sets:
+            forwarder.handle_instances_set(instances_set)
+        source.complete_jobs()
+        forwarder._check_pending_jobs()
+
+        # the processed instances are buffered for deletion ...
+        self.assertEqual([], source.bulk_deletes)
+        self.assertEqual({"i1", "i2", "i3", "i4"}, forwarder._bulk_deleter.get_pending_ids())
+
+        # ... and are not handled again meanwhile
+        forwarder.handle_instances_set(create_instances_set(source, "series-1", ["i1", "i2"]))
+        self.assertEqual(2, len([r for r in source.requests if r.endswith("/store")]))
+
+        # they are deleted in batches
+        forwarder._bulk_deleter.flush()
+        self.assertEqual([["i1", "i2", "i3"], ["i4"]], source.bulk_deletes)
+        self.assertEqual(set(), forwarder._bulk_deleter.get_pending_ids())
+
+    def test_processor_modifying_uids(self):
+        source = FakeSource()
+        deleted = []
+        source.upload = lambda content: ["i1", "new-i2"]
+        source.instances = SimpleNamespace(delete=lambda orthanc_ids, ignore_errors: deleted.extend(orthanc_ids))
+        forwarder = OrthancForwarder(
+            source=source,
+            destinations=[ForwarderDestination(destination="dest", forwarder_mode=ForwarderMode.DICOM)]
+        )
+
+        # the instances created by the processor are deleted
+        with self.assertRaises(Exception):
+            forwarder._upload_processed_files(["i1", "i2"], [b"file-1", b"file-2"])
+        self.assertEqual(["new-i2"], deleted)
@@ -0,0 +1,136 @@
+from unittest import TestCase
+import datetime
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from orthanc_api_client import ResourceNotFound, ResourceType
+from orthanc_tools import OrthancMultiSyncher, StudySummary
+
+
+class FakeOrthanc:
+    """
+    An in-memory Orthanc that implements the few routes used by the multi syncher to compare and transfer a study.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.content = {}               # study id -> series id -> instances ids
+        self.uploaded = []
+
+        self.studies = SimpleNamespace(get_instances_ids=lambda study_id: sorted(i for instances_ids in self.content[study_id].values() for i in instances_ids))
+        self.series = SimpleNamespace(get_instances_ids=self._get_series_instances_ids)
+        self.instances = SimpleNamespace(get_file=lambda instance_id: instance_id.encode("utf8"))
+
+    def add(self, study_id: str, series: dict):
+        for series_id, instances_ids in series.items():
+            self.content.setdefault(study_id, {}).setdefault(series_id, set()).update(instances_ids)
+
+    def get_summary(self, study_id: str) -> StudySummary:
+        if study_id not in self.content:
+            return None
+        return StudySummary(orthanc_id=study_id, last_update=datetime.datetime(2025, 1, 1),
+                            series_count=len(self.content[study_id]), instances_count=sum(len(i) for i in self.content[study_id].values()))
+
+    def get_json(self, relative_url: str, params=None):
+        study_id = relative_url.split("/")[1]  # studies/{id}/series
+        if study_id not in self.content:
+            raise ResourceNotFound(msg="not found")
+        return [{"ID": series_id, "Instances": sorted(instances_ids)} for series_id, instances_ids in self.content[study_id].items()]
+
+    def _get_series_instances_ids(self, series_id: str):
+        return sorted(i for series in self.content.values() for s, instances_ids in series.items() if s == series_id for i in instances_ids)
+
+    def upload(self, data: bytes):
+        with self._lock:
+            self.uploaded.append(data.decode("utf8"))
+
+
+class TestOrthancMultiSyncher(TestCase):
+
+    def create_syncher(self, level: str, nodes_count: int = 3, **kwargs):
+        nodes = {n: FakeOrthanc() for n in ["a", "b", "c"][:nodes_count]}
+        syncher = OrthancMultiSyncher(api_clients=nodes, level=level, **kwargs)
+
+        # record the transfers instead of performing them
+        transfers = []
+        syncher.schedule_transfer = transfers.append
+        return syncher, nodes, transfers
+
+    def synch_study(self, syncher: OrthancMultiSyncher, nodes, study_id: str) -> bool:
+        return syncher.synch_study(study_id, {n: o.get_summary(study_id) for n, o in nodes.items()})
+
+    def test_identical_study(self):
+        syncher, nodes, transfers = self.create_syncher(level="Instance")
+        for o in nodes.values():
+            o.add("study", {"s1": {"i1", "i2"}})
+
+        self.assertTrue(self.synch_study(syncher, nodes, "study"))
+        self.assertEqual([], transfers)
+
+    def test_missing_study(self):
+        syncher, nodes, transfers = self.create_syncher(level="Study")
+        nodes["b"].add("study", {"s1": {"i1", "i2"}})
+
+        self.assertFalse(self.synch_study(syncher, nodes, "study"))
+        self.assertEqual([("b", "a", ["study"], ResourceType.STUDY), ("b", "c", ["study"], ResourceType.STUDY)],
+                         [(t.source, t.destination, t.resources_ids, t.resource_type) for t in transfers])
+
+    def test_choose_source_balances_the_load(self):
+        syncher, nodes, transfers = self.create_syncher(level="Study")
+
+        # the same study is in a and b, it is read once from each of them
+        for study_id in ["study-1", "study-2"]:
+            nodes["a"].add(study_id, {"s1": {"i1", "i2"}})
+            nodes["b"].add(study_id, {"s1": {"i1", "i2"}})
+            self.synch_study(syncher, nodes, study_id)
+
+        self.assertEqual(["a", "b"], [t.source for t in transfers])
+        self.assertEqual({"a": 2, "b": 2, "c": 0}, syncher._load)
+
+        # the most complete version of a series is always preferred, whatever the load
+        self.assertEqual("a", syncher._choose_source(["a", "b"], lambda n: {"a": 3, "b": 2}[n]))
+
+    def test_presence_matrix_plan(self):
+        syncher, nodes, transfers = self.create_syncher(level="Instance")
+        nodes["a"].add("study", {"s1": {"i1", "i2"}, "s2": {"i3"}})
+        nodes["b"].add("study", {"s1": {"i1"}})
+        nodes["c"].add("study", {"s1": {"i2", "i4"}})
+
+        series_presence, instances_presence, series_instances_count = syncher.get_presence_matrix("study", ["a", "b", "c"])
+        self.assertEqual({"s1": {"a", "b", "c"}, "s2": {"a"}}, series_presence)
+        self.assertEqual({"a", "c"}, instances_presence["i2"])
+        self.assertEqual(1, series_instances_count[("b", "s1")])
+
+        self.assertFalse(self.synch_study(syncher, nodes, "study"))
+        plan = {(t.source, t.destination): sorted(t.resources_ids) for t in transfers}
+        self.assertEqual({"a", "b", "c"}, set(n for pair in plan.keys() for n in pair))
+
+        # each node receives all the instances it is missing, each one read from a single node
+        received = {n: set() for n in nodes}
+        for (source, destination), instances_ids in plan.items():
+            self.assertTrue(all(source in instances_presence[i] for i in instances_ids))
+            received[destination].update(instances_ids)
+        self.assertEqual({"a": {"i4"}, "b": {"i2", "i3", "i4"}, "c": {"i1", "i3"}}, received)
+
+    def test_status_file_is_keyed_by_node(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "status.txt")
+            syncher, nodes, transfers = self.create_syncher(level="Series", persist_status_path=path)
+            syncher._last_update_limits = {"a": datetime.datetime(2025, 1, 1), "b": datetime.datetime(2025, 2, 2), "c": datetime.datetime(2025, 3, 3)}
+            syncher._save_status_to_file()
+
+            # the nodes have been reordered and a node has been added
+            syncher = OrthancMultiSyncher(api_clients={"d": FakeOrthanc(), "c": FakeOrthanc(), "a": FakeOrthanc()}, persist_status_path=path)
+            self.assertEqual({"d": None, "c": datetime.datetime(2025, 3, 3), "a": datetime.datetime(2025, 1, 1)}, syncher._last_update_limits)
+
+    def test_transfers_complete_when_the_scheduler_fails(self):
+        scheduler = SimpleNamespace(wait_right_time_to_run=lambda: 1 / 0)
+        syncher = OrthancMultiSyncher(api_clients={"a": FakeOrthanc(), "b": FakeOrthanc()}, scheduler=scheduler)
+        syncher.retry_delays = [0]
+        syncher._api_clients["a"].add("study", {"s1": {"i1"}})
+
+        syncher.synch_study("study", {"a": syncher._api_clients["a"].get_summary("study"), "b": None})
+        syncher._wait_transfers_completed()
+        syncher._stop_transfer_threads()
+        self.assertEqual([], syncher._api_clients["b"].uploaded)
@@ -6,7 +6,7 @@ import logging
 import unittest
 import pika
 
-from orthanc_tools import OrthancReplicator
+from orthanc_tools import OrthancReplicator, OrthancTestDbPopulator, SqliteTransport
 
 here = pathlib.Path(__file__).parent.resolve()
 
@@ -269,7 +269,140 @@ class TestOrthancReplicator(unittest.TestCase):
 
         replicator.stop()
 
+    def test_throughput_with_concurrent_workers(self):
+        self.oa.delete_all_content()
+        self.ob.delete_all_content()
+        self.purge_all_queues()
+
+        populator = OrthancTestDbPopulator(api_client=self.oa, studies_count=2, series_count=2, instances_count=50, random_seed=42, worker_threads_count=4)
+        populator.execute()
+        instances_count = len(self.oa.instances.get_all_ids())
+
+        broker_connection_parameters = self.get_rabbitmq_connection_params()
+        replicator = OrthancReplicator(
+            source=self.oa,
+            destination=self.ob,
+            broker_params=broker_connection_parameters,
+            worker_threads_count=4,
+            prefetch_count=20
+        )
+
+        start = time.time()
+        replicator.execute()
+
+        helpers.wait_until(lambda: len(self.ob.instances.get_all_ids()) == instances_count, 60)
+        elapsed = time.time() - start
+        logger.info(f"Replicated {instances_count} instances in {elapsed:.1f}s ({instances_count / elapsed:.1f} instances/s)")
+
+        self.assertEqual(instances_count, len(self.ob.instances.get_all_ids()))
+
+        # deletions are replicated too
+        self.oa.delete_all_content()
+        helpers.wait_until(lambda: len(self.ob.instances.get_all_ids()) == 0, 30)
+        self.assertEqual(0, len(self.ob.instances.get_all_ids()))
+
+        replicator.stop()
+
+    def test_forward_in_batches(self):
+        self.oa.delete_all_content()
+        self.ob.delete_all_content()
+        self.purge_all_queues()
+
+        populator = OrthancTestDbPopulator(api_client=self.oa, studies_count=1, series_count=2, instances_count=25, random_seed=42)
+        populator.execute()
+        instances_count = len(self.oa.instances.get_all_ids())
+
+        broker_connection_parameters = self.get_rabbitmq_connection_params()
+        replicator = OrthancReplicator(
+            source=self.oa,
+            destination=self.ob,
+            broker_params=broker_connection_parameters,
+            worker_threads_count=2,
+            prefetch_count=20,
+            forward_batch_size=10,
+            forward_batch_timeout_in_ms=200
+        )
+
+        replicator.execute()
+
+        helpers.wait_until(lambda: len(self.ob.instances.get_all_ids()) == instances_count, 30)
+        self.assertEqual(instances_count, len(self.ob.instances.get_all_ids()))
+
+        # all messages have been acked
+        helpers.wait_until(lambda: self.get_queue_length("forward", False) == 0, 5)
+        self.assertEqual(0, self.get_queue_length("forward", False))
+        self.assertEqual(0, self.get_queue_length("forward", True))
+
+        replicator.stop()
+
+    def test_coalescing_cancels_forward_of_deleted_instance(self):
+        self.oa.delete_all_content()
+        self.ob.delete_all_content()
+        self.purge_all_queues()
+
+        broker_connection_parameters = self.get_rabbitmq_connection_params()
+        replicator = OrthancReplicator(
+            source=self.oa,
+            destination=self.ob,
+            broker_params=broker_connection_parameters,
+            coalescing_window_in_ms=3000
+        )
+
+        replicator.execute()
+
+        # an instance that is deleted right after it has been received shall not be forwarded at all
+        self.oa.upload_file(here / "stimuli/CT_small.dcm")
+        self.oa.delete_all_content()
+
+        helpers.wait_until(lambda: replicator.get_statistics().cancelled_forwards == 1, 10)
+        self.assertEqual(1, replicator.get_statistics().cancelled_forwards)
+        self.assertEqual(0, len(self.ob.instances.get_all_ids()))
+
+        helpers.wait_until(lambda: self.get_queue_length("delete", False) == 0, 5)
+        self.assertEqual(0, self.get_queue_length("forward", False))
+        self.assertEqual(0, self.get_queue_length("delete", False))
+
+        replicator.stop()
+
+    def test_replicate_with_sqlite_transport(self):
+        self.oa.delete_all_content()
+        self.ob.delete_all_content()
+        self.purge_all_queues()
+
+        # no broker involved: the messages are published by the test itself
+        transport = SqliteTransport(path=":memory:", retry_delay=1)
+        replicator = OrthancReplicator(
+            source=self.oa,
+            destination=self.ob,
+            transport=transport,
+            worker_threads_count=4
+        )
+
+        replicator.execute()
+
+        populator = OrthancTestDbPopulator(api_client=self.oa, studies_count=2, series_count=2, instances_count=50, random_seed=42, worker_threads_count=4)
+        populator.execute()
+        instances_ids = self.oa.instances.get_all_ids()
+
+        start = time.time()
+        for instance_id in instances_ids:
+            transport.publish("forward", instance_id)
+
+        helpers.wait_until(lambda: transport.get_messages_count() == 0, 60)
+        elapsed = time.time() - start
+        logger.info(f"Replicated {len(instances_ids)} instances in {elapsed:.1f}s ({len(instances_ids) / elapsed:.1f} instances/s)")
+
+        self.assertEqual(len(instances_ids), len(self.ob.instances.get_all_ids()))
+
+        for instance_id in instances_ids:
+            transport.publish("delete", instance_id)
+
+        helpers.wait_until(lambda: len(self.ob.instances.get_all_ids()) == 0, 30)
+        self.assertEqual(0, len(self.ob.instances.get_all_ids()))
+
+        replicator.stop()
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     unittest.main()
-
@@ -0,0 +1,380 @@
+from unittest import TestCase
+import datetime
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from orthanc_api_client import ResourceNotFound
+from orthanc_tools import OrthancSyncher, OrthancSnapshot
+
+
+def to_orthanc_datetime(value: datetime.datetime) -> str:
+    return value.strftime("%Y%m%dT%H%M%S")
+
+
+class FakeResponse:
+
+    def __init__(self, content):
+        self._content = content
+
+    def json(self):
+        return self._content
+
+
+class FakeOrthanc:
+    """
+    An in-memory Orthanc that implements the few routes used by the syncher.
+    """
+
+    def __init__(self, events: list = None):
+        self._lock = threading.Lock()
+        self.content = {}               # study id -> series id -> instances ids
+        self.last_updates = {}          # study id -> LastUpdate
+        self.failing_downloads = {}     # instance id -> number of downloads that still have to fail
+        self.events = events if events is not None else []
+        self.requests_count = 0
+
+        self.studies = SimpleNamespace(get_instances_ids=lambda study_id: sorted(i for instances_ids in self.content[study_id].values() for i in instances_ids))
+        self.series = SimpleNamespace(get_instances_ids=self._get_series_instances_ids)
+        self.instances = SimpleNamespace(get_file=self._get_file)
+
+    def add(self, study_id: str, series: dict, last_update: datetime.datetime):
+        with self._lock:
+            for series_id, instances_ids in series.items():
+                self.content.setdefault(study_id, {}).setdefault(series_id, set()).update(instances_ids)
+            self.last_updates[study_id] = last_update
+
+    def _get_summary(self, study_id: str) -> dict:
+        return {
+            "ID": study_id,
+            "LastUpdate": to_orthanc_datetime(self.last_updates[study_id]),
+            "RequestedTags": {
+                "NumberOfStudyRelatedSeries": str(len(self.content[study_id])),
+                "NumberOfStudyRelatedInstances": str(sum(len(i) for i in self.content[study_id].values()))
+            }
+        }
+
+    def post(self, endpoint: str, json: dict):
+        with self._lock:
+            self.requests_count += 1
+            studies_ids = sorted(self.content.keys(), key=lambda s: self.last_updates[s], reverse=True)
+            return FakeResponse([self._get_summary(s) for s in studies_ids[json["Since"]:json["Since"] + json["Limit"]]])
+
+    def get_json(self, relative_url: str, params=None):
+        with self._lock:
+            self.requests_count += 1
+            segments = relative_url.split("/")
+            if segments[1] not in self.content:
+                raise ResourceNotFound(msg="not found")
+            if len(segments) == 3:  # studies/{id}/series
+                return [{"ID": series_id, "Instances": sorted(instances_ids)} for series_id, instances_ids in self.content[segments[1]].items()]
+            return self._get_summary(segments[1])
+
+    def get_statistics(self):
+        with self._lock:
+            return SimpleNamespace(studies_count=len(self.content))
+
+    def has_loaded_plugin(self, plugin: str) -> bool:
+        return False
+
+    def _get_series_instances_ids(self, series_id: str):
+        with self._lock:
+            return sorted(i for series in self.content.values() for s, instances_ids in series.items() if s == series_id for i in instances_ids)
+
+    def _get_file(self, instance_id: str):
+        with self._lock:
+            if self.failing_downloads.get(instance_id, 0) > 0:
+                self.failing_downloads[instance_id] -= 1
+                raise Exception(f"Could not download instance {instance_id}")
+
+            study_id, series_id = next((st, se) for st, series in self.content.items() for se, instances_ids in series.items() if instance_id in instances_ids)
+            return study_id, series_id, instance_id
+
+    def upload(self, file):
+        study_id, series_id, instance_id = file
+        self.add(study_id, {series_id: [instance_id]}, datetime.datetime.now())
+        self.events.append(("upload", instance_id))
+
+
+class TestOrthancSnapshot(TestCase):
+
+    def create_orthanc(self, studies_count: int) -> FakeOrthanc:
+        orthanc = FakeOrthanc()
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+        for i in range(0, studies_count):
+            orthanc.add(f"study-{i}", {f"series-{i}": [f"instance-{i}-a", f"instance-{i}-b"]}, now - datetime.timedelta(days=i))
+        return orthanc
+
+    def test_load_all(self):
+        orthanc = self.create_orthanc(studies_count=25)
+        snapshot = OrthancSnapshot(api_client=orthanc, batch_size=10)
+        snapshot.load()
+
+        self.assertTrue(snapshot.is_complete)
+        self.assertEqual(3, orthanc.requests_count)
+        self.assertEqual(25, len(snapshot.studies))
+        self.assertEqual(1, snapshot.get("study-3").series_count)
+        self.assertEqual(2, snapshot.get("study-3").instances_count)
+
+        # the snapshot is complete -> an unknown study is not looked up
+        self.assertIsNone(snapshot.get("unknown"))
+        self.assertEqual(3, orthanc.requests_count)
+
+    def test_partial_load(self):
+        orthanc = self.create_orthanc(studies_count=25)
+        snapshot = OrthancSnapshot(api_client=orthanc, batch_size=10)
+        last_update_limit = datetime.datetime(2025, 6, 1, 12, 0, 0) - datetime.timedelta(days=4, hours=12)
+        snapshot.load(last_update_limit=last_update_limit)
+
+        # the listing stops after the first batch that reaches the limit
+        self.assertFalse(snapshot.is_complete)
+        self.assertEqual(1, orthanc.requests_count)
+        self.assertEqual([f"study-{i}" for i in range(0, 5)], [s.orthanc_id for s in snapshot.get_studies_updated_since(last_update_limit)])
+
+        # the studies that have not been listed are looked up one by one
+        self.assertEqual("study-20", snapshot.get("study-20").orthanc_id)
+        self.assertIsNone(snapshot.get("unknown"))
+        self.assertEqual(3, orthanc.requests_count)
+
+        # the listing resumes where it stopped
+        snapshot.load()
+        self.assertTrue(snapshot.is_complete)
+        self.assertEqual(25, len([s for s in snapshot.studies.values() if s is not None]))
+        self.assertEqual(5, orthanc.requests_count)
+
+
+class TestOrthancSyncher(TestCase):
+
+    def test_compare_studies(self):
+        orthanc_1 = FakeOrthanc()
+        orthanc_2 = FakeOrthanc()
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+
+        orthanc_1.add("identical", {"s1": ["i1", "i2"]}, now)
+        orthanc_2.add("identical", {"s1": ["i1", "i2"]}, now)
+        orthanc_1.add("missing", {"s2": ["i3"]}, now)
+        orthanc_1.add("missing-series", {"s3": ["i4"], "s4": ["i5"]}, now)
+        orthanc_2.add("missing-series", {"s3": ["i4"]}, now)
+        orthanc_1.add("missing-instances", {"s5": ["i6", "i7"]}, now)
+        orthanc_2.add("missing-instances", {"s5": ["i6", "i8", "i9"]}, now)
+
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, level="Instance")
+        transfers = []
+        syncher.transfer_resources = lambda transfer: transfers.append(transfer)
+
+        self.assertTrue(syncher.compare_studies(orthanc_1, orthanc_2, "identical"))
+        self.assertEqual([], transfers)
+
+        self.assertFalse(syncher.compare_studies(orthanc_1, orthanc_2, "missing"))
+        self.assertEqual([(orthanc_1, "STUDY", ["missing"])], [(t.orthanc_source, t.resource_type.name, t.resources_ids) for t in transfers])
+
+        transfers.clear()
+        self.assertFalse(syncher.compare_studies(orthanc_1, orthanc_2, "missing-series"))
+        self.assertEqual([(orthanc_1, "SERIES", ["s4"])], [(t.orthanc_source, t.resource_type.name, t.resources_ids) for t in transfers])
+
+        # the instances are missing on both sides
+        transfers.clear()
+        self.assertFalse(syncher.compare_studies(orthanc_1, orthanc_2, "missing-instances", bidirectional=True))
+        self.assertEqual([(orthanc_1, "INSTANCE", ["i7"]), (orthanc_2, "INSTANCE", ["i8", "i9"])], [(t.orthanc_source, t.resource_type.name, t.resources_ids) for t in transfers])
+
+        # same counts at series level -> identical without listing the content
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, level="Series")
+        syncher.transfer_resources = lambda transfer: transfers.append(transfer)
+        requests_count = orthanc_1.requests_count + orthanc_2.requests_count
+        transfers.clear()
+        self.assertTrue(syncher.compare_studies(orthanc_1, orthanc_2, "missing-instances"))
+        self.assertEqual([], transfers)
+        self.assertEqual(requests_count + 2, orthanc_1.requests_count + orthanc_2.requests_count)
+
+    def test_checkpoint_lags_behind_pending_retries(self):
+        events = []
+        orthanc_1 = FakeOrthanc(events)
+        orthanc_2 = FakeOrthanc(events)
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+        for i in range(0, 4):
+            orthanc_1.add(f"study-{i}", {f"series-{i}": [f"instance-{i}"]}, now - datetime.timedelta(hours=i))
+        orthanc_1.failing_downloads["instance-0"] = 1    # the study of the first batch needs a retry
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, persist_status_path=os.path.join(temp_dir, "status.txt"),
+                                     orthanc_queries_batch_size=1, transfer_threads_count=2)
+            syncher.retry_delays = [0.5]
+
+            compare_studies = syncher.compare_studies
+            syncher.compare_studies = lambda *args, **kwargs: events.append(("compare", args[2])) or compare_studies(*args, **kwargs)
+            save_checkpoint = syncher._save_checkpoint
+            syncher._save_checkpoint = lambda *args, **kwargs: events.append(("checkpoint", kwargs["batch_index"])) or save_checkpoint(*args, **kwargs)
+
+            syncher.synch(orthanc_source=orthanc_1, orthanc_destination=orthanc_2, last_update_limit=now - datetime.timedelta(days=1), checkpoint_index=0)
+
+        self.assertEqual(orthanc_1.content, orthanc_2.content)
+
+        # the comparison of the next batches has not waited for the retry ...
+        retry_index = events.index(("upload", "instance-0"))
+        self.assertLess(events.index(("compare", "study-3")), retry_index)
+
+        # ... but the checkpoint has
+        checkpoints = [e[1] for e in events if e[0] == "checkpoint"]
+        self.assertLess(retry_index, events.index(("checkpoint", checkpoints[0])))
+        self.assertEqual(4, checkpoints[-1])
+
+    def create_orthancs(self, studies_count: int, events: list = None):
+        # all the studies of Orthanc-1 are missing in Orthanc-2
+        orthanc_1 = FakeOrthanc(events)
+        orthanc_2 = FakeOrthanc(events)
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+        for i in range(0, studies_count):
+            orthanc_1.add(f"study-{i}", {f"series-{i}": [f"instance-{i}"]}, now - datetime.timedelta(hours=i))
+        return orthanc_1, orthanc_2, now - datetime.timedelta(days=1)
+
+    def test_bounded_transfer_pool(self):
+        orthanc_1, orthanc_2, last_update_limit = self.create_orthancs(studies_count=20)
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, transfer_threads_count=2, transfer_queue_size=2)
+
+        lock = threading.Lock()
+        counts = {"compared": 0, "transferred": 0, "in_progress": 0, "max_in_progress": 0, "max_not_transferred": 0}
+
+        compare_studies = syncher.compare_studies
+        def _compare_studies(*args, **kwargs):
+            with lock:
+                counts["compared"] += 1
+                counts["max_not_transferred"] = max(counts["max_not_transferred"], counts["compared"] - counts["transferred"])
+            return compare_studies(*args, **kwargs)
+
+        transfer_resources = syncher.transfer_resources
+        def _transfer_resources(transfer):
+            with lock:
+                counts["in_progress"] += 1
+                counts["max_in_progress"] = max(counts["max_in_progress"], counts["in_progress"])
+            time.sleep(0.02)
+            transfer_resources(transfer)
+            with lock:
+                counts["in_progress"] -= 1
+                counts["transferred"] += 1
+
+        syncher.compare_studies = _compare_studies
+        syncher.transfer_resources = _transfer_resources
+        syncher.synch(orthanc_source=orthanc_1, orthanc_destination=orthanc_2, last_update_limit=last_update_limit)
+
+        self.assertEqual(orthanc_1.content, orthanc_2.content)
+        self.assertEqual(2, counts["max_in_progress"])
+        # the comparison can not get ahead of the transfers by more than the threads + the queue (+ the transfer being queued)
+        self.assertLessEqual(counts["max_not_transferred"], 2 + 2 + 1)
+
+    def test_delayed_retries(self):
+        events = []
+        orthanc_1, orthanc_2, last_update_limit = self.create_orthancs(studies_count=5, events=events)
+        orthanc_1.failing_downloads["instance-0"] = 2
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, transfer_threads_count=1)
+        syncher.retry_delays = [0.2, 0.2]
+
+        start = time.time()
+        syncher.synch(orthanc_source=orthanc_1, orthanc_destination=orthanc_2, last_update_limit=last_update_limit)
+
+        self.assertEqual(orthanc_1.content, orthanc_2.content)
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        # the failed transfer has not blocked the other ones
+        self.assertEqual(("upload", "instance-0"), events[-1])
+        self.assertEqual([], syncher.get_quarantined_studies())
+
+    def test_scheduler_pauses_the_transfers(self):
+        orthanc_1, orthanc_2, last_update_limit = self.create_orthancs(studies_count=3)
+        right_time_to_run = threading.Event()
+        scheduler = SimpleNamespace(wait_right_time_to_run=right_time_to_run.wait)
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, scheduler=scheduler, transfer_threads_count=2)
+
+        thread = threading.Thread(target=syncher.synch, kwargs={"orthanc_source": orthanc_1, "orthanc_destination": orthanc_2, "last_update_limit": last_update_limit})
+        thread.start()
+
+        time.sleep(0.3)
+        self.assertEqual({}, orthanc_2.content)
+        self.assertTrue(thread.is_alive())
+
+        right_time_to_run.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(orthanc_1.content, orthanc_2.content)
+
+    def test_concurrent_directions(self):
+        orthanc_1 = FakeOrthanc()
+        orthanc_2 = FakeOrthanc()
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+
+        orthanc_1.add("only-in-1", {"s1": ["i1"]}, now)
+        orthanc_2.add("only-in-2", {"s2": ["i2"]}, now)
+        # updated on both sides (with some content missing on each side)
+        for i in range(0, 10):
+            orthanc_1.add(f"both-{i}", {f"s-{i}": [f"i-{i}-a", f"i-{i}-b"]}, now - datetime.timedelta(minutes=i))
+            orthanc_2.add(f"both-{i}", {f"s-{i}": [f"i-{i}-a", f"i-{i}-c", f"i-{i}-d"]}, now - datetime.timedelta(minutes=i))
+
+        syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, level="Instance", orthanc_queries_batch_size=3, transfer_threads_count=2)
+
+        compared_studies = []
+        compare_studies = syncher.compare_studies
+        syncher.compare_studies = lambda *args, **kwargs: compared_studies.append(args[2]) or compare_studies(*args, **kwargs)
+
+        syncher.execute()
+
+        self.assertEqual(orthanc_1.content, orthanc_2.content)
+        self.assertEqual({"i-0-a", "i-0-b", "i-0-c", "i-0-d"}, orthanc_1.content["both-0"]["s-0"])
+
+        # each study has been handled only once, by one of the 2 runs
+        self.assertEqual(12, len(compared_studies))
+        self.assertEqual(12, len(set(compared_studies)))
+
+    def test_resume_from_checkpoint(self):
+        orthanc_1, orthanc_2, last_update_limit = self.create_orthancs(studies_count=10)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            persist_status_path = os.path.join(temp_dir, "status.txt")
+
+            # the first execution is interrupted once a checkpoint has been saved
+            syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, persist_status_path=persist_status_path,
+                                     orthanc_queries_batch_size=2, transfer_threads_count=1)
+            save_checkpoint = syncher._save_checkpoint
+            saved_batch_indexes = []
+
+            def _save_checkpoint_and_crash(*args, **kwargs):
+                save_checkpoint(*args, **kwargs)
+                if args[0] == 0:
+                    saved_batch_indexes.append(kwargs["batch_index"])
+                    raise InterruptedError()
+
+            syncher._save_checkpoint = _save_checkpoint_and_crash
+            compare_studies = syncher.compare_studies
+            syncher.compare_studies = lambda *args, **kwargs: time.sleep(0.05) or compare_studies(*args, **kwargs)  # let the transfers complete
+            with self.assertRaises(InterruptedError):
+                syncher.execute()
+            self.assertTrue(os.path.exists(persist_status_path + ".checkpoint"))
+
+            # the next execution resumes after the checkpoint
+            syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, persist_status_path=persist_status_path,
+                                     orthanc_queries_batch_size=2, transfer_threads_count=1)
+            compared_studies = []
+            compare_studies = syncher.compare_studies
+            syncher.compare_studies = lambda *args, **kwargs: (compared_studies.append(args[2]) if args[0] == orthanc_1 else None) or compare_studies(*args, **kwargs)
+            syncher.execute()
+
+            # the studies at the boundaries of the checkpoint (same LastUpdate) are processed again
+            self.assertLess(saved_batch_indexes[0], 5)
+            self.assertEqual(["study-0"] + [f"study-{i}" for i in range(saved_batch_indexes[0] * 2 - 1, 10)], compared_studies)
+            self.assertEqual(orthanc_1.content, orthanc_2.content)
+            self.assertFalse(os.path.exists(persist_status_path + ".checkpoint"))
+
+    def test_quarantine(self):
+        orthanc_1, orthanc_2, last_update_limit = self.create_orthancs(studies_count=3)
+        orthanc_1.failing_downloads["instance-1"] = 10
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            error_log_file_path = os.path.join(temp_dir, "errors.log")
+            syncher = OrthancSyncher(api_client_1=orthanc_1, api_client_2=orthanc_2, error_log_file_path=error_log_file_path, transfer_threads_count=2)
+            syncher.retry_delays = [0.05, 0.05]
+
+            syncher.synch(orthanc_source=orthanc_1, orthanc_destination=orthanc_2, last_update_limit=last_update_limit)
+
+            # the other studies have been synched
+            self.assertEqual(["study-1"], syncher.get_quarantined_studies())
+            self.assertEqual({"study-0", "study-2"}, set(orthanc_2.content.keys()))
+            with open(error_log_file_path) as f:
+                self.assertEqual("study-1\n", f.read())
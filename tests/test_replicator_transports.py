@@ -0,0 +1,125 @@
+from unittest import TestCase
+import threading
+import tempfile
+import logging
+import time
+import os
+from orthanc_tools import SqliteTransport
+
+logger = logging.getLogger(__name__)
+
+
+class TestSqliteTransport(TestCase):
+
+    def consume_in_thread(self, transport: SqliteTransport, received: list, consumers_count: int = 1, prefetch_count: int = 10):
+        thread = threading.Thread(target=transport.consume, kwargs={
+            "on_message": lambda m: received.append(m),
+            "consumers_count": consumers_count,
+            "prefetch_count": prefetch_count
+        })
+        thread.start()
+        return thread
+
+    def wait_until(self, condition, timeout: float = 5):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            time.sleep(0.01)
+
+    def test_ack_and_nack(self):
+        transport = SqliteTransport(path=":memory:", retry_delay=0.3, polling_interval=0.01)
+        transport.publish("forward", "1")
+        transport.publish("delete", "2")
+
+        received = []
+        thread = self.consume_in_thread(transport, received)
+
+        self.wait_until(lambda: len(received) == 2)
+        self.assertEqual([("forward", "1"), ("delete", "2")], [(m.action, m.orthanc_id) for m in received])
+
+        # un-acknowledged messages are not delivered twice
+        time.sleep(0.1)
+        self.assertEqual(2, len(received))
+
+        transport.acknowledge([(received[0], True), (received[1], False)])
+        self.assertEqual(1, transport.get_messages_count())
+
+        # the failed message is delivered again after the retry delay
+        time.sleep(0.1)
+        self.assertEqual(2, len(received))
+        self.wait_until(lambda: len(received) == 3)
+        self.assertEqual("2", received[2].orthanc_id)
+
+        transport.acknowledge([(received[2], True)])
+        self.assertEqual(0, transport.get_messages_count())
+
+        transport.stop()
+        thread.join()
+
+    def test_prefetch(self):
+        transport = SqliteTransport(path=":memory:", polling_interval=0.01)
+        for i in range(0, 10):
+            transport.publish("forward", str(i))
+
+        received = []
+        thread = self.consume_in_thread(transport, received, consumers_count=2, prefetch_count=2)
+
+        self.wait_until(lambda: len(received) == 4)
+        time.sleep(0.1)
+        self.assertEqual(4, len(received))
+
+        transport.acknowledge([(m, True) for m in received[:2]])
+        self.wait_until(lambda: len(received) == 6)
+        self.assertEqual(["0", "1", "2", "3", "4", "5"], [m.orthanc_id for m in received])
+
+        transport.stop()
+        thread.join()
+
+    def test_durability(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "queue.db")
+
+            transport = SqliteTransport(path=path, polling_interval=0.01)
+            transport.publish("forward", "1")
+            transport.publish("forward", "2")
+
+            received = []
+            thread = self.consume_in_thread(transport, received)
+            self.wait_until(lambda: len(received) == 2)
+            transport.acknowledge([(received[0], True)])
+            transport.stop()
+            thread.join()
+
+            # the message that has not been acknowledged is delivered again after a restart
+            transport = SqliteTransport(path=path, polling_interval=0.01)
+            received = []
+            thread = self.consume_in_thread(transport, received)
+            self.wait_until(lambda: len(received) == 1)
+            self.assertEqual(["2"], [m.orthanc_id for m in received])
+            transport.stop()
+            thread.join()
+
+    def test_throughput(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            transport = SqliteTransport(path=os.path.join(temp_dir, "queue.db"), polling_interval=0.001)
+            messages_count = 2000
+
+            start = time.time()
+            for i in range(0, messages_count):
+                transport.publish("forward", str(i))
+            publish_elapsed = time.time() - start
+
+            # each message is acknowledged as soon as it is received
+            start = time.time()
+            thread = threading.Thread(target=transport.consume, kwargs={
+                "on_message": lambda m: transport.acknowledge([(m, True)]),
+                "consumers_count": 4,
+                "prefetch_count": 50
+            })
+            thread.start()
+            self.wait_until(lambda: transport.get_messages_count() == 0, timeout=60)
+            consume_elapsed = time.time() - start
+            transport.stop()
+            thread.join()
+
+            logger.info(f"Published {messages_count} messages at {messages_count / publish_elapsed:.0f} msg/s, consumed at {messages_count / consume_elapsed:.0f} msg/s")
+            self.assertEqual(0, transport.get_messages_count())
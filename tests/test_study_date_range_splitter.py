@@ -0,0 +1,66 @@
+from unittest import TestCase
+import datetime
+from orthanc_tools import StudyDateRangeSplitter
+
+
+class FakePacs:
+
+    def __init__(self, studies, max_results_count):
+        self.studies = studies      # list of (dicom date, dicom time)
+        self.max_results_count = max_results_count
+        self.queries = []
+
+    @staticmethod
+    def _matches(value, query_range):
+        first, _, last = query_range.partition('-')
+        return first <= value <= (last or first)
+
+    @classmethod
+    def _matches_time(cls, value, query_range):
+        # an empty value only matches the empty value matching ("") and the string comparisons are lexical
+        if query_range == '""':
+            return value == ""
+        return value != "" and cls._matches(value, query_range)
+
+    def query_studies(self, query):
+        self.queries.append(query)
+        results = [s for s in self.studies
+                   if self._matches(s[0], query['StudyDate']) and ('StudyTime' not in query or self._matches_time(s[1], query['StudyTime']))]
+        return results[:self.max_results_count]
+
+
+class TestStudyDateRangeSplitter(TestCase):
+
+    def test_no_study_is_lost(self):
+        studies = [("20220105", "101010"), ("20220106", "101010"), ("20220301", "080000")]
+        studies += [("20220210", f"{h:02d}0000") for h in range(0, 24)]    # a dense day
+        studies += [("20220210", "101010.5"), ("20220210", "125959.999"), ("20220210", "")]    # with fractional seconds and without StudyTime
+        pacs = FakePacs(studies, max_results_count=5)
+
+        splitter = StudyDateRangeSplitter(query_studies=pacs.query_studies, max_results_count=5, initial_range_in_days=30)
+        found = []
+        for date_range, results in splitter.iterate(datetime.date(2022, 1, 1), datetime.date(2022, 12, 31)):
+            self.assertFalse(date_range.is_truncated)
+            found.extend(results)
+
+        self.assertEqual(sorted(studies), sorted(found))
+        self.assertLess(len(pacs.queries), 100)    # instead of 365 with one query per day
+
+    def test_backward_and_unknown_limit(self):
+        studies = [("20220105", "101010"), ("20220103", "101010")]
+        pacs = FakePacs(studies, max_results_count=100)
+
+        # without a known limit, the dates are queried one by one
+        splitter = StudyDateRangeSplitter(query_studies=pacs.query_studies)
+        date_ranges = [str(date_range) for date_range, results in splitter.iterate(datetime.date(2022, 1, 5), datetime.date(2022, 1, 1))]
+
+        self.assertEqual(["20220105", "20220104", "20220103", "20220102", "20220101"], date_ranges)
+
+    def test_truncated_second(self):
+        pacs = FakePacs([("20220105", "101010")] * 3, max_results_count=2)
+
+        splitter = StudyDateRangeSplitter(query_studies=pacs.query_studies, max_results_count=2)
+        truncated_ranges = [date_range for date_range, results in splitter.iterate(datetime.date(2022, 1, 5), datetime.date(2022, 1, 5)) if date_range.is_truncated]
+
+        self.assertEqual(1, len(truncated_ranges))
+        self.assertEqual({'StudyDate': '20220105', 'StudyTime': '101010-101010.999999'}, truncated_ranges[0].get_query())
@@ -0,0 +1,42 @@
+from unittest import TestCase
+import threading
+from orthanc_tools import WatermarkFlowController
+
+
+class TestWatermarkFlowController(TestCase):
+
+    def test_active_count(self):
+        controller = WatermarkFlowController(name="test", get_usage=lambda: 0, low_watermark=800, high_watermark=1000, max_active_count=4)
+
+        self.assertEqual(4, controller.get_active_count(500))
+        self.assertEqual(4, controller.get_active_count(800))
+        self.assertEqual(2, controller.get_active_count(900))
+        self.assertEqual(1, controller.get_active_count(999))
+        self.assertEqual(0, controller.get_active_count(1000))
+        self.assertEqual(0, controller.get_active_count(2000))
+
+    def test_workers_are_paused_above_high_watermark(self):
+        usage = [2000]
+        controller = WatermarkFlowController(name="test", get_usage=lambda: usage[0], low_watermark=800, high_watermark=1000,
+                                             max_active_count=2, sampling_interval=0.05)
+        controller.start()
+        self.assertEqual(0, controller.active_count)
+
+        acquired = threading.Event()
+
+        def _acquire():
+            controller.acquire()
+            acquired.set()
+            controller.release()
+
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+
+        # the disk has been emptied -> the worker resumes at the next sample
+        usage[0] = 100
+        self.assertTrue(acquired.wait(1))
+        self.assertEqual(2, controller.active_count)
+
+        thread.join()
+        controller.stop()